@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        # Обёртка учёта запросов ставится на соединения при их открытии,
+        # поэтому приёмник connection_created регистрируется до первого.
+        from foodgramm import instrumentation  # noqa: F401
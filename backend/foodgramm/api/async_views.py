@@ -0,0 +1,171 @@
+import functools
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import NotFound
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from recipe.models import Recipe
+
+from .authentication import token_cache
+from .cache import (
+    get_viewer_overlay,
+    is_cacheable,
+    lookup_response,
+    render_cached,
+    store_response
+)
+from .filters import RecipeFilter
+from .ingredient_index import ingredient_index
+from .pagination import PaginationLimiter
+from .serializers import RecipeSerializer
+from .views import IngredientViewSet, RecipeViewSet
+
+JSON_MEDIA_TYPES = ('', '*/*', 'application/*', 'application/json')
+
+
+def accepts_json(request):
+    if 'format' in request.GET:
+        return False
+    return any(
+        media_type.split(';')[0].strip() in JSON_MEDIA_TYPES
+        for media_type in request.headers.get('Accept', '').split(',')
+    )
+
+
+async def authenticate(request):
+    header = request.headers.get('Authorization', '').split()
+    if not header:
+        return AnonymousUser()
+    if len(header) != 2 or header[0].lower() != 'token':
+        return None
+    if settings.TOKEN_CACHE_TTL:
+        token = await sync_to_async(
+            token_cache.get, thread_sensitive=False
+        )(header[1])
+        if token is not None:
+            return token.user
+    token = await Token.objects.select_related('user').filter(
+        key=header[1]
+    ).afirst()
+    if token is None or not token.user.is_active:
+        return None
+    if settings.TOKEN_CACHE_TTL:
+        await sync_to_async(token_cache.set, thread_sensitive=False)(
+            header[1], token
+        )
+    return token.user
+
+
+def async_read_view(viewset, actions, **initkwargs):
+    """Асинхронный GET поверх синхронного ViewSet.
+
+    Всё, что обработчик не берёт на себя (запись, другие форматы, ошибки
+    аутентификации и валидации), уходит в исходный ViewSet; обработчик
+    сообщает об этом, возвращая None.
+    """
+    fallback = sync_to_async(viewset.as_view(actions, **initkwargs))
+
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def view(request, *args, **kwargs):
+            response = None
+            if request.method == 'GET' and accepts_json(request):
+                user = await authenticate(request)
+                if user is not None:
+                    drf_request = Request(request)
+                    drf_request.user = user
+                    response = await handler(drf_request, *args, **kwargs)
+            if response is None:
+                response = await fallback(request, *args, **kwargs)
+            return response
+
+        view = csrf_exempt(view)
+        view.cls = viewset
+        view.actions = actions
+        return view
+
+    return decorator
+
+
+def json_response(data):
+    return HttpResponse(
+        JSONRenderer().render(data), content_type='application/json'
+    )
+
+
+async def cached_recipes(request, build):
+    if not is_cacheable(request):
+        data = await build()
+        return None if data is None else json_response(data)
+    key, cached = await sync_to_async(lookup_response)(request)
+    if cached is not None:
+        overlay = await sync_to_async(get_viewer_overlay)(request.user)
+        return render_cached(cached, request, overlay, RecipeSerializer)
+    data = await build()
+    if data is None:
+        return None
+    return await sync_to_async(store_response)(
+        key, data, request, RecipeSerializer
+    )
+
+
+@async_read_view(RecipeViewSet, {'get': 'list', 'post': 'create'})
+async def recipe_list(request):
+    async def build():
+        filterset = RecipeFilter(
+            request.query_params,
+            Recipe.objects.with_user_state(request.user),
+            request=request
+        )
+        if not filterset.is_valid():
+            return None
+        paginator = PaginationLimiter()
+        try:
+            page = await paginator.apaginate_queryset(
+                filterset.qs, request,
+                RecipeViewSet.get_keyset_ordering(request)
+            )
+        except NotFound:
+            return None
+        serializer = RecipeSerializer(
+            page, many=True, context={'request': request}
+        )
+        return paginator.get_paginated_response(serializer.data).data
+
+    return await cached_recipes(request, build)
+
+
+@async_read_view(RecipeViewSet, {
+    'get': 'retrieve',
+    'put': 'update',
+    'patch': 'partial_update',
+    'delete': 'destroy',
+}, detail=True)
+async def recipe_detail(request, pk):
+    async def build():
+        try:
+            recipe = await Recipe.objects.with_user_state(
+                request.user
+            ).aget(pk=pk)
+        except Recipe.DoesNotExist:
+            return None
+        return RecipeSerializer(recipe, context={'request': request}).data
+
+    return await cached_recipes(request, build)
+
+
+@async_read_view(IngredientViewSet, {'get': 'list'})
+async def ingredient_list(request):
+    name = request.query_params.get('name')
+    if not name:
+        return None
+    return HttpResponse(
+        await ingredient_index.arender(name, settings.INGREDIENT_SEARCH_LIMIT),
+        content_type='application/json'
+    )
@@ -0,0 +1,145 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from foodgramm.metrics import cache_result
+
+VERSION_KEY = 'auth:revoked:version'
+REVOCATION_TIMEOUT = 24 * 3600
+MAX_REVOCATIONS = 1000
+
+
+def token_key(key):
+    return f'auth:token:{key}'
+
+
+def revocation_key(version):
+    return f'auth:revoked:{version}'
+
+
+def get_shared_cache():
+    if settings.TOKEN_CACHE_ALIAS:
+        return caches[settings.TOKEN_CACHE_ALIAS]
+    return None
+
+
+def local_ttl(shared):
+    # LocMemCache и журнал отзыва в нём у каждого процесса свои.
+    if shared is None or isinstance(shared, LocMemCache):
+        return min(settings.TOKEN_CACHE_TTL, settings.TOKEN_CACHE_LOCAL_TTL)
+    return settings.TOKEN_CACHE_TTL
+
+
+class TokenCache:
+    """Токены вместе с пользователями: LRU с TTL в процессе и общий кеш.
+
+    Отозванные пользователи записываются в журнал общего кеша, по которому
+    остальные процессы чистят свои записи. Без общего кеша другие процессы
+    узнают об отзыве не позже чем через TOKEN_CACHE_LOCAL_TTL.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._version = None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._version = None
+
+    def _drop(self, user_ids):
+        for key in [
+            key for key, (_, token) in self._entries.items()
+            if token.user_id in user_ids
+        ]:
+            del self._entries[key]
+
+    def _sync(self, shared):
+        version = shared.get(VERSION_KEY, 0)
+        if self._version is None or version < self._version:
+            self._entries.clear()
+        elif version - self._version > MAX_REVOCATIONS:
+            self._entries.clear()
+        elif version > self._version:
+            revoked = shared.get_many([
+                revocation_key(number)
+                for number in range(self._version + 1, version + 1)
+            ])
+            if len(revoked) < version - self._version:
+                self._entries.clear()
+            else:
+                self._drop(set(revoked.values()))
+        self._version = version
+
+    def _store(self, key, token, shared):
+        self._entries[key] = (time.monotonic() + local_ttl(shared), token)
+        self._entries.move_to_end(key)
+        while len(self._entries) > settings.TOKEN_CACHE_SIZE:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        shared = get_shared_cache()
+        with self._lock:
+            if shared is not None:
+                self._sync(shared)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                cache_result('token', True)
+                return copy.deepcopy(entry[1])
+            self._entries.pop(key, None)
+        token = None if shared is None else shared.get(token_key(key))
+        cache_result('token', token is not None)
+        if token is not None:
+            with self._lock:
+                self._store(key, copy.deepcopy(token), shared)
+        return token
+
+    def set(self, key, token):
+        shared = get_shared_cache()
+        with self._lock:
+            self._store(key, copy.deepcopy(token), shared)
+        if shared is not None:
+            shared.set(token_key(key), token, local_ttl(shared))
+
+    def revoke(self, user_id, keys=None):
+        with self._lock:
+            self._drop({user_id})
+        shared = get_shared_cache()
+        if shared is None:
+            return
+        if keys is None:
+            keys = Token.objects.filter(user_id=user_id).values_list(
+                'key', flat=True
+            )
+        shared.delete_many([token_key(key) for key in keys])
+        try:
+            version = shared.incr(VERSION_KEY)
+        except ValueError:
+            shared.add(VERSION_KEY, 0, timeout=None)
+            version = shared.incr(VERSION_KEY)
+        shared.set(revocation_key(version), user_id, REVOCATION_TIMEOUT)
+
+
+token_cache = TokenCache()
+
+
+class CachingTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication, которая ходит в базу только при промахе кеша."""
+
+    def authenticate_credentials(self, key):
+        if not settings.TOKEN_CACHE_TTL:
+            return super().authenticate_credentials(key)
+        token = token_cache.get(key)
+        if token is None:
+            user, token = super().authenticate_credentials(key)
+            token_cache.set(key, token)
+        return token.user, token
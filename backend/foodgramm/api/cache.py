@@ -0,0 +1,171 @@
+import copy
+import hashlib
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, HttpResponseNotModified
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+
+from foodgramm.metrics import cache_result
+from recipe.models import Favorite, Follow, ShoppingCart
+
+RECIPES_VERSION_KEY = 'recipes:version'
+EMPTY_OVERLAY = {
+    'favorites': frozenset(),
+    'shopping_cart': frozenset(),
+    'following': frozenset(),
+}
+
+
+def get_cache():
+    return caches[settings.RECIPE_CACHE_ALIAS]
+
+
+def get_recipes_version():
+    cache = get_cache()
+    version = cache.get(RECIPES_VERSION_KEY)
+    if version is None:
+        cache.add(RECIPES_VERSION_KEY, 1, timeout=None)
+        version = cache.get(RECIPES_VERSION_KEY, 1)
+    return version
+
+
+def bump_recipes_version():
+    cache = get_cache()
+    try:
+        cache.incr(RECIPES_VERSION_KEY)
+    except ValueError:
+        cache.add(RECIPES_VERSION_KEY, 2, timeout=None)
+
+
+def response_cache_key(request):
+    query = urlencode(sorted(
+        (key, value)
+        for key, values in request.query_params.lists()
+        for value in sorted(values)
+    ))
+    return (
+        f'recipes:{get_recipes_version()}:{request.path}:'
+        f'{hashlib.md5(query.encode()).hexdigest()}'
+    )
+
+
+def make_etag(content):
+    return f'"{hashlib.md5(content).hexdigest()}"'
+
+
+def cached_json_response(content, etag, request):
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content, content_type='application/json')
+    response['ETag'] = etag
+    return response
+
+
+def viewer_overlay_key(user_id):
+    return f'viewer:{user_id}'
+
+
+def load_viewer_overlay(user):
+    return {
+        'favorites': set(Favorite.objects.filter(
+            user=user
+        ).values_list('recipe_id', flat=True)),
+        'shopping_cart': set(ShoppingCart.objects.filter(
+            user=user
+        ).values_list('recipe_id', flat=True)),
+        'following': set(Follow.objects.filter(
+            follower=user
+        ).values_list('author_id', flat=True)),
+    }
+
+
+def get_viewer_overlay(user):
+    if not user.is_authenticated:
+        return EMPTY_OVERLAY
+    if not settings.VIEWER_OVERLAY_TIMEOUT:
+        return load_viewer_overlay(user)
+    cache = get_cache()
+    key = viewer_overlay_key(user.id)
+    overlay = cache.get(key)
+    cache_result('viewer_overlay', overlay is not None)
+    if overlay is None:
+        overlay = load_viewer_overlay(user)
+        cache.set(key, overlay, settings.VIEWER_OVERLAY_TIMEOUT)
+    return overlay
+
+
+def invalidate_viewer_overlay(user_id):
+    get_cache().delete(viewer_overlay_key(user_id))
+
+
+PERSONAL_FILTERS = ('is_favorited', 'is_in_shopping_cart')
+
+
+def is_cacheable(request):
+    return not request.user.is_authenticated or not any(
+        request.query_params.get(name) not in (None, '', '0')
+        for name in PERSONAL_FILTERS
+    )
+
+
+def lookup_response(request):
+    key = response_cache_key(request)
+    cached = get_cache().get(key)
+    cache_result('recipes', cached is not None)
+    return key, cached
+
+
+def store_response(key, data, request, serializer_class):
+    neutral = copy.deepcopy(data)
+    if request.user.is_authenticated:
+        neutral = serializer_class.personalize(neutral, EMPTY_OVERLAY)
+    content = JSONRenderer().render(neutral)
+    get_cache().set(
+        key, (neutral, content, make_etag(content)),
+        settings.RECIPE_CACHE_TIMEOUT
+    )
+    if request.user.is_authenticated:
+        content = JSONRenderer().render(data)
+    return cached_json_response(content, make_etag(content), request)
+
+
+def render_cached(cached, request, overlay, serializer_class):
+    data, content, etag = cached
+    if request.user.is_authenticated:
+        data = serializer_class.personalize(data, overlay)
+        content = JSONRenderer().render(data)
+        etag = make_etag(content)
+    return cached_json_response(content, etag, request)
+
+
+class RecipeResponseCacheMixin:
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(
+            super().retrieve, request, *args, **kwargs
+        )
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        if (request.accepted_renderer.format != 'json'
+                or not is_cacheable(request)):
+            return handler(request, *args, **kwargs)
+
+        key, cached = lookup_response(request)
+        if cached is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            return store_response(
+                key, response.data, request, self.serializer_class
+            )
+        return render_cached(
+            cached, request, get_viewer_overlay(request.user),
+            self.serializer_class
+        )
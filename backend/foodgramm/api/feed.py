@@ -0,0 +1,103 @@
+import bisect
+from itertools import islice
+
+from django.conf import settings
+
+from recipe.models import Follow, Recipe
+
+from .cache import get_cache
+
+HEAVY = 'heavy'
+FANOUT_BATCH = 1000
+
+
+def timeline_key(user_id):
+    return f'feed:{user_id}'
+
+
+def followed_recipes(user):
+    return Recipe.objects.filter(
+        author__in=Follow.objects.filter(follower=user).values('author_id')
+    ).order_by('-created_at', '-id')
+
+
+def build_timeline(user):
+    follows = Follow.objects.filter(follower=user)
+    if follows[:settings.FEED_FANOUT_MAX_FOLLOWS + 1].count() > (
+            settings.FEED_FANOUT_MAX_FOLLOWS):
+        return HEAVY
+    size = settings.FEED_TIMELINE_SIZE
+    entries = list(followed_recipes(user).values_list(
+        'created_at', 'id'
+    )[:size])
+    entries.reverse()
+    return {'entries': entries, 'complete': len(entries) < size}
+
+
+def get_timeline(user):
+    cache = get_cache()
+    key = timeline_key(user.id)
+    timeline = cache.get(key)
+    if timeline is None:
+        timeline = build_timeline(user)
+        cache.set(key, timeline, settings.FEED_TIMELINE_TIMEOUT)
+    return timeline
+
+
+def timeline_page(user, cursor, limit):
+    timeline = get_timeline(user)
+    if timeline == HEAVY:
+        return None
+    entries = timeline['entries']
+    end = len(entries) if cursor is None else bisect.bisect_left(
+        entries, cursor
+    )
+    page = entries[max(0, end - limit):end][::-1]
+    if len(page) < limit and not timeline['complete']:
+        return None
+    return page
+
+
+def feed_page(user, cursor, limit, keyset_filter):
+    recipes = Recipe.objects.with_user_state(user)
+    page = timeline_page(user, cursor, limit)
+    if page is not None:
+        found = recipes.in_bulk([pk for _, pk in page])
+        return [found[pk] for _, pk in page if pk in found]
+    recipes = recipes.filter(
+        author__in=Follow.objects.filter(follower=user).values('author_id')
+    ).order_by('-created_at', '-id')
+    if cursor is not None:
+        recipes = recipes.filter(keyset_filter(cursor))
+    return list(recipes[:limit])
+
+
+def update_timelines(author_id, entry, add):
+    cache = get_cache()
+    size = settings.FEED_TIMELINE_SIZE
+    followers = Follow.objects.filter(author_id=author_id).values_list(
+        'follower_id', flat=True
+    ).iterator(chunk_size=FANOUT_BATCH)
+    while chunk := list(islice(followers, FANOUT_BATCH)):
+        changed = {}
+        timelines = cache.get_many([timeline_key(pk) for pk in chunk])
+        for key, timeline in timelines.items():
+            if timeline == HEAVY:
+                continue
+            entries = timeline['entries']
+            if add:
+                bisect.insort(entries, entry)
+                if len(entries) > size:
+                    del entries[0]
+                    timeline['complete'] = False
+            elif entry in entries:
+                entries.remove(entry)
+            else:
+                continue
+            changed[key] = timeline
+        if changed:
+            cache.set_many(changed, settings.FEED_TIMELINE_TIMEOUT)
+
+
+def invalidate_timeline(user_id):
+    get_cache().delete(timeline_key(user_id))
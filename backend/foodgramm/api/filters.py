@@ -9,6 +9,7 @@ class RecipeFilter(django_filters.FilterSet):
     )
     author = django_filters.NumberFilter(field_name='author__id')
     is_favorited = django_filters.NumberFilter(method='check_favorite')
+    search = django_filters.CharFilter(method='search_recipes')
 
     def check_favorite(self, qs, field_name, value):
         current_user = self.request.user
@@ -21,9 +22,12 @@ class RecipeFilter(django_filters.FilterSet):
             return qs.filter(shoppingcarts__user=self.request.user)
         return qs
 
+    def search_recipes(self, qs, field_name, value):
+        return qs.search(value)
+
     class Meta:
         model = Recipe
-        fields = ['author', 'is_favorited', 'is_in_shopping_cart']
+        fields = ['author', 'is_favorited', 'is_in_shopping_cart', 'search']
 
 
 class IngredientFilter(django_filters.FilterSet):
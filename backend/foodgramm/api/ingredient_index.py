@@ -0,0 +1,93 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+
+from foodgramm.metrics import cache_result
+from recipe.models import Ingredient
+
+
+class IngredientIndex:
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshot = None
+
+    def invalidate(self):
+        self._snapshot = None
+
+    def _expired(self, snapshot):
+        return snapshot is None or time.monotonic() - snapshot[0] > self.ttl
+
+    def _rows(self):
+        # values(), а не values_list(): итератор values_list() в Django 5.1
+        # выполняет запрос сразу и ломает aiterator().
+        return Ingredient.objects.values('id', 'name', 'measurement_unit')
+
+    def _build(self, rows=None):
+        keys, payloads, ids = [], [], set()
+        if rows is None:
+            rows = self._rows()
+        for row in sorted(rows, key=lambda row: row['name'].casefold()):
+            keys.append(row['name'].casefold())
+            ids.add(row['id'])
+            payloads.append(json.dumps(row, ensure_ascii=False).encode())
+        return time.monotonic(), keys, payloads, frozenset(ids)
+
+    def _get_snapshot(self):
+        snapshot = self._snapshot
+        if self._expired(snapshot):
+            with self._lock:
+                snapshot = self._snapshot
+                if self._expired(snapshot):
+                    cache_result('ingredient_index', False)
+                    snapshot = self._snapshot = self._build()
+                    return snapshot
+        cache_result('ingredient_index', True)
+        return snapshot
+
+    async def _aget_snapshot(self):
+        snapshot = self._snapshot
+        if self._expired(snapshot):
+            cache_result('ingredient_index', False)
+            rows = [row async for row in self._rows().aiterator()]
+            snapshot = self._snapshot = self._build(rows)
+            return snapshot
+        cache_result('ingredient_index', True)
+        return snapshot
+
+    def _search(self, snapshot, query, limit):
+        _, keys, payloads, _ = snapshot
+        query = query.casefold()
+        start = end = bisect_left(keys, query)
+        while end < len(keys) and keys[end].startswith(query):
+            end += 1
+        found = list(range(start, min(end, start + limit)))
+        for position, key in enumerate(keys):
+            if len(found) >= limit:
+                break
+            if query in key and not start <= position < end:
+                found.append(position)
+        return [payloads[position] for position in found]
+
+    def search(self, query, limit):
+        return self._search(self._get_snapshot(), query, limit)
+
+    def known_ids(self):
+        snapshot = self._snapshot
+        if self._expired(snapshot):
+            return frozenset()
+        return snapshot[3]
+
+    def render(self, query, limit):
+        return b'[' + b','.join(self.search(query, limit)) + b']'
+
+    async def arender(self, query, limit):
+        payloads = self._search(await self._aget_snapshot(), query, limit)
+        return b'[' + b','.join(payloads) + b']'
+
+
+ingredient_index = IngredientIndex(ttl=settings.INGREDIENT_INDEX_TTL)
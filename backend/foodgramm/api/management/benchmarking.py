@@ -0,0 +1,90 @@
+import io
+import os
+import statistics
+import time
+import tracemalloc
+
+from PIL import Image
+from django.core.management import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+# PNG 1×1 в виде data URI, как его присылает фронтенд.
+IMAGE = (
+    'data:image/png;base64,'
+    'iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8DwHwAFBQ'
+    'IAX8jx0gAAAABJRU5ErkJggg=='
+)
+
+
+def random_png(side):
+    # Шум почти не сжимается: размер файла близок к худшему случаю.
+    buffer = io.BytesIO()
+    Image.frombytes('RGB', (side, side), os.urandom(side * side * 3)).save(
+        buffer, 'PNG'
+    )
+    return buffer.getvalue()
+
+
+def percentile(values, share):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+
+def latency(timings):
+    return {
+        'p50': statistics.median(timings) * 1000,
+        'p95': percentile(timings, 0.95) * 1000,
+    }
+
+
+def timed(func, repeat):
+    """Вызывает func repeat раз.
+
+    Возвращает время каждого вызова в секундах, число запросов к БД
+    в каждом и результат последнего вызова.
+    """
+    timings, queries, result = [], [], None
+    for _ in range(repeat):
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            result = func()
+            timings.append(time.perf_counter() - started)
+        queries.append(len(context.captured_queries))
+    return timings, queries, result
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak, result
+
+
+def selected(name, only):
+    return not only or any(part in name for part in only)
+
+
+class BenchmarkCommand(BaseCommand):
+    """Общие аргументы команд benchmark_*.
+
+    repeat и sizes задают умолчания для --repeat и --sizes (None — без
+    аргумента), only добавляет --only для выбора сценариев по имени.
+    """
+
+    repeat = None
+    sizes = None
+    only = False
+
+    def add_arguments(self, parser):
+        if self.repeat is not None:
+            parser.add_argument('--repeat', type=int, default=self.repeat)
+        if self.sizes is not None:
+            parser.add_argument(
+                '--sizes', type=int, nargs='+', default=list(self.sizes)
+            )
+        if self.only:
+            parser.add_argument('--only', nargs='+', default=[])
@@ -0,0 +1,181 @@
+import itertools
+import json
+import os
+import statistics
+import tempfile
+
+from django.core.management import CommandError
+from django.db import transaction
+from django.db.models import Count
+from django.test.utils import override_settings
+from rest_framework.test import APIClient
+
+from recipe.models import Ingredient, Recipe, User
+
+from ..benchmarking import (
+    IMAGE, BenchmarkCommand, latency, peak_memory, selected, timed
+)
+
+RECIPE_FILTERS = ('author', 'is_favorited', 'is_in_shopping_cart')
+DUMMY_CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}
+}
+
+
+class Command(BenchmarkCommand):
+    help = (
+        'Измеряет задержку, число запросов и память основных эндпоинтов '
+        'на данных из generate_data'
+    )
+    repeat = 30
+    only = True
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--baseline', default='benchmark_api.json',
+            help='Файл с результатами предыдущего запуска'
+        )
+        parser.add_argument(
+            '--save', action='store_true',
+            help='Сохранить результаты как новую базовую линию'
+        )
+        parser.add_argument(
+            '--no-cache', action='store_true',
+            help='Отключить кеш ответов'
+        )
+
+    def scenarios(self):
+        viewer = User.objects.annotate(
+            carts=Count('shoppingcarts')
+        ).filter(carts__gt=0).order_by('-carts').first()
+        recipe = Recipe.objects.order_by('-id').first()
+        ingredients = list(Ingredient.objects.order_by('?')[:2])
+        if viewer is None or recipe is None or not ingredients:
+            raise CommandError('Нет данных, сначала выполните generate_data')
+        own = viewer.recipes.first() or recipe
+        ingredient_payload = [
+            {'id': ingredient.id, 'amount': 10} for ingredient in ingredients
+        ]
+
+        yield 'recipes', viewer, 'get', '/api/recipes/', {}
+        for size in range(1, len(RECIPE_FILTERS) + 1):
+            for names in itertools.combinations(RECIPE_FILTERS, size):
+                params = {
+                    name: recipe.author_id if name == 'author' else 1
+                    for name in names
+                }
+                yield (
+                    'recipes?' + '&'.join(names), viewer, 'get',
+                    '/api/recipes/', params
+                )
+        yield 'recipes (anonymous)', None, 'get', '/api/recipes/', {}
+        yield 'recipe detail', viewer, 'get', f'/api/recipes/{recipe.id}/', {}
+        yield (
+            'ingredient search', viewer, 'get', '/api/ingredients/',
+            {'name': ingredients[0].name[:3]}
+        )
+        yield (
+            'recipe match', viewer, 'get', '/api/recipes/match/',
+            {'ingredients': [ingredient.id for ingredient in ingredients]}
+        )
+        yield (
+            'similar recipes', viewer, 'get',
+            f'/api/recipes/{recipe.id}/similar/', {}
+        )
+        yield (
+            'recommended recipes', viewer, 'get',
+            '/api/recipes/recommended/', {}
+        )
+        yield (
+            'subscriptions', viewer, 'get', '/api/users/subscriptions/',
+            {'recipes_limit': 3}
+        )
+        yield (
+            'shopping list', viewer, 'get',
+            '/api/recipes/download_shopping_cart/', {}
+        )
+        yield 'recipe create', viewer, 'post', '/api/recipes/', {
+            'name': 'benchmark',
+            'text': 'benchmark',
+            'cooking_time': 10,
+            'image': IMAGE,
+            'ingredients': ingredient_payload,
+        }
+        yield (
+            'recipe update', own.author, 'patch', f'/api/recipes/{own.id}/',
+            {'name': 'benchmark', 'ingredients': ingredient_payload}
+        )
+
+    def call(self, user, method, url, data):
+        client = APIClient()
+        if user is not None:
+            client.force_authenticate(user)
+        with transaction.atomic():
+            if method == 'get':
+                response = client.get(url, data)
+            else:
+                response = getattr(client, method)(url, data, format='json')
+            if getattr(response, 'streaming', False):
+                b''.join(response.streaming_content)
+            transaction.set_rollback(True)
+        if response.status_code >= 400:
+            raise CommandError(
+                f'{method.upper()} {url}: {response.status_code}'
+            )
+
+    def measure(self, user, method, url, data, repeat):
+        def call():
+            self.call(user, method, url, data)
+
+        call()
+        timings, queries, _ = timed(call, repeat)
+        peak, _ = peak_memory(call)
+        return {
+            **latency(timings),
+            'queries': statistics.median(queries),
+            'peak_kib': peak / 1024,
+        }
+
+    def load_baseline(self, path):
+        if not os.path.exists(path):
+            return {}
+        with open(path, encoding='utf-8') as file:
+            return json.load(file)
+
+    def report(self, name, result, previous):
+        line = (
+            f'{name:<48} p50 {result["p50"]:8.2f} мс  '
+            f'p95 {result["p95"]:8.2f} мс  '
+            f'{result["queries"]:5.0f} запр.  {result["peak_kib"]:8.0f} КиБ'
+        )
+        if previous:
+            line += '  Δp50 {:+.0%}  Δзапр. {:+.0f}'.format(
+                result['p50'] / previous['p50'] - 1 if previous['p50'] else 0,
+                result['queries'] - previous['queries']
+            )
+        self.stdout.write(line)
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 2:
+            raise CommandError('--repeat должен быть не меньше 2')
+        baseline = self.load_baseline(options['baseline'])
+        overrides = {'IMAGE_WORKERS': 0, 'ALLOWED_HOSTS': ['testserver']}
+        if options['no_cache']:
+            overrides['CACHES'] = DUMMY_CACHES
+        results = {}
+        with tempfile.TemporaryDirectory() as media_root:
+            with override_settings(MEDIA_ROOT=media_root, **overrides):
+                for name, user, method, url, data in self.scenarios():
+                    if not selected(name, options['only']):
+                        continue
+                    results[name] = self.measure(
+                        user, method, url, data, options['repeat']
+                    )
+                    self.report(name, results[name], baseline.get(name))
+        if options['save']:
+            with open(options['baseline'], 'w', encoding='utf-8') as file:
+                json.dump(results, file, ensure_ascii=False, indent=2)
+            self.stdout.write(
+                f'Базовая линия сохранена в {options["baseline"]}'
+            )
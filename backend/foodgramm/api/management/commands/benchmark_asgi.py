@@ -0,0 +1,162 @@
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import local
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.management import CommandError
+from rest_framework.authtoken.models import Token
+
+from recipe.models import Ingredient, Recipe, User
+
+from ..benchmarking import BenchmarkCommand, latency, selected
+
+SERVERS = {
+    'wsgi': ('sync', 'foodgramm.wsgi:application', 'False'),
+    'asgi': (
+        'uvicorn_worker.UvicornWorker', 'foodgramm.asgi:application', 'True'
+    ),
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class Command(BenchmarkCommand):
+    help = (
+        'Сравнивает пропускную способность эндпоинтов чтения под gunicorn '
+        '(WSGI) и uvicorn (ASGI с асинхронными представлениями) при '
+        'большом числе одновременных запросов'
+    )
+    only = True
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument('--concurrency', type=int, default=200)
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument('--workers', type=int, default=2)
+        parser.add_argument(
+            '--mode', choices=tuple(SERVERS), nargs='+',
+            default=list(SERVERS)
+        )
+
+    def scenarios(self):
+        recipe = Recipe.objects.order_by('-id').first()
+        ingredient = Ingredient.objects.order_by('?').first()
+        viewer = User.objects.filter(is_active=True).order_by('id').first()
+        if recipe is None or ingredient is None or viewer is None:
+            raise CommandError('Нет данных, сначала выполните generate_data')
+        token, _ = Token.objects.get_or_create(user=viewer)
+        auth = {'Authorization': f'Token {token.key}'}
+        return (
+            ('recipes', '/api/recipes/', {}),
+            ('recipes (token)', '/api/recipes/', auth),
+            ('recipes?cursor', '/api/recipes/?cursor=&limit=6', auth),
+            ('recipe detail', f'/api/recipes/{recipe.id}/', auth),
+            ('ingredient search',
+             f'/api/ingredients/?name={quote(ingredient.name[:3])}', {}),
+            ('short link', f'/s/{recipe.id}/', {}),
+        )
+
+    def start(self, mode, port, workers):
+        worker_class, application, async_views = SERVERS[mode]
+        process = subprocess.Popen(
+            [
+                sys.executable, '-m', 'gunicorn', application,
+                '--worker-class', worker_class,
+                '--workers', str(workers),
+                '--bind', f'127.0.0.1:{port}',
+                '--log-level', 'warning',
+            ],
+            cwd=settings.BASE_DIR,
+            env=dict(
+                os.environ,
+                ASYNC_READ_VIEWS=async_views,
+                REQUEST_LOG_LEVEL='ERROR',
+            ),
+        )
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError(f'{mode}: сервер завершился при запуске')
+            try:
+                socket.create_connection(('127.0.0.1', port), 0.2).close()
+                return process
+            except OSError:
+                time.sleep(0.2)
+        process.terminate()
+        raise CommandError(f'{mode}: сервер не запустился за 30 с')
+
+    def load(self, port, path, headers, options):
+        connections = local()
+
+        def request(_):
+            connection = getattr(connections, 'value', None)
+            if connection is None:
+                connection = connections.value = http.client.HTTPConnection(
+                    '127.0.0.1', port, timeout=60
+                )
+            started = time.perf_counter()
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                response.read()
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connections.value = None
+                return None, False
+            return time.perf_counter() - started, response.status < 400
+
+        with ThreadPoolExecutor(options['concurrency']) as pool:
+            list(pool.map(request, range(options['concurrency'])))
+            started = time.perf_counter()
+            results = list(pool.map(request, range(options['requests'])))
+            elapsed = time.perf_counter() - started
+        timings = [timing for timing, ok in results if ok]
+        if not timings:
+            raise CommandError(f'{path}: все запросы завершились ошибкой')
+        return {
+            'rps': len(timings) / elapsed,
+            **latency(timings),
+            'errors': len(results) - len(timings),
+        }
+
+    def handle(self, *args, **options):
+        scenarios = [
+            scenario for scenario in self.scenarios()
+            if selected(scenario[0], options['only'])
+        ]
+        results = {}
+        for mode in options['mode']:
+            port = free_port()
+            process = self.start(mode, port, options['workers'])
+            try:
+                for name, path, headers in scenarios:
+                    results[name, mode] = self.load(
+                        port, path, headers, options
+                    )
+            finally:
+                process.terminate()
+                process.wait()
+
+        self.stdout.write(
+            f'{options["concurrency"]} одновременных запросов, '
+            f'{options["workers"]} воркера на режим'
+        )
+        for name, _, _ in scenarios:
+            for mode in options['mode']:
+                result = results[name, mode]
+                self.stdout.write(
+                    f'{name:<20} {mode}  {result["rps"]:8.1f} запр/с  '
+                    f'p50 {result["p50"]:8.2f} мс  '
+                    f'p95 {result["p95"]:8.2f} мс  '
+                    f'ошибок {result["errors"]}'
+                )
@@ -0,0 +1,62 @@
+import statistics
+import tempfile
+
+from django.db import transaction
+from django.test.utils import override_settings
+from rest_framework.test import APIRequestFactory
+
+from api.serializers import RecipeCreateUpdateSerializer
+from recipe.models import Ingredient, User
+
+from ..benchmarking import IMAGE, BenchmarkCommand, timed
+
+
+class Command(BenchmarkCommand):
+    help = 'Измеряет время создания рецепта от числа ингредиентов'
+    repeat = 20
+    sizes = (1, 10, 40, 100)
+
+    def create_recipe(self, author, ingredients):
+        request = APIRequestFactory().post('/')
+        request.user = author
+        serializer = RecipeCreateUpdateSerializer(data={
+            'name': 'benchmark',
+            'text': 'benchmark',
+            'cooking_time': 1,
+            'image': IMAGE,
+            'ingredients': [
+                {'id': ingredient.id, 'amount': 1}
+                for ingredient in ingredients
+            ]
+        }, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        serializer.save(author=author)
+
+    def measure(self, author, ingredients, repeat):
+        timings, queries, _ = timed(
+            lambda: self.create_recipe(author, ingredients), repeat
+        )
+        return statistics.median(timings), queries[-1]
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        author = User.objects.create_user(
+            username='benchmark_recipe_create',
+            email='benchmark_recipe_create@example.com',
+            password='benchmark'
+        )
+        ingredients = Ingredient.objects.bulk_create(
+            Ingredient(name=f'benchmark {idx}', measurement_unit='г')
+            for idx in range(max(options['sizes']))
+        )
+        with tempfile.TemporaryDirectory() as media_root:
+            with override_settings(MEDIA_ROOT=media_root, IMAGE_WORKERS=0):
+                for size in options['sizes']:
+                    median, queries = self.measure(
+                        author, ingredients[:size], options['repeat']
+                    )
+                    self.stdout.write(
+                        f'{size:>4} ингредиентов: {median * 1000:7.2f} мс, '
+                        f'{queries} запросов'
+                    )
+        transaction.set_rollback(True)
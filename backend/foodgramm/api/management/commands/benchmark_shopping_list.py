@@ -0,0 +1,57 @@
+import random
+import statistics
+
+from django.db import transaction
+
+from api.shopping_list import cart_lines
+from api.units import UNITS, display_amount
+from recipe.models import Ingredient, ShoppingCartIngredient, User
+
+from ..benchmarking import BenchmarkCommand, timed
+
+
+class Command(BenchmarkCommand):
+    help = 'Измеряет время сборки списка покупок для больших корзин'
+    repeat = 10
+    sizes = (100, 1000, 5000)
+
+    def fill_cart(self, size):
+        user = User.objects.create_user(
+            username=f'benchmark_shopping_list_{size}',
+            email=f'benchmark_shopping_list_{size}@example.com',
+            password='benchmark'
+        )
+        units = list(UNITS) + ['шт.', 'щепотка']
+        ingredients = Ingredient.objects.bulk_create(
+            Ingredient(
+                name=f'benchmark {size} {idx // len(units)}',
+                measurement_unit=units[idx % len(units)]
+            ) for idx in range(size)
+        )
+        ShoppingCartIngredient.objects.bulk_create(
+            ShoppingCartIngredient(
+                user=user,
+                ingredient=ingredient,
+                total=random.randint(1, 2000)
+            ) for ingredient in ingredients
+        )
+        return user
+
+    def measure(self, user, repeat):
+        timings, queries, lines = timed(
+            lambda: [display_amount(item) for item in cart_lines(user)],
+            repeat
+        )
+        return statistics.median(timings), queries[-1], len(lines)
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        for size in options['sizes']:
+            median, queries, lines = self.measure(
+                self.fill_cart(size), options['repeat']
+            )
+            self.stdout.write(
+                f'{size:>6} позиций -> {lines} строк: '
+                f'{median * 1000:7.2f} мс, {queries} запросов'
+            )
+        transaction.set_rollback(True)
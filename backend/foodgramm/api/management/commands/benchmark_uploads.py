@@ -0,0 +1,67 @@
+import base64
+import time
+
+from django.db import transaction
+from rest_framework.test import APIRequestFactory
+
+from api.serializers import AvatarSerializer, RecipeCreateUpdateSerializer
+from recipe.models import Ingredient
+
+from ..benchmarking import BenchmarkCommand, peak_memory, random_png
+
+
+def make_payload(side):
+    return 'data:image/png;base64,' + base64.b64encode(
+        random_png(side)
+    ).decode()
+
+
+class Command(BenchmarkCommand):
+    help = 'Измеряет пиковое потребление памяти при загрузке изображений'
+
+    def add_arguments(self, parser):
+        super().add_arguments(parser)
+        parser.add_argument(
+            '--sides', type=int, nargs='+', default=[500, 1000, 2000]
+        )
+
+    def measure(self, serializer):
+        started = time.perf_counter()
+        peak, valid = peak_memory(serializer.is_valid)
+        elapsed = time.perf_counter() - started
+        if not valid:
+            self.stderr.write(str(serializer.errors))
+        return peak, elapsed
+
+    def report(self, name, payload, peak, elapsed):
+        self.stdout.write(
+            f'{name:<30} payload {len(payload) / 2 ** 20:7.2f} MiB  '
+            f'peak {peak / 2 ** 20:7.2f} MiB  '
+            f'x{peak / len(payload):4.2f}  {elapsed * 1000:7.1f} ms'
+        )
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        request = APIRequestFactory().post('/')
+        ingredient = Ingredient.objects.create(
+            name='benchmark_uploads', measurement_unit='г'
+        )
+        for side in options['sides']:
+            payload = make_payload(side)
+            self.report(
+                f'AvatarSerializer {side}px', payload, *self.measure(
+                    AvatarSerializer(data={'avatar': payload})
+                )
+            )
+            self.report(
+                f'RecipeCreateUpdate {side}px', payload, *self.measure(
+                    RecipeCreateUpdateSerializer(data={
+                        'name': 'benchmark',
+                        'text': 'benchmark',
+                        'cooking_time': 1,
+                        'image': payload,
+                        'ingredients': [{'id': ingredient.id, 'amount': 1}]
+                    }, context={'request': request})
+                )
+            )
+        transaction.set_rollback(True)
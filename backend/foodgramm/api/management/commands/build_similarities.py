@@ -0,0 +1,158 @@
+from itertools import chain
+
+import numpy as np
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import transaction
+from scipy import sparse
+
+from recipe.models import (
+    Favorite,
+    IngredientsInRecipe,
+    Recipe,
+    RecipeSimilarity,
+    ShoppingCart
+)
+
+from ...recommendations import invalidate_similar
+
+INTERACTIONS = ((Favorite, 1.0), (ShoppingCart, 0.5))
+
+
+def columns(queryset, *fields):
+    rows = queryset.order_by().values_list(*fields)
+    return np.fromiter(
+        chain.from_iterable(rows.iterator(chunk_size=10000)), dtype=np.int64
+    ).reshape(-1, len(fields)).T
+
+
+def recipe_rows(recipe_ids, values):
+    # Рецепты, созданные или удалённые во время сборки, пропускаются.
+    rows = np.minimum(
+        np.searchsorted(recipe_ids, values), len(recipe_ids) - 1
+    )
+    return rows, recipe_ids[rows] == values
+
+
+def normalized(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return sparse.csr_matrix(sparse.diags(1 / norms) @ matrix)
+
+
+def interaction_matrix(recipe_ids):
+    """Рецепты x пользователи: вес избранного плюс вес корзины."""
+    users, recipes, weights = [], [], []
+    for model, weight in INTERACTIONS:
+        user_ids, recipe_column = columns(
+            model.objects, 'user_id', 'recipe_id'
+        )
+        users.append(user_ids)
+        recipes.append(recipe_column)
+        weights.append(np.full(len(user_ids), weight))
+    rows, known = recipe_rows(recipe_ids, np.concatenate(recipes))
+    user_ids, cols = np.unique(
+        np.concatenate(users)[known], return_inverse=True
+    )
+    return sparse.csr_matrix(
+        (np.concatenate(weights)[known], (rows[known], cols)),
+        shape=(len(recipe_ids), len(user_ids))
+    )
+
+
+def ingredient_matrix(recipe_ids, max_share):
+    """Рецепты x ингредиенты с весами IDF."""
+    recipes, ingredients = columns(
+        IngredientsInRecipe.objects, 'recipe_id', 'ingredient_id'
+    )
+    rows, known = recipe_rows(recipe_ids, recipes)
+    ingredient_ids, cols = np.unique(ingredients[known], return_inverse=True)
+    counts = np.bincount(cols, minlength=len(ingredient_ids))
+    idf = np.log(len(recipe_ids) / np.maximum(counts, 1))
+    # Ингредиенты почти из каждого рецепта (соль, вода) не отличают
+    # рецепты друг от друга, но раздувают произведение матриц.
+    idf[counts > max_share * len(recipe_ids)] = 0
+    matrix = sparse.csr_matrix(
+        (idf[cols], (rows[known], cols)),
+        shape=(len(recipe_ids), len(ingredient_ids))
+    )
+    matrix.eliminate_zeros()
+    return matrix
+
+
+def top_neighbours(scores, rows, count):
+    for position, row in enumerate(rows):
+        start, end = scores.indptr[position], scores.indptr[position + 1]
+        cols, values = scores.indices[start:end], scores.data[start:end]
+        keep = (cols != row) & (values > 0)
+        cols, values = cols[keep], values[keep]
+        if len(values) > count:
+            top = np.argpartition(-values, count - 1)[:count]
+            cols, values = cols[top], values[top]
+        yield row, cols, values
+
+
+class Command(BaseCommand):
+    help = (
+        'Строит таблицу похожих рецептов: косинусная близость по '
+        'совместному добавлению в избранное и корзину, смешанная с '
+        'близостью состава'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--max-ingredient-share', type=float, default=0.1)
+        parser.add_argument(
+            '--missing', action='store_true',
+            help='Только рецепты, для которых соседи ещё не посчитаны'
+        )
+
+    def handle(self, *args, **options):
+        recipe_ids, = columns(Recipe.objects, 'id')
+        if not len(recipe_ids):
+            self.stdout.write('RecipeSimilarity: нет рецептов')
+            return
+        recipe_ids.sort()
+        interactions = normalized(interaction_matrix(recipe_ids))
+        composition = normalized(ingredient_matrix(
+            recipe_ids, options['max_ingredient_share']
+        ))
+        weight = settings.RECOMMENDATION_COOCCURRENCE_WEIGHT
+        rows = np.arange(len(recipe_ids))
+        if options['missing']:
+            done, = columns(
+                RecipeSimilarity.objects.values('recipe_id').distinct(),
+                'recipe_id'
+            )
+            rows = rows[~np.isin(recipe_ids, done)]
+
+        written = 0
+        for start in range(0, len(rows), options['batch_size']):
+            batch = rows[start:start + options['batch_size']]
+            scores = sparse.csr_matrix(
+                weight * (interactions[batch] @ interactions.T)
+                + (1 - weight) * (composition[batch] @ composition.T)
+            )
+            batch_ids = recipe_ids[batch].tolist()
+            with transaction.atomic():
+                RecipeSimilarity.objects.filter(
+                    recipe_id__in=batch_ids
+                ).delete()
+                written += len(RecipeSimilarity.objects.bulk_create(
+                    (
+                        RecipeSimilarity(
+                            recipe_id=int(recipe_ids[row]),
+                            similar_id=int(recipe_ids[col]),
+                            score=float(value)
+                        )
+                        for row, cols, values in top_neighbours(
+                            scores, batch, settings.RECOMMENDATION_LIMIT
+                        )
+                        for col, value in zip(cols, values)
+                    ),
+                    batch_size=5000
+                ))
+            invalidate_similar(batch_ids)
+        self.stdout.write(
+            f'RecipeSimilarity: рецептов {len(rows)}, записано {written}'
+        )
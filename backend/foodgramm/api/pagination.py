@@ -1,6 +1,204 @@
+import base64
+import json
+from collections import OrderedDict
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class PaginationLimiter(PageNumberPagination):
     page_size_query_param = 'limit'
     page_size = 6
+    cursor_query_param = 'cursor'
+    estimate_count = True
+    invalid_cursor_message = 'Неверный курсор'
+    annotations = {}
+
+    def paginate_queryset(self, queryset, request, view=None):
+        get_ordering = getattr(view, 'get_keyset_ordering', None)
+        self.keyset_ordering = (
+            get_ordering(request) if get_ordering is not None
+            else getattr(view, 'keyset_ordering', None)
+        )
+        self.use_cursor = (
+            self.keyset_ordering is not None
+            and self.cursor_query_param in request.query_params
+        )
+        if not self.use_cursor:
+            return super().paginate_queryset(queryset, request, view)
+
+        count = estimate_count(queryset) if self.estimate_count else None
+        queryset = queryset.order_by(*self.keyset_ordering)
+        self.annotations = queryset.query.annotations
+
+        def fetch(values, limit):
+            if values is None:
+                return list(queryset[:limit])
+            return list(queryset.filter(self.keyset_filter(values))[:limit])
+
+        return self.paginate_keyset(
+            request, queryset.model, self.keyset_ordering, fetch, count
+        )
+
+    def paginate_keyset(self, request, model, ordering, fetch, count=None):
+        return self.finish_keyset(fetch(
+            *self.start_keyset(request, model, ordering, count)
+        ))
+
+    async def apaginate_queryset(self, queryset, request, keyset_ordering):
+        self.keyset_ordering = keyset_ordering
+        self.use_cursor = self.cursor_query_param in request.query_params
+        if self.use_cursor:
+            count = (
+                await sync_to_async(estimate_count)(queryset)
+                if self.estimate_count else None
+            )
+            queryset = queryset.order_by(*keyset_ordering)
+            self.annotations = queryset.query.annotations
+            values, limit = self.start_keyset(
+                request, queryset.model, keyset_ordering, count
+            )
+            if values is not None:
+                queryset = queryset.filter(self.keyset_filter(values))
+            return self.finish_keyset([
+                item async for item in queryset[:limit].aiterator(
+                    chunk_size=limit
+                )
+            ])
+
+        self.request = request
+        page_size = self.get_page_size(request)
+        paginator = self.django_paginator_class(
+            CountedQuerySet(queryset, await queryset.acount()), page_size
+        )
+        page_number = self.get_page_number(request, paginator)
+        try:
+            self.page = paginator.page(page_number)
+        except InvalidPage as error:
+            raise NotFound(self.invalid_page_message.format(
+                page_number=page_number, message=str(error)
+            ))
+        self.page.object_list = [
+            item async for item in self.page.object_list.aiterator(
+                chunk_size=page_size
+            )
+        ]
+        return list(self.page)
+
+    def start_keyset(self, request, model, ordering, count):
+        self.use_cursor = True
+        self.keyset_ordering = ordering
+        self.estimated_count = count
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        values = (
+            self.cursor_values(model, self.decode_cursor(cursor))
+            if cursor else None
+        )
+        return values, self.page_size + 1
+
+    def finish_keyset(self, page):
+        self.has_next = len(page) > self.page_size
+        self.keyset_page = page[:self.page_size]
+        return self.keyset_page
+
+    def get_paginated_response(self, data):
+        if not self.use_cursor:
+            return super().get_paginated_response(data)
+        return Response(OrderedDict([
+            ('count', self.estimated_count),
+            ('next', self.get_next_link()),
+            ('results', data),
+        ]))
+
+    def get_next_link(self):
+        if not self.use_cursor:
+            return super().get_next_link()
+        if not self.has_next:
+            return None
+        last = self.keyset_page[-1]
+        cursor = self.encode_cursor([
+            getattr(last, field.lstrip('-')) for field in self.keyset_ordering
+        ])
+        return replace_query_param(
+            self.request.build_absolute_uri(),
+            self.cursor_query_param,
+            cursor
+        )
+
+    def get_previous_link(self):
+        if not self.use_cursor:
+            return super().get_previous_link()
+        return None
+
+    def encode_cursor(self, values):
+        payload = json.dumps(values, default=str).encode()
+        return base64.urlsafe_b64encode(payload).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if (not isinstance(values, list)
+                or len(values) != len(self.keyset_ordering)):
+            raise NotFound(self.invalid_cursor_message)
+        return values
+
+    def cursor_values(self, model, values):
+        parsed = []
+        for ordering, value in zip(self.keyset_ordering, values):
+            name = ordering.lstrip('-')
+            annotation = self.annotations.get(name)
+            field = (
+                model._meta.get_field(name) if annotation is None
+                else annotation.output_field
+            )
+            try:
+                value = field.to_python(value)
+            except ValidationError:
+                raise NotFound(self.invalid_cursor_message)
+            if isinstance(value, datetime) and timezone.is_naive(value):
+                raise NotFound(self.invalid_cursor_message)
+            parsed.append(value)
+        return tuple(parsed)
+
+    def keyset_filter(self, values):
+        condition = Q()
+        equal = {}
+        for ordering, value in zip(self.keyset_ordering, values):
+            name = ordering.lstrip('-')
+            lookup = 'lt' if ordering.startswith('-') else 'gt'
+            condition |= Q(**equal, **{f'{name}__{lookup}': value})
+            equal[name] = value
+        return condition
+
+
+class CountedQuerySet:
+
+    def __init__(self, queryset, count):
+        self.queryset = queryset
+        self.total = count
+
+    def count(self):
+        return self.total
+
+    def __getitem__(self, key):
+        return self.queryset[key]
+
+
+def estimate_count(queryset):
+    if connection.vendor != 'postgresql':
+        return None
+    plan = json.loads(queryset.order_by().explain(format='json'))
+    return plan[0]['Plan']['Plan Rows']
@@ -1,3 +1,6 @@
+import hmac
+
+from django.conf import settings
 from rest_framework.permissions import BasePermission, SAFE_METHODS
 
 
@@ -5,3 +8,16 @@ class IsAuthorOrReadOnly(BasePermission):
 
     def has_object_permission(self, request, view, obj):
         return request.method in SAFE_METHODS or obj.author == request.user
+
+
+class HasMetricsToken(BasePermission):
+
+    def has_permission(self, request, view):
+        # Без настроенного токена метрики закрыты: они раскрывают маршруты
+        # и нагрузку сервиса.
+        if not settings.METRICS_TOKEN:
+            return False
+        return hmac.compare_digest(
+            request.headers.get('Authorization', ''),
+            f'Bearer {settings.METRICS_TOKEN}'
+        )
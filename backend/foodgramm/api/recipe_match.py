@@ -0,0 +1,190 @@
+import threading
+from collections import defaultdict
+from itertools import chain
+
+import numpy as np
+from django.conf import settings
+
+from foodgramm.metrics import cache_result
+from recipe.models import IngredientsInRecipe
+
+from .cache import get_cache
+
+VERSION_KEY = 'recipe_match:version'
+CHANGE_TIMEOUT = 24 * 3600
+
+
+def change_key(version):
+    return f'recipe_match:change:{version}'
+
+
+def recipe_ingredients(recipe_ids):
+    found = defaultdict(set)
+    for recipe_id, ingredient_id in IngredientsInRecipe.objects.filter(
+        recipe_id__in=recipe_ids
+    ).values_list('recipe_id', 'ingredient_id'):
+        found[recipe_id].add(ingredient_id)
+    return {pk: frozenset(found[pk]) for pk in recipe_ids}
+
+
+class Snapshot:
+    """Прямой и обратный индексы состава рецептов в массивах NumPy.
+
+    Строки рецептов упорядочены по id. Для строки ``row`` её ингредиенты
+    лежат в ``ingredients[indptr[row]:indptr[row + 1]]``, а строки рецептов
+    с ингредиентом ``ingredient_ids[i]`` лежат в
+    ``postings[starts[i]:starts[i + 1]]``. Оба списка отсортированы.
+    """
+
+    def __init__(self, pairs):
+        recipes, ingredients = pairs
+        self.recipe_ids, rows = np.unique(recipes, return_inverse=True)
+        self.sizes = np.bincount(rows, minlength=len(self.recipe_ids))
+        self.indptr = np.concatenate(([0], np.cumsum(self.sizes)))
+        self.ingredients = ingredients
+        order = np.argsort(ingredients, kind='stable')
+        self.ingredient_ids, counts = np.unique(
+            ingredients[order], return_counts=True
+        )
+        self.starts = np.concatenate(([0], np.cumsum(counts)))
+        self.postings = rows[order]
+
+    @classmethod
+    def build(cls):
+        rows = IngredientsInRecipe.objects.order_by(
+            'recipe_id', 'ingredient_id'
+        ).values_list('recipe_id', 'ingredient_id')
+        pairs = np.fromiter(
+            chain.from_iterable(rows.iterator(chunk_size=10000)),
+            dtype=np.int64
+        )
+        return cls(pairs.reshape(-1, 2).T)
+
+    @staticmethod
+    def positions(keys, ids):
+        if not len(keys):
+            return np.array([], dtype=np.int64)
+        positions = np.minimum(np.searchsorted(keys, ids), len(keys) - 1)
+        return positions[keys[positions] == ids]
+
+    def matched(self, query):
+        hits = [
+            self.postings[self.starts[pos]:self.starts[pos + 1]]
+            for pos in self.positions(self.ingredient_ids, query)
+        ]
+        if not hits:
+            return np.zeros(len(self.recipe_ids), dtype=np.int64)
+        return np.bincount(
+            np.concatenate(hits), minlength=len(self.recipe_ids)
+        )
+
+    def recipe_ingredients(self, row):
+        return self.ingredients[self.indptr[row]:self.indptr[row + 1]]
+
+
+class RecipeMatchIndex:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._version = None
+        self._overrides = {}
+
+    def invalidate(self):
+        self._snapshot = None
+
+    def _rebuild(self, version):
+        self._snapshot = Snapshot.build()
+        self._overrides = {}
+        self._version = version
+
+    def _refresh(self):
+        cache = get_cache()
+        version = cache.get(VERSION_KEY, 0)
+        if self._snapshot is None or version < self._version:
+            cache_result('recipe_match', False)
+            self._rebuild(version)
+            return
+        cache_result('recipe_match', True)
+        if version == self._version:
+            return
+        changes = cache.get_many([
+            change_key(number)
+            for number in range(self._version + 1, version + 1)
+        ])
+        if (len(changes) < version - self._version
+                or len(self._overrides) + len(changes)
+                > settings.RECIPE_MATCH_MAX_CHANGES):
+            self._rebuild(version)
+            return
+        self._overrides.update(recipe_ingredients(set(changes.values())))
+        self._version = version
+
+    def _state(self):
+        with self._lock:
+            self._refresh()
+            return self._snapshot, self._overrides
+
+    def match(self, ingredient_ids, limit):
+        """Рецепты по убыванию доли имеющихся ингредиентов.
+
+        Возвращает список ``(recipe_id, coverage, missing_ids)``.
+        """
+        snapshot, overrides = self._state()
+        have = frozenset(ingredient_ids)
+        query = np.array(sorted(have), dtype=np.int64)
+
+        counts = snapshot.matched(query)
+        counts[snapshot.positions(
+            snapshot.recipe_ids, np.array(list(overrides), dtype=np.int64)
+        )] = 0
+        rows = np.flatnonzero(counts)
+        coverage = counts[rows] / snapshot.sizes[rows]
+        if len(rows) > limit:
+            # Полная сортировка нужна только претендентам на первые места.
+            threshold = np.partition(coverage, -limit)[-limit]
+            rows = rows[coverage >= threshold]
+            coverage = coverage[coverage >= threshold]
+        top = np.lexsort((
+            -snapshot.recipe_ids[rows], -counts[rows], -coverage
+        ))[:limit]
+
+        found = [
+            (
+                int(snapshot.recipe_ids[rows[idx]]),
+                float(coverage[idx]),
+                int(counts[rows[idx]]),
+                np.setdiff1d(
+                    snapshot.recipe_ingredients(rows[idx]), query,
+                    assume_unique=True
+                ).tolist()
+            )
+            for idx in top
+        ]
+        for recipe_id, ingredients in overrides.items():
+            matched = len(ingredients & have)
+            if matched:
+                found.append((
+                    recipe_id, matched / len(ingredients), matched,
+                    sorted(ingredients - have)
+                ))
+        found.sort(key=lambda item: (-item[1], -item[2], -item[0]))
+        return [
+            (recipe_id, coverage, missing)
+            for recipe_id, coverage, _, missing in found[:limit]
+        ]
+
+
+def publish_change(recipe_id):
+    # Номер изменения в общем кеше позволяет остальным процессам
+    # дочитать журнал вместо полной перестройки индекса.
+    cache = get_cache()
+    try:
+        version = cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, 0, timeout=None)
+        version = cache.incr(VERSION_KEY)
+    cache.set(change_key(version), recipe_id, CHANGE_TIMEOUT)
+
+
+recipe_match_index = RecipeMatchIndex()
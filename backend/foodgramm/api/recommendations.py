@@ -0,0 +1,97 @@
+from django.conf import settings
+from django.db.models import Sum
+
+from foodgramm.metrics import cache_result
+from recipe.models import Recipe, RecipeSimilarity
+
+from .cache import get_cache, get_viewer_overlay
+
+
+def similar_key(recipe_id):
+    return f'similar:{recipe_id}'
+
+
+def recommended_key(user_id):
+    return f'recommended:{user_id}'
+
+
+def cached_ids(name, key, build):
+    cache = get_cache()
+    ids = cache.get(key)
+    cache_result(name, ids is not None)
+    if ids is None:
+        ids = build()
+        cache.set(key, ids, settings.RECOMMENDATION_CACHE_TIMEOUT)
+    return ids
+
+
+def similar_recipe_ids(recipe_id):
+    return cached_ids(
+        'similar_recipes', similar_key(recipe_id),
+        lambda: list(RecipeSimilarity.objects.filter(
+            recipe_id=recipe_id
+        ).order_by('-score', 'similar_id').values_list(
+            'similar_id', flat=True
+        )[:settings.RECOMMENDATION_LIMIT])
+    )
+
+
+def build_recommendations(user):
+    # Вызывается только на промахе кеша recommended_recipe_ids. Избранное,
+    # корзина и подписки читаются из таблиц связей (или из набора зрителя в
+    # кеше, если задан VIEWER_OVERLAY_TIMEOUT), соседи - из таблицы сходства,
+    # которую заранее строит build_similarities.
+    overlay = get_viewer_overlay(user)
+    seen = overlay['favorites'] | overlay['shopping_cart']
+    seeds = sorted(seen, reverse=True)[:settings.RECOMMENDATION_MAX_SEEDS]
+    limit = settings.RECOMMENDATION_LIMIT
+    scores = dict(
+        RecipeSimilarity.objects.filter(recipe_id__in=seeds).exclude(
+            similar_id__in=seen
+        ).values('similar_id').annotate(total=Sum('score')).order_by(
+            '-total', 'similar_id'
+        ).values_list('similar_id', 'total')[:2 * limit]
+    )
+    top = max(scores.values(), default=1)
+    recipes = Recipe.objects.exclude(id__in=seen).exclude(author=user)
+    followed = []
+    if overlay['following']:
+        followed = list(recipes.filter(
+            author__in=overlay['following']
+        ).order_by('-created_at', '-id').values_list('id', flat=True)[:limit])
+    authors = dict(recipes.filter(id__in=[*scores, *followed]).values_list(
+        'id', 'author_id'
+    ))
+    boost = settings.RECOMMENDATION_FOLLOW_BOOST
+
+    def score(pk):
+        return scores.get(pk, 0) / top + boost * (
+            authors[pk] in overlay['following']
+        )
+
+    ranked = sorted(authors, key=lambda pk: (-score(pk), -pk))[:limit]
+    if len(ranked) < limit:
+        # Без истории действий рекомендации дополняются популярными.
+        ranked.extend(
+            pk for pk in recipes.exclude(id__in=ranked).order_by(
+                '-favorites_count', '-id'
+            ).values_list('id', flat=True)[:limit - len(ranked)]
+        )
+    return ranked
+
+
+def recommended_recipe_ids(user):
+    # Кеш на пользователя сбрасывают сигналы избранного, корзины и подписок
+    # (api/signals.py).
+    return cached_ids(
+        'recommended_recipes', recommended_key(user.id),
+        lambda: build_recommendations(user)
+    )
+
+
+def invalidate_similar(recipe_ids):
+    get_cache().delete_many([similar_key(pk) for pk in recipe_ids])
+
+
+def invalidate_recommendations(user_id):
+    get_cache().delete(recommended_key(user_id))
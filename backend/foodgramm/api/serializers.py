@@ -1,9 +1,19 @@
 import base64
-from django.core.files.base import ContentFile
+import binascii
+import os
+import tempfile
+
+from PIL import Image
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.files import File
 from django.core.validators import MinValueValidator
+from django.db import IntegrityError, transaction
 from rest_framework import serializers
 from djoser.serializers import UserSerializer as BaseUserSerializer
+from foodgramm.instrumentation import timed
+from foodgramm.metrics import IMAGE_UPLOAD_BYTES
+from recipe.images import rendition_url
 from recipe.models import (
     Ingredient,
     IngredientsInRecipe,
@@ -11,25 +21,70 @@ from recipe.models import (
     User,
     Follow,
     Favorite,
-    ShoppingCart
+    ShoppingCart,
+    ShoppingCartIngredient,
+    shifted
 )
+from .ingredient_index import ingredient_index
+from .pagination import PaginationLimiter
 
 UserModel = get_user_model()
 
 
+class TimedSerializerMixin:
+
+    def to_representation(self, instance):
+        with timed('serializer'):
+            return super().to_representation(instance)
+
+
+class IngredientsInRecipeListSerializer(serializers.ListSerializer):
+    default_error_messages = {
+        'duplicate': 'Ингредиенты не должны повторяться',
+        'does_not_exist': 'Ингредиент с id={pk} не найден',
+    }
+
+    def to_internal_value(self, data):
+        # Снимок ingredient_index - только быстрый путь: ингредиент, удалённый
+        # в другом процессе, поймает внешний ключ при сохранении рецепта.
+        attrs = super().to_internal_value(data)
+        ids = {item['ingredient_id'] for item in attrs}
+        missing = ids - ingredient_index.known_ids()
+        if missing:
+            missing -= Ingredient.objects.in_bulk(missing).keys()
+        errors = self.item_errors(attrs, missing)
+        if any(errors):
+            raise serializers.ValidationError(errors)
+        return attrs
+
+    def item_errors(self, attrs, missing):
+        errors, seen_ids = [], set()
+        for item in attrs:
+            pk = item['ingredient_id']
+            if pk in missing:
+                errors.append({'id': [self.error_messages[
+                    'does_not_exist'
+                ].format(pk=pk)]})
+            elif pk in seen_ids:
+                errors.append({'id': [self.error_messages['duplicate']]})
+            else:
+                errors.append({})
+            seen_ids.add(pk)
+        return errors
+
+
 class IngredientsInRecipeCreateSerializer(serializers.ModelSerializer):
-    id = serializers.PrimaryKeyRelatedField(
-        queryset=Ingredient.objects.all(),
-        source='ingredient'
-    )
+    id = serializers.IntegerField(source='ingredient_id')
     amount = serializers.IntegerField(min_value=1)
 
     class Meta:
         model = IngredientsInRecipe
         fields = ('id', 'amount')
+        list_serializer_class = IngredientsInRecipeListSerializer
 
 
-class IngredientSerializer(serializers.ModelSerializer):
+class IngredientSerializer(TimedSerializerMixin,
+                           serializers.ModelSerializer):
     class Meta:
         model = Ingredient
         fields = ('id', 'name', 'measurement_unit')
@@ -51,23 +106,45 @@ class IngredientsInRecipeSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'name', 'measurement_unit', 'amount')
 
 
-class UserSerializer(BaseUserSerializer):
+class RenditionField(serializers.ReadOnlyField):
+
+    def __init__(self, image_field, rendition, **kwargs):
+        self.image_field = image_field
+        self.rendition = rendition
+        super().__init__(source='*', **kwargs)
+
+    def to_representation(self, obj):
+        url = rendition_url(
+            getattr(obj, self.image_field),
+            getattr(obj, f'{self.image_field}_renditions'),
+            self.rendition
+        )
+        request = self.context.get('request')
+        if url and request is not None:
+            return request.build_absolute_uri(url)
+        return url
+
+
+class UserSerializer(TimedSerializerMixin, BaseUserSerializer):
     is_subscribed = serializers.SerializerMethodField()
+    avatar_thumbnail = RenditionField('avatar', 'thumbnail')
 
     class Meta:
         model = User
         fields = ('email', 'id', 'username', 'first_name',
-                  'last_name', 'is_subscribed', 'avatar'
+                  'last_name', 'is_subscribed', 'avatar', 'avatar_thumbnail'
                   )
 
     def get_is_subscribed(self, obj):
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
         current_user = self.context.get('request').user
         return current_user.is_authenticated and Follow.objects.filter(
             follower=current_user, author=obj
         ).exists()
 
 
-class RecipeSerializer(serializers.ModelSerializer):
+class RecipeSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     author = UserSerializer(read_only=True)
     ingredients = IngredientsInRecipeSerializer(
         source='ingredients_in_recipe',
@@ -76,23 +153,48 @@ class RecipeSerializer(serializers.ModelSerializer):
     )
     is_favorited = serializers.SerializerMethodField()
     is_in_shopping_cart = serializers.SerializerMethodField()
+    image_thumbnail = RenditionField('image', 'thumbnail')
+    image_card = RenditionField('image', 'card')
 
     class Meta:
         model = Recipe
         fields = (
             'id', 'author', 'ingredients',
             'is_favorited', 'is_in_shopping_cart',
-            'name', 'image', 'text', 'cooking_time'
+            'name', 'image', 'image_thumbnail', 'image_card',
+            'text', 'cooking_time'
         )
         read_only_fields = fields
 
+    @staticmethod
+    def personalize(data, overlay):
+        recipes = data['results'] if 'results' in data else [data]
+        for recipe in recipes:
+            recipe['is_favorited'] = recipe['id'] in overlay['favorites']
+            recipe['is_in_shopping_cart'] = (
+                recipe['id'] in overlay['shopping_cart']
+            )
+            recipe['author']['is_subscribed'] = (
+                recipe['author']['id'] in overlay['following']
+            )
+        return data
+
+    def to_representation(self, instance):
+        if hasattr(instance, 'author_is_subscribed'):
+            instance.author.is_subscribed = instance.author_is_subscribed
+        return super().to_representation(instance)
+
     def get_is_favorited(self, obj):
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
         user = self.context['request'].user
         return user.is_authenticated and Favorite.objects.filter(
             user=user, recipe=obj
         ).exists()
 
     def get_is_in_shopping_cart(self, obj):
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
         user = self.context['request'].user
         return user.is_authenticated and ShoppingCart.objects.filter(
             user=user,
@@ -101,12 +203,84 @@ class RecipeSerializer(serializers.ModelSerializer):
 
 
 class Base64ImageField(serializers.ImageField):
+    default_error_messages = {
+        'too_large': 'Размер изображения не должен превышать {max_size} байт',
+        'too_many_pixels': (
+            'Разрешение изображения не должно превышать {max_pixels} пикселей'
+        ),
+        'invalid_base64': 'Некорректные данные изображения',
+    }
+    header_size = 64 * 1024
+    chunk_size = 256 * 1024
+    whitespace = ' \t\r\n'
+
     def to_internal_value(self, data):
-        if isinstance(data, str) and data.startswith('data:image'):
-            format, imgstr = data.split(';base64,')
-            ext = format.split('/')[-1]
-            data = ContentFile(base64.b64decode(imgstr), name=f'temp.{ext}')
-        return super().to_internal_value(data)
+        if not (isinstance(data, str) and data.startswith('data:image')):
+            return super().to_internal_value(data)
+        header_end = data.find(';base64,')
+        if header_end == -1:
+            self.fail('invalid_base64')
+        ext = data[:header_end].split('/')[-1]
+        start = header_end + len(';base64,')
+        max_size = settings.IMAGE_UPLOAD_MAX_SIZE
+        encoded = len(data) - start - sum(
+            data.count(char, start) for char in self.whitespace
+        )
+        if encoded // 4 * 3 - data.rstrip()[-2:].count('=') > max_size:
+            self.fail('too_large', max_size=max_size)
+
+        spooled = tempfile.SpooledTemporaryFile(
+            max_size=settings.IMAGE_UPLOAD_MEMORY_SIZE
+        )
+        try:
+            header_end = start + self.header_size // 3 * 4
+            tail = self.write_decoded(spooled, data[start:header_end])
+            self.check_dimensions(spooled, required=False)
+            chunk_chars = self.chunk_size // 3 * 4
+            for offset in range(header_end, len(data), chunk_chars):
+                tail = self.write_decoded(
+                    spooled, tail + data[offset:offset + chunk_chars]
+                )
+            self.write_decoded(spooled, tail, final=True)
+            self.check_dimensions(spooled, required=True)
+        except serializers.ValidationError:
+            spooled.close()
+            raise
+        IMAGE_UPLOAD_BYTES.labels(self.field_name).observe(spooled.tell())
+        spooled.seek(0)
+        return serializers.FileField.to_internal_value(
+            self, File(spooled, name=f'temp.{ext}')
+        )
+
+    def write_decoded(self, spooled, chunk, final=False):
+        # Base64 бывает разбит на строки (по 76 символов в MIME): пробелы
+        # убираются, а хвост до кратного 4 переходит в следующий кусок.
+        chunk = ''.join(chunk.split())
+        end = len(chunk) if final else len(chunk) // 4 * 4
+        try:
+            spooled.write(base64.b64decode(chunk[:end], validate=True))
+        except (binascii.Error, ValueError):
+            self.fail('invalid_base64')
+        return chunk[end:]
+
+    def check_dimensions(self, spooled, required):
+        spooled.seek(0)
+        try:
+            with Image.open(spooled) as image:
+                width, height = image.size
+                if required:
+                    image.verify()
+        except Image.DecompressionBombError:
+            width = height = None
+        except (OSError, SyntaxError, ValueError):
+            if required:
+                self.fail('invalid_image')
+            return
+        finally:
+            spooled.seek(0, os.SEEK_END)
+        max_pixels = settings.IMAGE_MAX_PIXELS
+        if width is None or width * height > max_pixels:
+            self.fail('too_many_pixels', max_pixels=max_pixels)
 
 
 class RecipeCreateUpdateSerializer(RecipeSerializer):
@@ -136,11 +310,50 @@ class RecipeCreateUpdateSerializer(RecipeSerializer):
         IngredientsInRecipe.objects.bulk_create(
             IngredientsInRecipe(
                 recipe=recipe,
-                ingredient=item['ingredient'],
+                ingredient_id=item['ingredient_id'],
                 amount=item.get('amount', 1)
             ) for item in ingredients_data
         )
 
+    def update_ingredients(self, recipe, ingredients_data):
+        existing = {
+            item.ingredient_id: item
+            for item in recipe.ingredients_in_recipe.all()
+        }
+        incoming = {
+            item['ingredient_id']: item['amount'] for item in ingredients_data
+        }
+        # bulk_create и bulk_update не шлют сигналов, поэтому их изменения
+        # итогов корзин и счётчиков считаются здесь; удалённые строки
+        # списывают приёмники post_delete (recipe/signals.py).
+        changed, deltas = [], {}
+        for ingredient_id, item in existing.items():
+            amount = incoming.get(ingredient_id)
+            if amount and amount != item.amount:
+                deltas[ingredient_id] = amount - item.amount
+                item.amount = amount
+                changed.append(item)
+        IngredientsInRecipe.objects.bulk_update(changed, ['amount'])
+
+        added = incoming.keys() - existing.keys()
+        self.process_ingredients(recipe, (
+            item for item in ingredients_data
+            if item['ingredient_id'] in added
+        ))
+
+        removed = existing.keys() - incoming.keys()
+        if removed:
+            recipe.ingredients_in_recipe.filter(
+                ingredient_id__in=removed
+            ).delete()
+        self.change_ingredient_counters(added, 1)
+
+        deltas.update((pk, incoming[pk]) for pk in added)
+        ShoppingCartIngredient.objects.apply_deltas(
+            list(recipe.shoppingcarts.values_list('user_id', flat=True)),
+            deltas
+        )
+
     def validate(self, data):
         ingredients = data.get('ingredients_in_recipe', [])
         if not ingredients:
@@ -148,56 +361,130 @@ class RecipeCreateUpdateSerializer(RecipeSerializer):
                 {"ingredients": "Необходимо указать ингредиенты"}
             )
 
-        seen_ids = set()
-        for item in ingredients:
-            ing_id = item['ingredient'].id
-            if ing_id in seen_ids:
-                raise serializers.ValidationError(
-                    {"ingredients": "Ингредиенты не должны повторяться"}
-                )
-            seen_ids.add(ing_id)
         return data
 
+    @staticmethod
+    def change_ingredient_counters(ingredient_ids, delta):
+        if ingredient_ids:
+            Ingredient.objects.filter(pk__in=ingredient_ids).update(
+                recipes_count=shifted('recipes_count', delta)
+            )
+
+    def save(self, **kwargs):
+        try:
+            return super().save(**kwargs)
+        except IntegrityError:
+            items = self.validated_data['ingredients_in_recipe']
+            ids = {item['ingredient_id'] for item in items}
+            missing = ids - Ingredient.objects.in_bulk(ids).keys()
+            if not missing:
+                raise
+            raise serializers.ValidationError({
+                'ingredients': self.fields['ingredients'].item_errors(
+                    items, missing
+                )
+            })
+
+    @transaction.atomic
     def create(self, validated_data):
         ingredients = validated_data.pop('ingredients_in_recipe')
         recipe = super().create(validated_data)
         self.process_ingredients(recipe, ingredients)
+        self.change_ingredient_counters(
+            [item['ingredient_id'] for item in ingredients], 1
+        )
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         ingredients = validated_data.pop('ingredients_in_recipe', None)
-        instance.ingredients_in_recipe.all().delete()
-        self.process_ingredients(instance, ingredients)
+        self.update_ingredients(instance, ingredients)
         return super().update(instance, validated_data)
 
 
-class RecipeMinifiedSerializer(serializers.ModelSerializer):
+class RecipeMinifiedSerializer(TimedSerializerMixin,
+                               serializers.ModelSerializer):
+    image_thumbnail = RenditionField('image', 'thumbnail')
+
     class Meta:
         model = Recipe
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'image_thumbnail', 'cooking_time')
+        read_only_fields = fields
+
+
+class RecipeMatchSerializer(RecipeMinifiedSerializer):
+    coverage = serializers.FloatField(read_only=True)
+    missing_ingredients = IngredientSerializer(many=True, read_only=True)
+
+    class Meta(RecipeMinifiedSerializer.Meta):
+        fields = RecipeMinifiedSerializer.Meta.fields + (
+            'coverage', 'missing_ingredients'
+        )
         read_only_fields = fields
 
 
+class RecipeMatchQuerySerializer(serializers.Serializer):
+    ingredients = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=100
+    )
+    limit = serializers.IntegerField(
+        min_value=1,
+        max_value=settings.RECIPE_MATCH_LIMIT,
+        default=PaginationLimiter.page_size
+    )
+
+
+class RecommendationQuerySerializer(serializers.Serializer):
+    limit = serializers.IntegerField(
+        min_value=1,
+        max_value=settings.RECOMMENDATION_LIMIT,
+        default=PaginationLimiter.page_size
+    )
+
+
+RECIPES_LIMIT_FIELD = serializers.IntegerField(
+    min_value=0,
+    error_messages={
+        'invalid': 'recipes_limit должен быть целым числом',
+        'min_value': 'recipes_limit не может быть отрицательным',
+    }
+)
+
+
 class FollowedUserSerializer(UserSerializer):
     recipes = serializers.SerializerMethodField()
-    recipes_count = serializers.IntegerField(source='recipes.count')
+    recipes_count = serializers.IntegerField(read_only=True)
 
     class Meta:
         model = User
         fields = (
             'id', 'username', 'email', 'first_name',
             'last_name', 'is_subscribed', 'recipes',
-            'recipes_count', 'avatar'
+            'recipes_count', 'avatar', 'avatar_thumbnail'
         )
 
+    @staticmethod
+    def get_recipes_limit(request):
+        value = request.query_params.get('recipes_limit')
+        if value in (None, ''):
+            return settings.SUBSCRIPTION_RECIPES_LIMIT
+        try:
+            limit = RECIPES_LIMIT_FIELD.run_validation(value)
+        except serializers.ValidationError as error:
+            raise serializers.ValidationError(
+                {'recipes_limit': error.detail}
+            )
+        return min(limit, settings.SUBSCRIPTION_RECIPES_LIMIT)
+
     def get_recipes(self, obj):
-        recipes_limit = int(
-            self.context['request'].query_params.get('recipes_limit', 10**10)
-        )
-        return RecipeMinifiedSerializer(
-            obj.recipes.all()[:recipes_limit],
-            many=True
-        ).data
+        recipes = getattr(obj, 'latest_recipes', None)
+        if recipes is None:
+            recipes = obj.recipes.order_by('-created_at', '-id')[
+                :self.get_recipes_limit(self.context['request'])
+            ]
+        return RecipeMinifiedSerializer(recipes, many=True).data
 
 
 class AvatarSerializer(serializers.ModelSerializer):
@@ -0,0 +1,178 @@
+import csv
+import io
+from abc import ABC, abstractmethod
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
+from django.db.models import Count, F, Min, Sum
+from django.http import Http404
+from django.utils import timezone
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.renderers import BaseRenderer
+
+from recipe.models import Recipe, ShoppingCartIngredient
+
+from .units import base_unit, display_amount, unit_factor
+
+
+def cart_ingredients(profile):
+    return ShoppingCartIngredient.objects.filter(
+        user=profile
+    ).values(
+        'ingredient_id',
+        'total',
+        name=F('ingredient__name'),
+        measurement_unit=F('ingredient__measurement_unit'),
+    ).order_by('ingredient__name')
+
+
+def cart_lines(profile):
+    unit = 'ingredient__measurement_unit'
+    return ShoppingCartIngredient.objects.filter(user=profile).values(
+        name=F('ingredient__name'), base=base_unit(unit)
+    ).annotate(
+        quantity=Sum(F('total') * unit_factor(unit)),
+        amount=Sum('total'),
+        unit=Min(unit),
+        units=Count(unit, distinct=True)
+    ).order_by('name', 'base')
+
+
+def shopping_list_rows(profile):
+    yield 'title', timezone.localtime().strftime('%d-%m-%Y %H:%M')
+
+    dishes = Recipe.objects.filter(
+        shoppingcarts__user=profile
+    ).values_list('name', 'author__username').order_by('name')
+    for name, author in dishes.iterator():
+        yield 'recipe', name, author
+
+    for idx, item in enumerate(cart_lines(profile).iterator(), 1):
+        amount, unit = display_amount(item)
+        yield 'ingredient', idx, item['name'].capitalize(), unit, amount
+
+
+async def async_chunks(chunks, batch=64):
+    # Под ASGI Django собирает синхронный StreamingHttpResponse в память
+    # через list(); здесь поток читается пачками в потоке для sync-кода.
+    chunks = iter(chunks)
+    take = sync_to_async(lambda: list(islice(chunks, batch)))
+    try:
+        while part := await take():
+            for chunk in part:
+                yield chunk
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            await sync_to_async(close)()
+
+
+class ShoppingListRenderer(BaseRenderer, ABC):
+    """Формат списка покупок; ошибки отдаются JSON (см. RecipeViewSet)."""
+
+    charset = 'utf-8'
+
+    @abstractmethod
+    def stream(self, rows):
+        """Фрагменты файла по строкам из shopping_list_rows()."""
+
+
+class TextShoppingListRenderer(ShoppingListRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+
+    def stream(self, rows):
+        section = None
+        for kind, *values in rows:
+            if kind == 'title':
+                yield f'Список покупок на {values[0]}\n'
+                continue
+            if kind != section:
+                section = kind
+                yield ('\nРецепты:\n' if kind == 'recipe'
+                       else '\nИнгредиенты:\n')
+            if kind == 'recipe':
+                yield '- {} (Автор: {})\n'.format(*values)
+            else:
+                yield '{}. {} ({}) — {}\n'.format(*values)
+
+
+class Echo:
+    def write(self, value):
+        return value
+
+
+class CSVShoppingListRenderer(ShoppingListRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+    header = ('Тип', 'Название', 'Единица измерения', 'Количество', 'Автор')
+
+    def stream(self, rows):
+        writer = csv.writer(Echo())
+        yield writer.writerow(self.header)
+        for kind, *values in rows:
+            if kind == 'recipe':
+                name, author = values
+                yield writer.writerow(('рецепт', name, '', '', author))
+            elif kind == 'ingredient':
+                _, name, unit, total = values
+                yield writer.writerow(('ингредиент', name, unit, total, ''))
+
+
+class PDFShoppingListRenderer(ShoppingListRenderer):
+    media_type = 'application/pdf'
+    format = 'pdf'
+    charset = None
+    font_name = 'ShoppingListFont'
+    font_size = 11
+    margin = 40
+
+    def stream(self, rows):
+        from reportlab.lib.pagesizes import A4
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        from reportlab.pdfgen import canvas
+
+        if self.font_name not in pdfmetrics.getRegisteredFontNames():
+            pdfmetrics.registerFont(
+                TTFont(self.font_name, settings.SHOPPING_LIST_PDF_FONT)
+            )
+        buffer = io.BytesIO()
+        pdf = canvas.Canvas(buffer, pagesize=A4)
+        _, height = A4
+        line_height = self.font_size * 1.5
+        position = height - self.margin
+        pdf.setFont(self.font_name, self.font_size)
+        for line in TextShoppingListRenderer().stream(rows):
+            for text in line.rstrip('\n').split('\n'):
+                if position < self.margin:
+                    pdf.showPage()
+                    pdf.setFont(self.font_name, self.font_size)
+                    position = height - self.margin
+                pdf.drawString(self.margin, position, text)
+                position -= line_height
+        pdf.save()
+        yield buffer.getvalue()
+
+
+SHOPPING_LIST_RENDERERS = (
+    TextShoppingListRenderer,
+    CSVShoppingListRenderer,
+    PDFShoppingListRenderer,
+)
+
+
+class ShoppingListNegotiation(DefaultContentNegotiation):
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        requested = format_suffix or request.query_params.get(
+            self.settings.URL_FORMAT_OVERRIDE
+        )
+        if not requested:
+            return renderers[0], renderers[0].media_type
+        for renderer in renderers:
+            if renderer.format == requested:
+                return renderer, renderer.media_type
+        raise Http404
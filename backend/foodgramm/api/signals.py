@@ -0,0 +1,99 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from recipe.models import (
+    Favorite,
+    Follow,
+    Ingredient,
+    IngredientsInRecipe,
+    Recipe,
+    ShoppingCart,
+    User
+)
+from .authentication import token_cache
+from .cache import bump_recipes_version, invalidate_viewer_overlay
+from .feed import invalidate_timeline, update_timelines
+from .ingredient_index import ingredient_index
+from .recipe_match import publish_change
+from .recommendations import invalidate_recommendations
+
+
+@receiver((post_save, post_delete), sender=Ingredient)
+def invalidate_ingredient_index(**kwargs):
+    ingredient_index.invalidate()
+
+
+@receiver((post_save, post_delete), sender=Recipe)
+@receiver((post_save, post_delete), sender=IngredientsInRecipe)
+@receiver((post_save, post_delete), sender=Ingredient)
+def invalidate_recipe_responses(**kwargs):
+    transaction.on_commit(bump_recipes_version)
+
+
+@receiver(post_save, sender=Recipe)
+def fan_out_recipe(instance, created, **kwargs):
+    if created:
+        entry = (instance.created_at, instance.pk)
+        transaction.on_commit(
+            lambda: update_timelines(instance.author_id, entry, add=True)
+        )
+
+
+@receiver(post_delete, sender=Recipe)
+def retract_recipe(instance, **kwargs):
+    entry = (instance.created_at, instance.pk)
+    transaction.on_commit(
+        lambda: update_timelines(instance.author_id, entry, add=False)
+    )
+
+
+@receiver((post_save, post_delete), sender=Recipe)
+def publish_recipe_composition(instance, **kwargs):
+    recipe_id = instance.pk
+    transaction.on_commit(lambda: publish_change(recipe_id))
+
+
+@receiver((post_save, post_delete), sender=User)
+def invalidate_author_responses(update_fields=None, **kwargs):
+    if update_fields is None or set(update_fields) != {'last_login'}:
+        transaction.on_commit(bump_recipes_version)
+
+
+@receiver(post_delete, sender=Token)
+def revoke_deleted_token(instance, **kwargs):
+    # Выход через djoser (token/logout) удаляет токен пользователя.
+    user_id, key = instance.user_id, instance.key
+    transaction.on_commit(lambda: token_cache.revoke(user_id, [key]))
+
+
+@receiver(post_save, sender=User)
+def revoke_user_tokens(instance, created, update_fields=None, **kwargs):
+    # Смена пароля, деактивация и правка профиля должны дойти до
+    # request.user, поэтому закешированные токены пользователя сбрасываются.
+    if created:
+        return
+    if update_fields is None or set(update_fields) != {'last_login'}:
+        user_id = instance.pk
+        transaction.on_commit(lambda: token_cache.revoke(user_id))
+
+
+@receiver((post_save, post_delete), sender=Favorite)
+@receiver((post_save, post_delete), sender=ShoppingCart)
+def invalidate_user_overlay(instance, **kwargs):
+    transaction.on_commit(lambda: invalidate_viewer_overlay(instance.user_id))
+    transaction.on_commit(
+        lambda: invalidate_recommendations(instance.user_id)
+    )
+
+
+@receiver((post_save, post_delete), sender=Follow)
+def invalidate_follower_overlay(instance, **kwargs):
+    transaction.on_commit(
+        lambda: invalidate_viewer_overlay(instance.follower_id)
+    )
+    transaction.on_commit(lambda: invalidate_timeline(instance.follower_id))
+    transaction.on_commit(
+        lambda: invalidate_recommendations(instance.follower_id)
+    )
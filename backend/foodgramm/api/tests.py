@@ -0,0 +1,1886 @@
+import asyncio
+import base64
+import tempfile
+import json
+import os
+import time
+from io import StringIO
+from unittest import skipUnless
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.test import (
+    AsyncRequestFactory,
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings
+)
+from django.test.utils import CaptureQueriesContext
+from prometheus_client import REGISTRY
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from foodgramm.instrumentation import (
+    RequestStats,
+    RequestStatsMiddleware,
+    recording,
+    route_histogram
+)
+from recipe.views import aredirect_short_link
+from .async_views import ingredient_list, recipe_detail, recipe_list
+from .authentication import TokenCache, token_cache
+from .feed import HEAVY, timeline_key
+from .filters import IngredientFilter, RecipeFilter
+from .serializers import AvatarSerializer, RecipeCreateUpdateSerializer
+from .shopping_list import ShoppingListRenderer
+from .ingredient_index import ingredient_index
+from .management.benchmarking import IMAGE as TEST_IMAGE, random_png
+from .recipe_match import recipe_match_index
+
+from recipe.images import RENDITIONS_DIR, rendition_files
+from recipe.management.commands.loader import read_json
+from recipe.models import (
+    Favorite,
+    Follow,
+    Ingredient,
+    IngredientsInRecipe,
+    Recipe,
+    RecipeSimilarity,
+    ShoppingCart,
+    ShoppingCartIngredient,
+    User
+)
+
+
+def create_user(username):
+    return User.objects.create_user(
+        username=username,
+        email=f'{username}@example.com',
+        password='pass-Word-42',
+        first_name=username,
+        last_name=username
+    )
+
+
+def create_recipes(author, count, ingredients, viewer=None):
+    recipes = Recipe.objects.bulk_create(
+        Recipe(
+            author=author,
+            name=f'Рецепт {author.username} {idx}',
+            text='Описание',
+            cooking_time=10,
+            image='recipe_pic/test.png'
+        ) for idx in range(count)
+    )
+    IngredientsInRecipe.objects.bulk_create(
+        IngredientsInRecipe(recipe=recipe, ingredient=ingredient, amount=5)
+        for recipe in recipes
+        for ingredient in ingredients
+    )
+    if viewer is not None:
+        Favorite.objects.bulk_create(
+            Favorite(user=viewer, recipe=recipe) for recipe in recipes
+        )
+        ShoppingCart.objects.bulk_create(
+            ShoppingCart(user=viewer, recipe=recipe) for recipe in recipes
+        )
+        for recipe in recipes:
+            ShoppingCartIngredient.objects.add_recipe([viewer.id], recipe.id)
+    return recipes
+
+
+class RecipeListQueriesTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = create_user('viewer')
+        cls.ingredients = Ingredient.objects.bulk_create(
+            Ingredient(name=f'ингредиент {idx}', measurement_unit='г')
+            for idx in range(3)
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.viewer)
+
+    def add_author_with_recipes(self, username, count):
+        author = create_user(username)
+        Follow.objects.create(author=author, follower=self.viewer)
+        create_recipes(author, count, self.ingredients, viewer=self.viewer)
+
+    def count_list_queries(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/recipes/', {'limit': 100})
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries), response.json()
+
+    def test_list_queries_do_not_depend_on_page_size(self):
+        self.add_author_with_recipes('first', 2)
+        small_page_queries, _ = self.count_list_queries()
+
+        self.add_author_with_recipes('second', 10)
+        self.add_author_with_recipes('third', 10)
+        large_page_queries, data = self.count_list_queries()
+
+        self.assertEqual(len(data['results']), 22)
+        self.assertEqual(small_page_queries, large_page_queries)
+        self.assertLessEqual(large_page_queries, 3)
+
+    def test_list_reports_viewer_state(self):
+        self.add_author_with_recipes('author', 2)
+        _, data = self.count_list_queries()
+        recipe = data['results'][0]
+        self.assertTrue(recipe['is_favorited'])
+        self.assertTrue(recipe['is_in_shopping_cart'])
+        self.assertTrue(recipe['author']['is_subscribed'])
+        self.assertEqual(len(recipe['ingredients']), 3)
+
+    def test_anonymous_viewer_state(self):
+        self.add_author_with_recipes('author', 2)
+        response = APIClient().get('/api/recipes/')
+        recipe = response.json()['results'][0]
+        self.assertFalse(recipe['is_favorited'])
+        self.assertFalse(recipe['is_in_shopping_cart'])
+        self.assertFalse(recipe['author']['is_subscribed'])
+
+    def test_retrieve_queries(self):
+        author = create_user('author')
+        recipe, = create_recipes(author, 1, self.ingredients)
+        with self.assertNumQueries(2):
+            response = self.client.get(f'/api/recipes/{recipe.id}/')
+        self.assertEqual(response.status_code, 200)
+
+
+class ShoppingListDownloadTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = create_user('viewer')
+        cls.author = create_user('author')
+        cls.ingredients = Ingredient.objects.bulk_create(
+            Ingredient(name=f'ингредиент {idx}', measurement_unit='г')
+            for idx in range(3)
+        )
+        create_recipes(cls.author, 4, cls.ingredients, viewer=cls.viewer)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.viewer)
+
+    def download(self, **params):
+        response = self.client.get(
+            '/api/recipes/download_shopping_cart/', params
+        )
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_text_is_default(self):
+        response = self.download()
+        self.assertTrue(response.streaming)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        content = b''.join(response.streaming_content).decode()
+        self.assertIn('- Рецепт author 0 (Автор: author)', content)
+        self.assertIn('1. Ингредиент 0 (г) — 20', content)
+
+    def test_csv(self):
+        response = self.download(format='csv')
+        self.assertTrue(response['Content-Type'].startswith('text/csv'))
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(len(lines), 1 + 4 + 3)
+        self.assertIn('ингредиент,Ингредиент 2,г,20,', lines)
+
+    def test_unknown_format(self):
+        response = self.client.get(
+            '/api/recipes/download_shopping_cart/', {'format': 'docx'}
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+    def test_errors_are_json(self):
+        self.client.force_authenticate(None)
+        for params in ({}, {'format': 'txt'}, {'format': 'pdf'}):
+            response = self.client.get(
+                '/api/recipes/download_shopping_cart/', params
+            )
+            self.assertEqual(response.status_code, 401)
+            self.assertEqual(response['Content-Type'], 'application/json')
+            self.assertIn('detail', response.json())
+
+    def test_pdf_has_no_charset(self):
+        response = self.download(format='pdf')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(
+            self.download()['Content-Type'], 'text/plain; charset=utf-8'
+        )
+
+    def test_queries_do_not_depend_on_cart_size(self):
+        with self.assertNumQueries(2):
+            b''.join(self.download().streaming_content)
+
+    async def test_streams_asynchronously_under_asgi(self):
+        token = await Token.objects.acreate(user=self.viewer)
+        response = await self.async_client.get(
+            '/api/recipes/download_shopping_cart/',
+            headers={'Authorization': f'Token {token.key}'}
+        )
+        self.assertTrue(response.is_async)
+        content = b''.join([
+            chunk async for chunk in response.streaming_content
+        ]).decode()
+        self.assertIn('- Рецепт author 0 (Автор: author)', content)
+        self.assertIn('1. Ингредиент 0 (г) — 20', content)
+
+    def test_compatible_units_are_merged(self):
+        flour_g, flour_kg, sugar, oil, oil_ml = (
+            Ingredient.objects.bulk_create([
+                Ingredient(name='мука', measurement_unit='г'),
+                Ingredient(name='мука', measurement_unit='кг'),
+                Ingredient(name='сахар', measurement_unit='ч. л.'),
+                Ingredient(name='масло', measurement_unit='ст. л.'),
+                Ingredient(name='масло', measurement_unit='мл'),
+            ])
+        )
+        ShoppingCartIngredient.objects.apply_deltas([self.viewer.id], {
+            flour_g.id: 500, flour_kg.id: 1, sugar.id: 2,
+            oil.id: 100, oil_ml.id: 500,
+        })
+        content = b''.join(self.download().streaming_content).decode()
+        self.assertIn('Мука (кг) — 1.5', content)
+        self.assertIn('Сахар (ч. л.) — 2', content)
+        self.assertIn('Масло (л) — 2', content)
+
+    def test_renderer_must_define_stream(self):
+        class MarkdownRenderer(ShoppingListRenderer):
+            media_type = 'text/markdown'
+            format = 'md'
+
+        with self.assertRaises(TypeError):
+            MarkdownRenderer()
+
+
+class IngredientSearchTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Ingredient.objects.bulk_create(
+            Ingredient(name=name, measurement_unit='г')
+            for name in ('сахарная пудра', 'ванильный сахар', 'сахар', 'соль')
+        )
+
+    def setUp(self):
+        ingredient_index.invalidate()
+
+    def search(self, name):
+        response = APIClient().get('/api/ingredients/', {'name': name})
+        self.assertEqual(response.status_code, 200)
+        return [item['name'] for item in response.json()]
+
+    def test_ranking(self):
+        self.assertEqual(
+            self.search('Сахар'),
+            ['сахар', 'сахарная пудра', 'ванильный сахар']
+        )
+
+    def test_hits_do_not_query_database(self):
+        self.search('со')
+        with self.assertNumQueries(0):
+            self.assertEqual(self.search('со'), ['соль'])
+
+    def test_index_rebuilt_on_change(self):
+        self.search('со')
+        Ingredient.objects.create(name='соус', measurement_unit='мл')
+        self.assertEqual(self.search('со'), ['соль', 'соус'])
+        Ingredient.objects.get(name='соль').delete()
+        self.assertEqual(self.search('со'), ['соус'])
+
+
+@skipUnless(connection.vendor == 'postgresql', 'EXPLAIN plans need Postgres')
+class QueryPlanTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = create_user('viewer')
+        ingredients = Ingredient.objects.bulk_create(
+            Ingredient(name=f'ингредиент {idx}', measurement_unit='г')
+            for idx in range(200)
+        )
+        authors = []
+        for idx in range(20):
+            author = create_user(f'author{idx}')
+            authors.append(author)
+            create_recipes(
+                author, 10, ingredients[idx::20],
+                viewer=cls.viewer if idx % 2 else None
+            )
+            if idx % 3:
+                Follow.objects.create(author=author, follower=cls.viewer)
+        # У популярных рецептов и авторов много чужих отметок, поэтому
+        # поиск по одному recipe_id или author_id с фильтром по
+        # пользователю хуже составного уникального индекса.
+        fans = [create_user(f'fan{idx}') for idx in range(30)]
+        recipes = Recipe.objects.all()
+        for model in (Favorite, ShoppingCart):
+            model.objects.bulk_create(
+                model(user=fan, recipe=recipe)
+                for fan in fans for recipe in recipes
+            )
+        Follow.objects.bulk_create(
+            Follow(follower=fan, author=author)
+            for fan in fans for author in authors
+        )
+        Recipe.objects.update_search_vectors()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        self.request = RequestFactory().get('/')
+        self.request.user = self.viewer
+
+    def assertUsesIndex(self, queryset, index):
+        plan = queryset.explain()
+        self.assertNotIn('Seq Scan', plan, plan)
+        self.assertIn(index, plan, plan)
+
+    def recipe_filter(self, **data):
+        return RecipeFilter(
+            data=data,
+            queryset=Recipe.objects.all(),
+            request=self.request
+        ).qs
+
+    def test_recipe_list(self):
+        self.assertUsesIndex(
+            self.recipe_filter()[:6], 'recipe_created_at_idx'
+        )
+
+    def test_recipe_author_filter(self):
+        author = User.objects.get(username='author3')
+        self.assertUsesIndex(
+            self.recipe_filter(author=author.id)[:6],
+            'recipe_author_created_at_idx'
+        )
+
+    def test_recipe_favorited_filter(self):
+        self.assertUsesIndex(
+            self.recipe_filter(is_favorited=1)[:6],
+            'unique_user_recipe_favorite'
+        )
+
+    def test_recipe_shopping_cart_filter(self):
+        self.assertUsesIndex(
+            self.recipe_filter(is_in_shopping_cart=1)[:6],
+            'unique_user_recipe_shoppingcart'
+        )
+
+    def test_ingredient_name_filter(self):
+        self.assertUsesIndex(IngredientFilter(
+            data={'name': 'ингредиент 1'},
+            queryset=Ingredient.objects.all()
+        ).qs, 'ingredient_upper_name_idx')
+
+    def test_subscriptions(self):
+        self.assertUsesIndex(
+            User.objects.filter(authors_subs__follower=self.viewer)[:6],
+            'unique_subscription'
+        )
+
+    def test_recipe_search(self):
+        self.assertUsesIndex(
+            self.recipe_filter(search='ингредиенты')[:6],
+            'recipe_search_vector_idx'
+        )
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMAGE_WORKERS=0)
+class RecipeSearchTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('author')
+        chicken, rice = Ingredient.objects.bulk_create([
+            Ingredient(name='Курица', measurement_unit='г'),
+            Ingredient(name='Рис', measurement_unit='г'),
+        ])
+        cls.recipes = {}
+        for name, text, ingredients in (
+            ('Курица с рисом', 'Обжарить', [rice]),
+            ('Плов', 'Классический', [chicken, rice]),
+            ('Салат', 'Подавать с отварной курицей', []),
+            ('Суп', 'Сварить', []),
+        ):
+            recipe = Recipe.objects.create(
+                author=cls.author, name=name, text=text, cooking_time=5,
+                image='recipe_pic/test.png'
+            )
+            IngredientsInRecipe.objects.bulk_create(
+                IngredientsInRecipe(recipe=recipe, ingredient=ingredient,
+                                    amount=1)
+                for ingredient in ingredients
+            )
+            cls.recipes[name] = recipe
+        Recipe.objects.update_search_vectors()
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def search(self, **params):
+        data = self.client.get('/api/recipes/', params).json()
+        return [recipe['name'] for recipe in data['results']]
+
+    def test_ranked_by_field(self):
+        self.assertEqual(
+            self.search(search='курицу'), ['Курица с рисом', 'Плов', 'Салат']
+        )
+
+    def test_all_words_must_match(self):
+        self.assertEqual(
+            self.search(search='курица рис'), ['Курица с рисом', 'Плов']
+        )
+        self.assertEqual(self.search(search='суп курица'), [])
+
+    def test_combined_with_filters(self):
+        other = create_user('other')
+        self.assertEqual(self.search(search='плов', author=other.id), [])
+        self.assertEqual(
+            self.search(search='плов', author=self.author.id), ['Плов']
+        )
+
+    def test_keyset_pages_follow_rank(self):
+        names, url, params = [], '/api/recipes/', {
+            'search': 'курица', 'limit': 1, 'cursor': ''
+        }
+        for _ in range(len(self.recipes)):
+            data = self.client.get(url, params).json()
+            names.extend(recipe['name'] for recipe in data['results'])
+            url, params = data['next'], None
+            if url is None:
+                break
+        self.assertIsNone(url)
+        self.assertEqual(names, ['Курица с рисом', 'Плов', 'Салат'])
+
+    @skipUnless(connection.vendor == 'postgresql', 'tsvector needs Postgres')
+    def test_vector_follows_changes_and_typos(self):
+        self.client.force_authenticate(self.author)
+        recipe = self.recipes['Суп']
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/api/recipes/{recipe.id}/', {
+                'name': 'Грибной суп',
+                'ingredients': [
+                    {'id': Ingredient.objects.get(name='Рис').id,
+                     'amount': 1}
+                ]
+            }, format='json')
+        self.assertEqual(self.search(search='грибного супа'), ['Грибной суп'])
+        self.assertEqual(self.search(search='грибой суп'), ['Грибной суп'])
+        self.assertEqual(self.search(search='грибой курица'), [])
+
+
+class KeysetPaginationTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = create_user('viewer')
+        cls.author = create_user('author')
+        create_recipes(cls.author, 7, [])
+        for idx in range(5):
+            Follow.objects.create(
+                author=create_user(f'author{idx}'), follower=cls.viewer
+            )
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.viewer)
+
+    def walk(self, url, limit):
+        items, response = [], self.client.get(
+            url, {'cursor': '', 'limit': limit}
+        )
+        while True:
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertLessEqual(len(data['results']), limit)
+            items.extend(data['results'])
+            if data['next'] is None:
+                return items
+            response = self.client.get(data['next'])
+
+    def test_recipes(self):
+        recipes = self.walk('/api/recipes/', 3)
+        expected = Recipe.objects.order_by('-created_at', '-id')
+        self.assertEqual(
+            [recipe['id'] for recipe in recipes],
+            list(expected.values_list('id', flat=True))
+        )
+
+    def test_subscriptions(self):
+        authors = self.walk('/api/users/subscriptions/', 2)
+        self.assertEqual(
+            [author['username'] for author in authors],
+            [f'author{idx}' for idx in range(5)]
+        )
+
+    def test_page_number_mode_is_default(self):
+        data = self.client.get('/api/recipes/', {'page': 2}).json()
+        self.assertEqual(data['count'], 7)
+        self.assertEqual(len(data['results']), 1)
+
+    def test_invalid_cursor(self):
+        response = self.client.get('/api/recipes/', {'cursor': 'broken'})
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(IMAGE_WORKERS=0)
+class RecipeResponseCacheTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('author')
+        cls.ingredient = Ingredient.objects.create(
+            name='соль', measurement_unit='г'
+        )
+        cls.recipe, = create_recipes(cls.author, 1, [cls.ingredient])
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def test_repeated_reads_are_cached(self):
+        first = self.client.get('/api/recipes/', {'limit': 3, 'page': 1})
+        with self.assertNumQueries(0):
+            second = self.client.get('/api/recipes/', {'page': 1, 'limit': 3})
+        self.assertEqual(first.content, second.content)
+        self.assertEqual(first['ETag'], second['ETag'])
+
+    def test_not_modified(self):
+        url = f'/api/recipes/{self.recipe.id}/'
+        etag = self.client.get(url)['ETag']
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_invalidated_on_recipe_change(self):
+        url = f'/api/recipes/{self.recipe.id}/'
+        etag = self.client.get(url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            IngredientsInRecipe.objects.filter(recipe=self.recipe).update(
+                amount=7
+            )
+            self.recipe.name = 'Новое название'
+            self.recipe.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['name'], 'Новое название')
+        self.assertEqual(response.json()['ingredients'][0]['amount'], 7)
+
+    def test_authenticated_reads_share_cached_body(self):
+        viewer = create_user('viewer')
+        Favorite.objects.create(user=viewer, recipe=self.recipe)
+        Follow.objects.create(author=self.author, follower=viewer)
+        anonymous = self.client.get('/api/recipes/').json()
+        self.client.force_authenticate(viewer)
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/recipes/')
+        recipe = response.json()['results'][0]
+        self.assertTrue(recipe['is_favorited'])
+        self.assertFalse(recipe['is_in_shopping_cart'])
+        self.assertTrue(recipe['author']['is_subscribed'])
+        self.assertFalse(anonymous['results'][0]['is_favorited'])
+
+    def test_personal_filters_bypass_cache(self):
+        self.client.force_authenticate(self.author)
+        self.client.get('/api/recipes/')
+        response = self.client.get('/api/recipes/', {'is_favorited': 1})
+        self.assertEqual(response.json()['count'], 0)
+        self.assertNotIn('ETag', response)
+
+    @override_settings(VIEWER_OVERLAY_TIMEOUT=60)
+    def test_cached_overlay_invalidated_on_write(self):
+        self.client.force_authenticate(self.author)
+        self.client.get('/api/recipes/')
+        self.client.get('/api/recipes/')
+        with self.assertNumQueries(0):
+            self.client.get('/api/recipes/')
+        with self.captureOnCommitCallbacks(execute=True):
+            ShoppingCart.objects.create(user=self.author, recipe=self.recipe)
+        recipe = self.client.get('/api/recipes/').json()['results'][0]
+        self.assertTrue(recipe['is_in_shopping_cart'])
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class CountersTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('author')
+        cls.viewer = create_user('viewer')
+        cls.ingredients = Ingredient.objects.bulk_create(
+            Ingredient(name=f'ингредиент {idx}', measurement_unit='г')
+            for idx in range(3)
+        )
+
+    def setUp(self):
+        ingredient_index.invalidate()
+        self.client = APIClient()
+
+    def create_recipe(self, ingredients):
+        self.client.force_authenticate(self.author)
+        response = self.client.post('/api/recipes/', {
+            'name': 'Рецепт',
+            'text': 'Описание',
+            'cooking_time': 5,
+            'image': TEST_IMAGE,
+            'ingredients': [
+                {'id': ingredient.id, 'amount': 10}
+                for ingredient in ingredients
+            ]
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.content)
+        return Recipe.objects.get(pk=response.json()['id'])
+
+    def assertCounts(self, obj, **counts):
+        obj.refresh_from_db()
+        for field, expected in counts.items():
+            self.assertEqual(getattr(obj, field), expected, field)
+
+    def test_recipe_counters(self):
+        first, second, third = self.ingredients
+        recipe = self.create_recipe([first, second])
+        self.assertCounts(self.author, recipes_count=1)
+        self.assertCounts(first, recipes_count=1)
+
+        response = self.client.patch(f'/api/recipes/{recipe.id}/', {
+            'ingredients': [
+                {'id': second.id, 'amount': 1},
+                {'id': third.id, 'amount': 1}
+            ]
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertCounts(first, recipes_count=0)
+        self.assertCounts(second, recipes_count=1)
+        self.assertCounts(third, recipes_count=1)
+
+        self.client.delete(f'/api/recipes/{recipe.id}/')
+        self.assertCounts(self.author, recipes_count=0)
+        self.assertCounts(second, recipes_count=0)
+
+    def test_update_keeps_unchanged_rows(self):
+        first, second, third = self.ingredients
+        recipe = self.create_recipe([first, second])
+        kept = IngredientsInRecipe.objects.get(recipe=recipe, ingredient=first)
+        response = self.client.patch(f'/api/recipes/{recipe.id}/', {
+            'name': 'Новое название',
+            'ingredients': [
+                {'id': first.id, 'amount': 10},
+                {'id': third.id, 'amount': 3}
+            ]
+        }, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+        rows = {
+            row.ingredient_id: row
+            for row in IngredientsInRecipe.objects.filter(recipe=recipe)
+        }
+        self.assertEqual(set(rows), {first.id, third.id})
+        self.assertEqual(rows[first.id].pk, kept.pk)
+        self.assertEqual(rows[third.id].amount, 3)
+        self.assertEqual(
+            [item['amount'] for item in response.json()['ingredients']],
+            [10, 3]
+        )
+
+    def test_unknown_ingredient(self):
+        self.client.force_authenticate(self.author)
+        response = self.client.post('/api/recipes/', {
+            'name': 'Рецепт',
+            'text': 'Описание',
+            'cooking_time': 5,
+            'image': TEST_IMAGE,
+            'ingredients': [{'id': 10 ** 6, 'amount': 1}]
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('ingredients', response.json())
+
+    def test_ingredient_errors_are_reported_per_item(self):
+        first, second, _ = self.ingredients
+        self.client.force_authenticate(self.author)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post('/api/recipes/', {
+                'name': 'Рецепт',
+                'text': 'Описание',
+                'cooking_time': 5,
+                'image': TEST_IMAGE,
+                'ingredients': [
+                    {'id': first.id, 'amount': 1},
+                    {'id': 10 ** 6, 'amount': 1},
+                    {'id': second.id, 'amount': 1},
+                    {'id': first.id, 'amount': 2},
+                ]
+            }, format='json')
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()['ingredients']
+        self.assertEqual(errors[0], {})
+        self.assertIn('id', errors[1])
+        self.assertEqual(errors[2], {})
+        self.assertIn('id', errors[3])
+        self.assertEqual(len(context.captured_queries), 1)
+
+    def test_known_ingredients_resolved_from_catalogue(self):
+        ingredient_index.search('ингредиент', 1)
+        serializer = RecipeCreateUpdateSerializer(data={
+            'name': 'Рецепт',
+            'text': 'Описание',
+            'cooking_time': 5,
+            'image': TEST_IMAGE,
+            'ingredients': [
+                {'id': ingredient.id, 'amount': 1}
+                for ingredient in self.ingredients
+            ]
+        })
+        with self.assertNumQueries(0):
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+
+    def test_favorite_and_follow_counters(self):
+        recipe = self.create_recipe(self.ingredients[:1])
+        self.client.force_authenticate(self.viewer)
+        self.client.post(f'/api/recipes/{recipe.id}/favorite/')
+        self.client.post(f'/api/recipes/{recipe.id}/favorite/')
+        self.client.post(f'/api/users/{self.author.id}/subscribe/')
+        self.assertCounts(recipe, favorites_count=1)
+        self.assertCounts(self.author, followers_count=1)
+
+        response = self.client.get('/api/users/subscriptions/')
+        self.assertEqual(response.json()['results'][0]['recipes_count'], 1)
+
+        self.client.delete(f'/api/recipes/{recipe.id}/favorite/')
+        self.client.delete(f'/api/users/{self.author.id}/subscribe/')
+        self.assertCounts(recipe, favorites_count=0)
+        self.assertCounts(self.author, followers_count=0)
+
+    def test_counters_follow_changes_outside_api(self):
+        first, second, _ = self.ingredients
+        recipe = self.create_recipe([first])
+        Favorite.objects.create(user=self.viewer, recipe=recipe)
+        Follow.objects.create(follower=self.viewer, author=self.author)
+        self.assertCounts(recipe, favorites_count=1)
+        self.assertCounts(self.author, recipes_count=1, followers_count=1)
+
+        self.viewer.delete()
+        self.assertCounts(recipe, favorites_count=0)
+        self.assertCounts(self.author, followers_count=0)
+
+        row = IngredientsInRecipe.objects.get(recipe=recipe)
+        row.ingredient = second
+        row.save()
+        self.assertCounts(first, recipes_count=0)
+        self.assertCounts(second, recipes_count=1)
+
+        Recipe.objects.filter(pk=recipe.pk).delete()
+        self.assertCounts(self.author, recipes_count=0)
+        self.assertCounts(second, recipes_count=0)
+
+    def test_recount_fixes_drift(self):
+        recipe, = create_recipes(
+            self.author, 1, self.ingredients, viewer=self.viewer
+        )
+        Follow.objects.create(author=self.author, follower=self.viewer)
+        call_command('recount', stdout=StringIO())
+        self.assertCounts(recipe, favorites_count=1)
+        self.assertCounts(self.author, recipes_count=1, followers_count=1)
+        self.assertCounts(self.ingredients[0], recipes_count=1)
+
+    def cart_summary(self):
+        self.client.force_authenticate(self.viewer)
+        response = self.client.get('/api/recipes/shopping_cart/summary/')
+        self.assertEqual(response.status_code, 200)
+        return {item['id']: item['amount'] for item in response.json()}
+
+    def test_cart_totals_follow_changes(self):
+        first, second, third = self.ingredients
+        recipe = self.create_recipe([first, second])
+        other = self.create_recipe([second])
+        self.client.force_authenticate(self.viewer)
+        for item in (recipe, other):
+            self.client.post(f'/api/recipes/{item.id}/shopping_cart/')
+        self.assertEqual(
+            self.cart_summary(), {first.id: 10, second.id: 20}
+        )
+
+        self.client.force_authenticate(self.author)
+        self.client.patch(f'/api/recipes/{recipe.id}/', {
+            'ingredients': [
+                {'id': second.id, 'amount': 3},
+                {'id': third.id, 'amount': 7}
+            ]
+        }, format='json')
+        self.assertEqual(
+            self.cart_summary(), {second.id: 13, third.id: 7}
+        )
+
+        self.client.delete(f'/api/recipes/{other.id}/shopping_cart/')
+        self.assertEqual(self.cart_summary(), {second.id: 3, third.id: 7})
+
+        self.client.force_authenticate(self.author)
+        self.client.delete(f'/api/recipes/{recipe.id}/')
+        self.assertEqual(self.cart_summary(), {})
+
+    def test_cart_totals_follow_deletes_outside_api(self):
+        first, second, third = self.ingredients
+        recipe = self.create_recipe([first, second])
+        other = self.create_recipe([second])
+        for item in (recipe, other):
+            ShoppingCart.objects.create(user=self.viewer, recipe=item)
+        self.assertEqual(self.cart_summary(), {first.id: 10, second.id: 20})
+
+        Recipe.objects.filter(pk=recipe.pk).delete()
+        self.assertEqual(self.cart_summary(), {second.id: 10})
+
+        row = IngredientsInRecipe.objects.get(recipe=other)
+        row.amount = 4
+        row.save()
+        IngredientsInRecipe.objects.create(
+            recipe=other, ingredient=third, amount=2
+        )
+        self.assertEqual(self.cart_summary(), {second.id: 4, third.id: 2})
+
+        third.delete()
+        self.assertEqual(self.cart_summary(), {second.id: 4})
+        self.author.delete()
+        self.assertEqual(self.cart_summary(), {})
+
+    def test_recount_rebuilds_cart_totals(self):
+        create_recipes(self.author, 2, self.ingredients, viewer=self.viewer)
+        ShoppingCartIngredient.objects.all().delete()
+        call_command('recount', stdout=StringIO())
+        self.assertEqual(
+            self.cart_summary(),
+            {ingredient.id: 10 for ingredient in self.ingredients}
+        )
+
+    def test_stale_counters_stay_non_negative(self):
+        recipe, = create_recipes(
+            self.author, 1, self.ingredients, viewer=self.viewer
+        )
+        Follow.objects.create(author=self.author, follower=self.viewer)
+        self.client.force_authenticate(self.viewer)
+        for url in (
+            f'/api/recipes/{recipe.id}/favorite/',
+            f'/api/users/{self.author.id}/subscribe/',
+        ):
+            self.assertEqual(self.client.delete(url).status_code, 204)
+        self.client.force_authenticate(self.author)
+        self.assertEqual(
+            self.client.delete(f'/api/recipes/{recipe.id}/').status_code, 204
+        )
+        self.assertCounts(self.author, recipes_count=0, followers_count=0)
+        self.assertCounts(self.ingredients[0], recipes_count=0)
+
+    def test_save_keeps_counters(self):
+        User.objects.filter(pk=self.author.pk).update(recipes_count=5)
+        self.author.first_name = 'Иван'
+        self.author.save()
+        self.assertCounts(self.author, recipes_count=5, first_name='Иван')
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class StaleIngredientTest(TransactionTestCase):
+    # Внешний ключ проверяется при фиксации, поэтому нужны настоящие
+    # транзакции, а не откат TestCase.
+
+    def test_deleted_ingredient_in_snapshot(self):
+        author = create_user('author')
+        kept, deleted = Ingredient.objects.bulk_create(
+            Ingredient(name=f'ингредиент {idx}', measurement_unit='г')
+            for idx in range(2)
+        )
+        deleted_id = deleted.id
+        ingredient_index.invalidate()
+        ingredient_index.search('ингредиент', 1)
+        # Снимок другого процесса ещё не знает об удалении.
+        snapshot = ingredient_index._snapshot
+        deleted.delete()
+        ingredient_index._snapshot = snapshot
+        client = APIClient()
+        client.force_authenticate(author)
+        response = client.post('/api/recipes/', {
+            'name': 'Рецепт',
+            'text': 'Описание',
+            'cooking_time': 5,
+            'image': TEST_IMAGE,
+            'ingredients': [
+                {'id': kept.id, 'amount': 1},
+                {'id': deleted_id, 'amount': 1},
+            ]
+        }, format='json')
+        ingredient_index.invalidate()
+        self.assertEqual(response.status_code, 400, response.content)
+        self.assertEqual(response.json()['ingredients'][0], {})
+        self.assertIn('id', response.json()['ingredients'][1])
+        self.assertFalse(Recipe.objects.exists())
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMAGE_WORKERS=0)
+class ImageRenditionsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.author = create_user('author')
+        self.client = APIClient()
+        self.client.force_authenticate(self.author)
+
+    def test_recipe_renditions(self):
+        ingredient = Ingredient.objects.create(
+            name='соль', measurement_unit='г'
+        )
+        payload = {
+            'name': 'Рецепт',
+            'text': 'Описание',
+            'cooking_time': 5,
+            'image': TEST_IMAGE,
+            'ingredients': [{'id': ingredient.id, 'amount': 1}]
+        }
+        with self.captureOnCommitCallbacks() as callbacks:
+            data = self.client.post(
+                '/api/recipes/', payload, format='json'
+            ).json()
+        self.assertEqual(data['image_thumbnail'], data['image'])
+
+        for callback in callbacks:
+            callback()
+        recipe = Recipe.objects.get(pk=data['id'])
+        self.assertEqual(
+            set(recipe.image_renditions), {'source', 'thumbnail', 'card'}
+        )
+        data = self.client.get(f'/api/recipes/{recipe.id}/').json()
+        self.assertRegex(data['image_thumbnail'], r'_thumbnail\w*\.webp$')
+        self.assertRegex(data['image_card'], r'_card\w*\.webp$')
+
+    def test_avatar_renditions(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(
+                '/api/users/me/avatar/', {'avatar': TEST_IMAGE}, format='json'
+            )
+        self.client.force_authenticate(User.objects.get(pk=self.author.pk))
+        data = self.client.get('/api/users/me/').json()
+        self.assertRegex(data['avatar_thumbnail'], r'_thumbnail\w*\.webp$')
+
+    def upload_avatar(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put(
+                '/api/users/me/avatar/', {'avatar': TEST_IMAGE}, format='json'
+            )
+        renditions = User.objects.get(pk=self.author.pk).avatar_renditions
+        return rendition_files(renditions)
+
+    def test_replaced_avatar_drops_old_renditions(self):
+        first = self.upload_avatar()
+        second = self.upload_avatar()
+        self.assertTrue(first and second and not first & second)
+        self.assertFalse(any(map(default_storage.exists, first)))
+        self.assertTrue(all(map(default_storage.exists, second)))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete('/api/users/me/avatar/')
+        self.assertEqual(
+            User.objects.get(pk=self.author.pk).avatar_renditions, {}
+        )
+        self.assertFalse(any(map(default_storage.exists, second)))
+
+    def test_deleted_owner_drops_renditions(self):
+        paths = self.upload_avatar()
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.get(pk=self.author.pk).delete()
+        self.assertFalse(any(map(default_storage.exists, paths)))
+
+    def test_command_backfills_and_prunes(self):
+        self.client.put(
+            '/api/users/me/avatar/', {'avatar': TEST_IMAGE}, format='json'
+        )
+        orphan = default_storage.save(
+            f'{RENDITIONS_DIR}/orphan.webp', ContentFile(b'')
+        )
+        call_command('renditions', '--prune', stdout=StringIO())
+        renditions = User.objects.get(pk=self.author.pk).avatar_renditions
+        self.assertEqual(set(renditions), {'source', 'thumbnail', 'card'})
+        self.assertTrue(
+            all(map(default_storage.exists, rendition_files(renditions)))
+        )
+        self.assertFalse(default_storage.exists(orphan))
+
+
+class Base64ImageFieldTest(TestCase):
+
+    def validate(self, payload):
+        serializer = AvatarSerializer(data={'avatar': payload})
+        self.assertFalse(serializer.is_valid())
+        return serializer.errors['avatar'][0].code
+
+    @override_settings(IMAGE_UPLOAD_MAX_SIZE=10)
+    def test_rejects_large_payload_before_decoding(self):
+        self.assertEqual(self.validate(TEST_IMAGE), 'too_large')
+
+    @override_settings(IMAGE_MAX_PIXELS=0)
+    def test_rejects_large_dimensions(self):
+        self.assertEqual(self.validate(TEST_IMAGE), 'too_many_pixels')
+
+    def test_rejects_invalid_data(self):
+        self.assertEqual(
+            self.validate('data:image/png;base64,не base64'), 'invalid_base64'
+        )
+        self.assertEqual(
+            self.validate('data:image/png;base64,aGVsbG8gd29ybGQh'),
+            'invalid_image'
+        )
+
+    def test_accepts_valid_image(self):
+        serializer = AvatarSerializer(data={'avatar': TEST_IMAGE})
+        self.assertTrue(serializer.is_valid(), serializer.errors)
+        avatar = serializer.validated_data['avatar']
+        self.assertEqual(avatar.name, 'temp.png')
+        self.assertEqual(avatar.size, 70)
+
+    def test_accepts_wrapped_base64(self):
+        png = random_png(40)
+        encoded = base64.encodebytes(png).decode()
+        serializer = AvatarSerializer(data={
+            'avatar': 'data:image/png;base64,' + encoded.replace('\n', '\r\n')
+        })
+        # Куски поменьше, чтобы границы приходились на середину строк.
+        field = serializer.fields['avatar']
+        field.header_size, field.chunk_size = 300, 1000
+        # Переводы строк не учитываются в оценке размера.
+        with self.settings(IMAGE_UPLOAD_MAX_SIZE=len(png)):
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+        self.assertEqual(serializer.validated_data['avatar'].read(), png)
+
+
+class LoaderTest(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        Ingredient.objects.create(name='соль', measurement_unit='г')
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        return path
+
+    def load(self, *paths, **options):
+        out = StringIO()
+        call_command('loader', *paths, stdout=out, **options)
+        return out.getvalue()
+
+    def test_json(self):
+        path = self.write('ingredients.json', json.dumps([
+            {'name': 'соль', 'measurement_unit': 'г'},
+            {'name': 'мука', 'measurement_unit': 'г'},
+            {'name': 'мука', 'measurement_unit': 'г'},
+            {'name': 'молоко', 'measurement_unit': 'мл'},
+            {'name': '', 'measurement_unit': 'г'},
+            ['не', 'объект'],
+        ], ensure_ascii=False))
+        output = self.load(path, batch_size=2)
+        self.assertIn('добавлено 2, пропущено 2, ошибочных 2', output)
+        self.assertEqual(Ingredient.objects.count(), 3)
+
+        output = self.load(path, batch_size=2)
+        self.assertIn('добавлено 0, пропущено 4, ошибочных 2', output)
+        self.assertEqual(Ingredient.objects.count(), 3)
+
+    def test_csv(self):
+        path = self.write(
+            'ingredients.csv', 'соль,г\nяйца,шт.\n"сахар, песок",г\nбез\n'
+        )
+        output = self.load(path)
+        self.assertIn('добавлено 2, пропущено 1, ошибочных 1', output)
+        self.assertTrue(Ingredient.objects.filter(
+            name='сахар, песок', measurement_unit='г'
+        ).exists())
+
+    def test_json_items_split_across_chunks(self):
+        items = [
+            {'name': f'ингредиент {idx}', 'measurement_unit': 'г'}
+            for idx in range(50)
+        ]
+        path = self.write('ingredients.json', json.dumps(items))
+        with open(path, encoding='utf-8') as file:
+            rows = list(read_json(file, chunk_size=7))
+        self.assertEqual(
+            rows, [(item['name'], item['measurement_unit']) for item in items]
+        )
+
+    def test_invalid_json(self):
+        path = self.write('ingredients.json', '[{"name": "соль"')
+        with self.assertRaises(CommandError):
+            self.load(path)
+
+
+class RequestStatsTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = create_user('viewer')
+        cls.author = create_user('author')
+        cls.ingredients = Ingredient.objects.bulk_create(
+            Ingredient(name=f'ингредиент {idx}', measurement_unit='г')
+            for idx in range(2)
+        )
+        create_recipes(cls.author, 3, cls.ingredients, viewer=cls.viewer)
+
+    def setUp(self):
+        cache.clear()
+        route_histogram.reset()
+        self.client = APIClient()
+        self.client.force_authenticate(self.viewer)
+
+    def test_server_timing_and_log(self):
+        with self.assertLogs('foodgramm.requests') as logs:
+            response = self.client.get('/api/recipes/')
+        self.assertRegex(
+            response['Server-Timing'], r'db;dur=[\d.]+;desc="\d+ queries"'
+        )
+        self.assertIn('serializer;dur=', response['Server-Timing'])
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['route'], 'RecipeViewSet.list')
+        self.assertEqual(record['status'], 200)
+        self.assertGreater(record['queries'], 0)
+
+    def test_only_slow_or_heavy_requests_warn(self):
+        with self.assertNoLogs('foodgramm.requests', 'WARNING'):
+            self.client.get('/api/recipes/')
+        with override_settings(HEAVY_REQUEST_QUERIES=1):
+            with self.assertLogs('foodgramm.requests', 'WARNING') as logs:
+                self.client.get('/api/recipes/')
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['route'], 'RecipeViewSet.list')
+
+    def test_histogram_per_route(self):
+        for _ in range(2):
+            self.client.get('/api/recipes/')
+        response = self.client.get(
+            '/api/recipes/download_shopping_cart/'
+        )
+        b''.join(response.streaming_content)
+        routes = route_histogram.snapshot()['routes']
+        self.assertEqual(routes['RecipeViewSet.list']['count'], 2)
+        self.assertEqual(
+            sum(routes['RecipeViewSet.list']['latency_ms']), 2
+        )
+        self.assertGreaterEqual(
+            routes['RecipeViewSet.download_shopping_cart']['query_count'], 2
+        )
+
+    def test_duplicate_queries(self):
+        stats = RequestStats()
+        with recording(stats):
+            for recipe in Recipe.objects.all():
+                recipe.author.username
+        duplicate, = stats.duplicates()
+        self.assertEqual(duplicate['count'], 3)
+
+    def test_stats_endpoint_is_protected(self):
+        response = self.client.get('/api/stats/requests/')
+        self.assertEqual(response.status_code, 403)
+        self.viewer.is_staff = True
+        self.client.force_authenticate(self.viewer)
+        response = self.client.get('/api/stats/requests/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.json()['routes']['RequestStatsView.get']['count'], 1
+        )
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMAGE_WORKERS=0)
+@override_settings(METRICS_TOKEN='secret')
+class MetricsTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = create_user('viewer')
+        cls.ingredient = Ingredient.objects.create(
+            name='соль', measurement_unit='г'
+        )
+        create_recipes(cls.viewer, 2, [cls.ingredient], viewer=cls.viewer)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_request_and_cache_metrics(self):
+        latency = dict(
+            route='RecipeViewSet.list', method='GET', status='200'
+        )
+        before = self.sample('foodgramm_request_duration_seconds_count',
+                             **latency)
+        hits = self.sample('foodgramm_cache_requests_total',
+                           cache='recipes', result='hit')
+        for _ in range(2):
+            self.client.get('/api/recipes/')
+        response = self.client.get(
+            '/api/metrics', HTTP_AUTHORIZATION='Bearer secret'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn(
+            b'foodgramm_request_queries_bucket{le="5.0",'
+            b'route="RecipeViewSet.list"}', response.content
+        )
+        self.assertEqual(self.sample(
+            'foodgramm_request_duration_seconds_count', **latency
+        ), before + 2)
+        self.assertEqual(self.sample(
+            'foodgramm_cache_requests_total', cache='recipes', result='hit'
+        ), hits + 1)
+
+    def test_upload_and_shopping_list_metrics(self):
+        uploads = self.sample(
+            'foodgramm_image_upload_bytes_count', field='image'
+        )
+        lists = self.sample(
+            'foodgramm_shopping_list_seconds_count', format='csv'
+        )
+        self.client.force_authenticate(self.viewer)
+        self.client.post('/api/recipes/', {
+            'name': 'Рецепт',
+            'text': 'Описание',
+            'cooking_time': 5,
+            'image': TEST_IMAGE,
+            'ingredients': [{'id': self.ingredient.id, 'amount': 1}]
+        }, format='json')
+        response = self.client.get(
+            '/api/recipes/download_shopping_cart/', {'format': 'csv'}
+        )
+        b''.join(response.streaming_content)
+        self.assertEqual(self.sample(
+            'foodgramm_image_upload_bytes_count', field='image'
+        ), uploads + 1)
+        self.assertEqual(self.sample(
+            'foodgramm_shopping_list_seconds_count', format='csv'
+        ), lists + 1)
+
+    def test_token(self):
+        response = self.client.get('/api/metrics')
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(
+            '/api/metrics', HTTP_AUTHORIZATION='Bearer wrong'
+        )
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(
+            '/api/metrics', HTTP_AUTHORIZATION='Bearer secret'
+        )
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(METRICS_TOKEN='')
+    def test_closed_without_token(self):
+        response = self.client.get(
+            '/api/metrics', HTTP_AUTHORIZATION='Bearer '
+        )
+        self.assertEqual(response.status_code, 403)
+
+
+class SubscriptionsTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = create_user('viewer')
+        ingredient = Ingredient.objects.create(
+            name='соль', measurement_unit='г'
+        )
+        cls.authors = [create_user(f'author{idx}') for idx in range(4)]
+        Follow.objects.bulk_create(
+            Follow(follower=cls.viewer, author=author)
+            for author in cls.authors
+        )
+        for author in cls.authors:
+            create_recipes(author, 5, [ingredient])
+        call_command('recount', stdout=StringIO())
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.viewer)
+
+    def get(self, **params):
+        return self.client.get('/api/users/subscriptions/', params)
+
+    def test_queries_do_not_depend_on_authors(self):
+        with self.assertNumQueries(3):
+            response = self.get(recipes_limit=2, limit=10)
+        results = response.json()['results']
+        self.assertEqual(len(results), 4)
+        for author, data in zip(self.authors, results):
+            self.assertTrue(data['is_subscribed'])
+            self.assertEqual(data['recipes_count'], 5)
+            self.assertEqual(
+                [recipe['id'] for recipe in data['recipes']],
+                list(author.recipes.order_by(
+                    '-created_at', '-id'
+                ).values_list('id', flat=True)[:2])
+            )
+
+    @override_settings(SUBSCRIPTION_RECIPES_LIMIT=3)
+    def test_recipes_limit_is_bounded(self):
+        results = self.get().json()['results']
+        self.assertEqual(len(results[0]['recipes']), 3)
+        results = self.get(recipes_limit=10 ** 10).json()['results']
+        self.assertEqual(len(results[0]['recipes']), 3)
+        results = self.get(recipes_limit=0).json()['results']
+        self.assertEqual(results[0]['recipes'], [])
+
+    def test_invalid_recipes_limit(self):
+        for value in ('abc', '-1'):
+            response = self.get(recipes_limit=value)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('recipes_limit', response.json())
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMAGE_WORKERS=0)
+class FeedTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = create_user('viewer')
+        cls.ingredient = Ingredient.objects.create(
+            name='соль', measurement_unit='г'
+        )
+        cls.authors = [create_user(f'author{idx}') for idx in range(3)]
+        for author in cls.authors:
+            create_recipes(author, 3, [cls.ingredient])
+        Follow.objects.bulk_create(
+            Follow(follower=cls.viewer, author=author)
+            for author in cls.authors[:2]
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.viewer)
+
+    def expected(self):
+        return list(Recipe.objects.filter(
+            author__in=self.authors[:2]
+        ).order_by('-created_at', '-id').values_list('id', flat=True))
+
+    def walk(self, limit=2):
+        ids, url = [], '/api/recipes/feed/'
+        params = {'limit': limit}
+        while url:
+            data = self.client.get(url, params).json()
+            ids.extend(recipe['id'] for recipe in data['results'])
+            url, params = data['next'], None
+        return ids
+
+    def test_timeline(self):
+        self.assertEqual(self.walk(), self.expected())
+        self.assertIsInstance(cache.get(timeline_key(self.viewer.id)), dict)
+        with self.assertNumQueries(2):
+            self.client.get('/api/recipes/feed/', {'limit': 2})
+
+    @override_settings(FEED_FANOUT_MAX_FOLLOWS=1)
+    def test_heavy_follower_reads_merged_query(self):
+        self.assertEqual(self.walk(), self.expected())
+        self.assertEqual(cache.get(timeline_key(self.viewer.id)), HEAVY)
+
+    @override_settings(FEED_TIMELINE_SIZE=4)
+    def test_truncated_timeline_falls_back_to_query(self):
+        self.assertEqual(self.walk(limit=3), self.expected())
+
+    def test_fan_out_on_write(self):
+        self.walk()
+        self.client.force_authenticate(self.authors[0])
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/recipes/', {
+                'name': 'Новый',
+                'text': 'Описание',
+                'cooking_time': 5,
+                'image': TEST_IMAGE,
+                'ingredients': [{'id': self.ingredient.id, 'amount': 1}]
+            }, format='json')
+        created = response.json()['id']
+        self.client.force_authenticate(self.viewer)
+        self.assertEqual(self.walk()[0], created)
+
+        self.client.force_authenticate(self.authors[0])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/recipes/{created}/')
+        self.client.force_authenticate(self.viewer)
+        self.assertNotIn(created, self.walk())
+        self.assertEqual(self.walk(), self.expected())
+
+    def test_follow_change_resets_timeline(self):
+        self.walk()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/api/users/{self.authors[2].id}/subscribe/')
+        self.assertIsNone(cache.get(timeline_key(self.viewer.id)))
+        self.assertEqual(len(self.walk()), 9)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMAGE_WORKERS=0)
+class AsyncReadViewsTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = create_user('viewer')
+        cls.token = Token.objects.create(user=cls.viewer)
+        cls.ingredient = Ingredient.objects.create(
+            name='соль', measurement_unit='г'
+        )
+        cls.author = create_user('author')
+        cls.recipes = create_recipes(
+            cls.author, 4, [cls.ingredient], viewer=cls.viewer
+        )
+        Follow.objects.create(follower=cls.viewer, author=cls.author)
+
+    def setUp(self):
+        cache.clear()
+        ingredient_index.invalidate()
+        self.factory = AsyncRequestFactory()
+        self.client = APIClient()
+        self.auth = {'Authorization': f'Token {self.token.key}'}
+
+    def sync_get(self, url, params=None, headers=None):
+        cache.clear()
+        response = self.client.get(url, params, headers=headers)
+        cache.clear()
+        return response
+
+    async def test_recipe_list_matches_sync(self):
+        for params in ({'limit': 2}, {'limit': 2, 'page': 2},
+                       {'is_favorited': 1}, {'author': self.author.id},
+                       {'limit': 3, 'cursor': ''},
+                       {'search': 'рецепт', 'limit': 3, 'cursor': ''}):
+            for headers in ({}, self.auth):
+                expected = await sync_to_async(self.sync_get)(
+                    '/api/recipes/', params, headers
+                )
+                response = await recipe_list(self.factory.get(
+                    '/api/recipes/', params, headers=headers
+                ))
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(json.loads(response.content), expected.json())
+
+    async def test_recipe_detail_matches_sync(self):
+        url = f'/api/recipes/{self.recipes[0].id}/'
+        expected = await sync_to_async(self.sync_get)(url, None, self.auth)
+        response = await recipe_detail(
+            self.factory.get(url, headers=self.auth), pk=self.recipes[0].id
+        )
+        self.assertEqual(json.loads(response.content), expected.json())
+        missing = await recipe_detail(
+            self.factory.get('/api/recipes/0/'), pk=0
+        )
+        self.assertEqual(missing.status_code, 404)
+
+    async def test_fallbacks_to_sync_view(self):
+        response = await recipe_list(self.factory.get(
+            '/api/recipes/', headers={'Authorization': 'Token invalid'}
+        ))
+        self.assertEqual(response.status_code, 401)
+        response = await recipe_list(
+            self.factory.get('/api/recipes/', {'page': 100})
+        )
+        self.assertEqual(response.status_code, 404)
+        response = await recipe_detail(
+            self.factory.delete(
+                f'/api/recipes/{self.recipes[0].id}/', headers=self.auth
+            ),
+            pk=self.recipes[0].id
+        )
+        self.assertEqual(response.status_code, 403)
+
+    async def test_ingredient_search(self):
+        response = await ingredient_list(
+            self.factory.get('/api/ingredients/', {'name': 'СО'})
+        )
+        self.assertEqual(json.loads(response.content), [{
+            'id': self.ingredient.id,
+            'name': 'соль',
+            'measurement_unit': 'г'
+        }])
+
+    async def test_short_link(self):
+        pk = self.recipes[0].id
+        response = await aredirect_short_link(
+            self.factory.get(f'/s/{pk}/'), pk
+        )
+        self.assertEqual(response['Location'], f'/recipes/{pk}/')
+        with self.assertRaises(Http404):
+            await aredirect_short_link(self.factory.get('/s/0/'), 0)
+
+    def recording_middleware(self, view):
+        stats = []
+        middleware = RequestStatsMiddleware(view)
+        original = middleware.finish
+        middleware.finish = lambda request, response, data: (
+            stats.append(data), original(request, response, data)
+        )
+        return middleware, stats
+
+    async def test_middleware_records_async_queries(self):
+        async def view(request):
+            await Recipe.objects.acount()
+            return HttpResponse()
+
+        middleware, stats = self.recording_middleware(view)
+        response = await middleware(self.factory.get('/api/recipes/'))
+        self.assertEqual(stats[0].queries, 1)
+        self.assertIn('db;dur=', response['Server-Timing'])
+
+    async def test_overlapping_requests_count_own_queries(self):
+        started = asyncio.Event()
+
+        async def view(request):
+            await Recipe.objects.acount()
+            if started.is_set():
+                await Recipe.objects.acount()
+            else:
+                started.set()
+                await asyncio.sleep(0.05)
+            return HttpResponse()
+
+        middleware, stats = self.recording_middleware(view)
+        await asyncio.gather(*(
+            middleware(self.factory.get('/api/recipes/'))
+            for _ in range(2)
+        ))
+        self.assertEqual(sorted(data.queries for data in stats), [1, 2])
+
+    async def test_async_stream_is_recorded_after_body(self):
+        async def content():
+            yield str(await Recipe.objects.acount()).encode()
+
+        async def view(request):
+            return StreamingHttpResponse(content())
+
+        middleware, stats = self.recording_middleware(view)
+        response = await middleware(self.factory.get('/api/recipes/'))
+        self.assertEqual(stats, [])
+        body = b''.join([
+            chunk async for chunk in response.streaming_content
+        ])
+        self.assertEqual(body, b'4')
+        self.assertEqual(stats[0].queries, 1)
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp(), IMAGE_WORKERS=0)
+class RecipeMatchTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('author')
+        cls.salt, cls.rice, cls.chicken, cls.onion = (
+            Ingredient.objects.bulk_create(
+                Ingredient(name=name, measurement_unit='г')
+                for name in ('соль', 'рис', 'курица', 'лук')
+            )
+        )
+        cls.full, = create_recipes(cls.author, 1, [cls.salt, cls.rice])
+        cls.half, = create_recipes(
+            cls.author, 1, [cls.salt, cls.rice, cls.chicken, cls.onion]
+        )
+        create_recipes(cls.author, 1, [cls.chicken])
+
+    def setUp(self):
+        cache.clear()
+        recipe_match_index.invalidate()
+        self.client = APIClient()
+
+    def match(self, *ingredients, **params):
+        response = self.client.get('/api/recipes/match/', {
+            'ingredients': [ingredient.id for ingredient in ingredients],
+            **params
+        })
+        return response
+
+    def test_ranked_by_coverage(self):
+        data = self.match(self.salt, self.rice).json()
+        self.assertEqual(
+            [(item['id'], item['coverage']) for item in data],
+            [(self.full.id, 1.0), (self.half.id, 0.5)]
+        )
+        self.assertEqual(data[0]['missing_ingredients'], [])
+        self.assertEqual(
+            [item['name'] for item in data[1]['missing_ingredients']],
+            ['курица', 'лук']
+        )
+        self.assertEqual(len(self.match(self.salt, limit=1).json()), 1)
+
+    def test_warm_index_skips_join_table(self):
+        self.match(self.salt)
+        with self.assertNumQueries(2):
+            self.match(self.chicken)
+
+    def test_follows_recipe_changes(self):
+        self.match(self.salt)
+        snapshot = recipe_match_index._snapshot
+        self.client.force_authenticate(self.author)
+        with self.captureOnCommitCallbacks(execute=True):
+            created = self.client.post('/api/recipes/', {
+                'name': 'Лук',
+                'text': 'Описание',
+                'cooking_time': 5,
+                'image': TEST_IMAGE,
+                'ingredients': [{'id': self.onion.id, 'amount': 1}]
+            }, format='json').json()['id']
+            self.client.patch(f'/api/recipes/{created}/', {
+                'ingredients': [
+                    {'id': self.onion.id, 'amount': 1},
+                    {'id': self.salt.id, 'amount': 1},
+                ]
+            }, format='json')
+        data = self.match(self.onion).json()
+        self.assertEqual(
+            [(item['id'], item['coverage']) for item in data],
+            [(created, 0.5), (self.half.id, 0.25)]
+        )
+        self.assertIs(recipe_match_index._snapshot, snapshot)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f'/api/recipes/{created}/')
+        self.assertEqual(
+            [item['id'] for item in self.match(self.onion).json()],
+            [self.half.id]
+        )
+
+    def test_requires_ingredients(self):
+        self.assertEqual(self.match().status_code, 400)
+        self.assertEqual(
+            self.match(self.salt, limit=1000).status_code, 400
+        )
+
+
+class RecommendationTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = create_user('author')
+        cls.chef = create_user('chef')
+        cls.viewer = create_user('viewer')
+        rice, chicken, onion, sugar, flour = Ingredient.objects.bulk_create(
+            Ingredient(name=name, measurement_unit='г')
+            for name in ('рис', 'курица', 'лук', 'сахар', 'мука')
+        )
+        cls.pilaf, = create_recipes(cls.author, 1, [rice, chicken, onion])
+        cls.risotto, = create_recipes(cls.author, 1, [rice, onion])
+        cls.cake, = create_recipes(cls.author, 1, [sugar, flour])
+        cls.soup, = create_recipes(cls.chef, 1, [chicken])
+        create_recipes(cls.viewer, 1, [rice, chicken])
+        for username in ('first', 'second'):
+            user = create_user(username)
+            Favorite.objects.create(user=user, recipe=cls.pilaf)
+            ShoppingCart.objects.create(user=user, recipe=cls.cake)
+        Favorite.objects.create(user=cls.viewer, recipe=cls.pilaf)
+        Follow.objects.create(author=cls.chef, follower=cls.viewer)
+        cls.build()
+
+    @staticmethod
+    def build(**options):
+        out = StringIO()
+        call_command(
+            'build_similarities', max_ingredient_share=1, stdout=out,
+            **options
+        )
+        return out.getvalue()
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+
+    def get(self, path, **params):
+        return self.client.get(path, params)
+
+    def ids(self, path, **params):
+        return [item['id'] for item in self.get(path, **params).json()]
+
+    def test_similar_blends_interactions_and_composition(self):
+        self.assertEqual(
+            self.ids(f'/api/recipes/{self.pilaf.id}/similar/')[:2],
+            [self.cake.id, self.risotto.id]
+        )
+        self.assertEqual(
+            self.ids(f'/api/recipes/{self.pilaf.id}/similar/', limit=1),
+            [self.cake.id]
+        )
+        self.assertEqual(self.get('/api/recipes/0/similar/').status_code, 404)
+
+    def test_warm_similar_skips_similarity_table(self):
+        path = f'/api/recipes/{self.pilaf.id}/similar/'
+        self.get(path)
+        with self.assertNumQueries(1):
+            self.get(path)
+
+    def test_recommended_uses_favorites_and_follows(self):
+        self.client.force_authenticate(self.viewer)
+        ids = self.ids('/api/recipes/recommended/')
+        self.assertEqual(
+            ids[:3], [self.cake.id, self.soup.id, self.risotto.id]
+        )
+        self.assertNotIn(self.pilaf.id, ids)
+        self.assertFalse(
+            Recipe.objects.filter(id__in=ids, author=self.viewer).exists()
+        )
+        with self.assertNumQueries(1):
+            self.get('/api/recipes/recommended/')
+
+    def test_recommended_follows_viewer_actions(self):
+        self.client.force_authenticate(self.viewer)
+        self.get('/api/recipes/recommended/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/api/recipes/{self.cake.id}/favorite/')
+        self.assertNotIn(self.cake.id, self.ids('/api/recipes/recommended/'))
+
+    @override_settings(VIEWER_OVERLAY_TIMEOUT=0)
+    def test_warm_recommendations_skip_join_tables(self):
+        self.client.force_authenticate(self.viewer)
+        tables = {
+            model._meta.db_table for model in (Favorite, ShoppingCart, Follow)
+        }
+
+        def touched():
+            with CaptureQueriesContext(connection) as context:
+                ids = self.ids('/api/recipes/recommended/')
+            return ids, any(
+                table in query['sql'] for table in tables
+                for query in context.captured_queries
+            )
+
+        ids, cold = touched()
+        self.assertTrue(cold)
+        self.assertEqual(touched(), (ids, False))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/api/recipes/{self.soup.id}/shopping_cart/')
+        ids, cold = touched()
+        self.assertTrue(cold)
+        self.assertNotIn(self.soup.id, ids)
+
+    def test_recommended_requires_authentication(self):
+        self.assertEqual(
+            self.get('/api/recipes/recommended/').status_code, 401
+        )
+
+    def test_missing_builds_only_new_recipes(self):
+        self.get(f'/api/recipes/{self.pilaf.id}/similar/')
+        created, = create_recipes(
+            self.author, 1, self.pilaf.ingredients.all()
+        )
+        self.assertIn('рецептов 1,', self.build(missing=True))
+        self.assertTrue(RecipeSimilarity.objects.filter(
+            recipe=created, similar=self.pilaf
+        ).exists())
+        self.build()
+        self.assertIn(
+            created.id, self.ids(f'/api/recipes/{self.pilaf.id}/similar/')
+        )
+
+
+class TokenCacheTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = create_user('user')
+        cls.token = Token.objects.create(user=cls.user)
+
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def me(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/users/me/')
+        looked_up = any(
+            Token._meta.db_table in query['sql']
+            for query in context.captured_queries
+        )
+        return response.status_code, looked_up
+
+    def test_warm_token_skips_auth_query(self):
+        self.assertEqual(self.me(), (200, True))
+        self.assertEqual(self.me(), (200, False))
+
+    def test_invalid_token_is_not_cached(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Token missing')
+        self.assertEqual(self.me(), (401, True))
+        self.assertEqual(self.me(), (401, True))
+
+    def test_logout_revokes_token(self):
+        self.me()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/auth/token/logout/')
+        self.assertEqual(self.me(), (401, True))
+
+    def test_deactivation_revokes_token(self):
+        self.me()
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.get(pk=self.user.pk).save()
+        self.assertEqual(self.me(), (200, True))
+        self.user.is_active = False
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertEqual(self.me(), (401, True))
+
+    def test_password_change_revokes_token(self):
+        self.me()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post('/api/users/set_password/', {
+                'current_password': 'pass-Word-42',
+                'new_password': 'new-Pass-Word-42',
+            }).status_code, 204)
+        self.assertEqual(self.me(), (200, True))
+
+    @override_settings(TOKEN_CACHE_SIZE=1, TOKEN_CACHE_ALIAS='')
+    def test_least_recently_used_token_is_evicted(self):
+        other = Token.objects.create(user=create_user('other'))
+        self.me()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {other.key}')
+        self.assertEqual(self.me(), (200, True))
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.assertEqual(self.me(), (200, True))
+
+    @override_settings(TOKEN_CACHE_TTL=0)
+    def test_disabled_cache(self):
+        self.me()
+        self.assertEqual(self.me(), (200, True))
+
+    def ttl(self, worker=token_cache):
+        return worker._entries[self.token.key][0] - time.monotonic()
+
+    @override_settings(TOKEN_CACHE_ALIAS='')
+    def test_process_local_entries_expire_quickly(self):
+        self.me()
+        self.assertLessEqual(self.ttl(), settings.TOKEN_CACHE_LOCAL_TTL)
+
+    def test_locmem_tier_uses_local_ttl(self):
+        self.me()
+        worker = TokenCache()
+        worker.get(self.token.key)
+        self.assertLessEqual(self.ttl(worker), settings.TOKEN_CACHE_LOCAL_TTL)
+
+    @override_settings(CACHES={'default': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache'
+    }})
+    def test_shared_backend_keeps_full_ttl(self):
+        self.me()
+        self.assertGreater(self.ttl(), settings.TOKEN_CACHE_LOCAL_TTL)
+
+    def test_shared_tier_publishes_revocations(self):
+        self.me()
+        worker = TokenCache()
+        self.assertEqual(worker.get(self.token.key).user, self.user)
+        self.assertIn(self.token.key, worker._entries)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.save()
+        self.assertIsNone(worker.get(self.token.key))
+        self.assertEqual(self.me(), (200, True))
@@ -0,0 +1,50 @@
+from decimal import Decimal
+
+from django.db.models import Case, F, IntegerField, Value, When
+
+UNITS = {
+    'г': ('г', 1),
+    'кг': ('г', 1000),
+    'мл': ('мл', 1),
+    'л': ('мл', 1000),
+    'ч. л.': ('мл', 5),
+    'ст. л.': ('мл', 15),
+    'стакан': ('мл', 250),
+}
+DISPLAY_UNITS = {
+    'г': (('кг', 1000), ('г', 1)),
+    'мл': (('л', 1000), ('мл', 1)),
+}
+METRIC_UNITS = frozenset(
+    unit for units in DISPLAY_UNITS.values() for unit, _ in units
+)
+
+
+def base_unit(field):
+    return Case(
+        *(
+            When(**{field: unit}, then=Value(base))
+            for unit, (base, _) in UNITS.items()
+        ),
+        default=F(field)
+    )
+
+
+def unit_factor(field):
+    return Case(
+        *(
+            When(**{field: unit}, then=Value(factor))
+            for unit, (_, factor) in UNITS.items()
+        ),
+        default=Value(1),
+        output_field=IntegerField()
+    )
+
+
+def display_amount(item):
+    if item['units'] == 1 and item['unit'] not in METRIC_UNITS:
+        return item['amount'], item['unit']
+    for unit, factor in DISPLAY_UNITS.get(item['base'], ()):
+        if item['quantity'] >= factor:
+            return Decimal(item['quantity']) / factor, unit
+    return item['quantity'], item['base']
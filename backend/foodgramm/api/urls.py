@@ -1,9 +1,12 @@
+from django.conf import settings
 from django.urls import include, path
 from rest_framework import routers
 from .views import (
     UserViewSet,
     RecipeViewSet,
     IngredientViewSet,
+    MetricsView,
+    RequestStatsView,
 )
 
 router = routers.SimpleRouter()
@@ -13,7 +16,19 @@ router.register("users", UserViewSet, basename="users")
 
 app_name = "api"
 
-urlpatterns = [
+urlpatterns = []
+if settings.ASYNC_READ_VIEWS:
+    from .async_views import ingredient_list, recipe_detail, recipe_list
+
+    urlpatterns += [
+        path("recipes/", recipe_list, name="recipes-list"),
+        path("recipes/<int:pk>/", recipe_detail, name="recipes-detail"),
+        path("ingredients/", ingredient_list, name="ingredients-list"),
+    ]
+
+urlpatterns += [
     path("", include(router.urls)),
     path("auth/", include("djoser.urls.authtoken")),
+    path("stats/requests/", RequestStatsView.as_view(), name="request-stats"),
+    path("metrics", MetricsView.as_view(), name="metrics"),
 ]
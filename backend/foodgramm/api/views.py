@@ -1,39 +1,68 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.db.models import Sum
-from django.http import FileResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.db import transaction
+from django.db.models import F, Prefetch, Value, Window
+from django.db.models.functions import RowNumber
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
-from django.utils import timezone
 from django.urls import reverse
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.views import UserViewSet as DjoserUserViewSet
 
 from rest_framework import status
 from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
 from rest_framework.permissions import (
+    IsAdminUser,
     IsAuthenticated,
     IsAuthenticatedOrReadOnly
 )
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
+from rest_framework.views import APIView
 from rest_framework.viewsets import ModelViewSet, ReadOnlyModelViewSet
 
+from foodgramm.instrumentation import route_histogram
+from foodgramm.metrics import (
+    SHOPPING_LIST_SECONDS,
+    observe_stream,
+    render_metrics
+)
 from recipe.models import (
+    SEARCH_ORDERING,
     Recipe,
     ShoppingCart,
-    IngredientsInRecipe,
     Favorite,
     Ingredient,
     Follow
 )
+from .cache import RecipeResponseCacheMixin
+from .feed import feed_page
 from .filters import IngredientFilter, RecipeFilter
+from .ingredient_index import ingredient_index
 from .pagination import PaginationLimiter
-from .permissions import IsAuthorOrReadOnly
+from .permissions import HasMetricsToken, IsAuthorOrReadOnly
+from .recipe_match import recipe_match_index
+from .recommendations import recommended_recipe_ids, similar_recipe_ids
 from .serializers import (
     AvatarSerializer,
     FollowedUserSerializer,
     IngredientSerializer,
     RecipeCreateUpdateSerializer,
+    RecipeMatchQuerySerializer,
+    RecipeMatchSerializer,
     RecipeMinifiedSerializer,
-    RecipeSerializer
+    RecipeSerializer,
+    RecommendationQuerySerializer
+)
+from .shopping_list import (
+    SHOPPING_LIST_RENDERERS,
+    ShoppingListNegotiation,
+    ShoppingListRenderer,
+    async_chunks,
+    cart_ingredients,
+    shopping_list_rows
 )
 
 User = get_user_model()
@@ -41,12 +70,31 @@ User = get_user_model()
 
 class UserViewSet(DjoserUserViewSet):
     pagination_class = PaginationLimiter
+    keyset_ordering = ('username', 'id')
     permission_classes = (IsAuthenticatedOrReadOnly,)
 
+    @staticmethod
+    def subscriptions_queryset(follower, recipes_limit):
+        latest = Recipe.objects.annotate(
+            position=Window(
+                RowNumber(),
+                partition_by=F('author_id'),
+                order_by=(F('created_at').desc(), F('id').desc())
+            )
+        ).filter(position__lte=recipes_limit).order_by('-created_at', '-id')
+        return User.objects.filter(
+            authors_subs__follower=follower
+        ).annotate(
+            is_subscribed=Value(True)
+        ).prefetch_related(
+            Prefetch('recipes', queryset=latest, to_attr='latest_recipes')
+        )
+
     @action(detail=False, permission_classes=[IsAuthenticated])
     def subscriptions(self, request):
-        requester = request.user
-        subs = User.objects.filter(authors_subs__follower=requester)
+        subs = self.subscriptions_queryset(
+            request.user, FollowedUserSerializer.get_recipes_limit(request)
+        )
         page = self.paginate_queryset(subs)
         context_serializer = FollowedUserSerializer(
             page, many=True, context={'request': request}
@@ -90,16 +138,19 @@ class UserViewSet(DjoserUserViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+        author.is_subscribed = True
         serialized = FollowedUserSerializer(author, context={'request': req})
         return Response(serialized.data, status=status.HTTP_201_CREATED)
 
     def handle_subscription_delete(self, follower, author):
-        sub = get_object_or_404(
-            Follow,
-            follower=follower,
-            author=author
-        )
-        sub.delete()
+        with transaction.atomic():
+            # Повторный DELETE ждёт блокировку и получает 404, а не второе
+            # списание счётчика в приёмнике post_delete.
+            get_object_or_404(
+                Follow.objects.select_for_update(),
+                follower=follower,
+                author=author
+            ).delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=False, url_path='me/avatar',
@@ -118,14 +169,24 @@ class UserViewSet(DjoserUserViewSet):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class RecipeViewSet(ModelViewSet):
+class RecipeViewSet(RecipeResponseCacheMixin, ModelViewSet):
     queryset = Recipe.objects.all()
     serializer_class = RecipeSerializer
     filter_backends = (DjangoFilterBackend,)
     filterset_class = RecipeFilter
     pagination_class = PaginationLimiter
+    keyset_ordering = ('-created_at', '-id')
     permission_classes = (IsAuthenticatedOrReadOnly, IsAuthorOrReadOnly,)
 
+    def get_queryset(self):
+        return Recipe.objects.with_user_state(self.request.user)
+
+    @classmethod
+    def get_keyset_ordering(cls, request):
+        if request.query_params.get('search'):
+            return SEARCH_ORDERING
+        return cls.keyset_ordering
+
     def get_serializer_class(self):
         if self.action in ['create', 'partial_update']:
             return RecipeCreateUpdateSerializer
@@ -134,46 +195,119 @@ class RecipeViewSet(ModelViewSet):
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
 
-    def generate_shopping_list(self, profile):
-        components = IngredientsInRecipe.objects.filter(
-            recipe__shoppingcarts__user=profile
-        ).values(
-            'ingredient__name',
-            'ingredient__measurement_unit'
-        ).annotate(total=Sum('amount')).order_by('ingredient__name')
-
-        dishes = Recipe.objects.filter(shoppingcarts__user=profile)
-        output = []
-        timestamp = timezone.now().strftime('%d-%m-%Y %H:%M')
-        output.append(f'Список покупок на {timestamp}\n')
-        output.append('\nРецепты:')
-
-        for dish in dishes:
-            output.append(f'- {dish.name} (Автор: {dish.author.username})')
-        output.append('\nИнгредиенты:')
-        for idx, item in enumerate(components, 1):
-            unit = item['ingredient__measurement_unit']
-            quantity = item['total']
-            name = item['ingredient__name'].capitalize()
-            output.append(f'{idx}. {name} ({unit}) — {quantity}')
-
-        return '\n'.join(output)
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(
+            request, response, *args, **kwargs
+        )
+        # Список покупок отдаётся потоком, а Response здесь — только ошибка:
+        # её тело JSON, что бы ни выбрал ?format.
+        if isinstance(response, Response) and isinstance(
+            response.accepted_renderer, ShoppingListRenderer
+        ):
+            response.accepted_renderer = JSONRenderer()
+            response.accepted_media_type = JSONRenderer.media_type
+        return response
+
+    @action(detail=False, permission_classes=[IsAuthenticated])
+    def feed(self, request):
+        paginator = self.paginator
+        page = paginator.paginate_keyset(
+            request, Recipe, self.keyset_ordering,
+            lambda cursor, limit: feed_page(
+                request.user, cursor, limit, paginator.keyset_filter
+            )
+        )
+        serializer = self.get_serializer(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=False, methods=['get'])
+    def match(self, request):
+        params = RecipeMatchQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        found = recipe_match_index.match(
+            params.validated_data['ingredients'],
+            params.validated_data['limit']
+        )
+        recipes = Recipe.objects.in_bulk([pk for pk, _, _ in found])
+        ingredients = Ingredient.objects.in_bulk({
+            ingredient_id
+            for _, _, missing in found for ingredient_id in missing
+        })
+        matched = []
+        for pk, coverage, missing in found:
+            recipe = recipes.get(pk)
+            if recipe is None:
+                continue
+            recipe.coverage = coverage
+            recipe.missing_ingredients = sorted(
+                (
+                    ingredients[ingredient_id] for ingredient_id in missing
+                    if ingredient_id in ingredients
+                ),
+                key=lambda ingredient: ingredient.name
+            )
+            matched.append(recipe)
+        return Response(RecipeMatchSerializer(
+            matched, many=True, context={'request': request}
+        ).data)
+
+    def recommendation_response(self, request, ids):
+        params = RecommendationQuerySerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        ids = ids[:params.validated_data['limit']]
+        recipes = Recipe.objects.in_bulk(ids)
+        return Response(RecipeMinifiedSerializer(
+            [recipes[pk] for pk in ids if pk in recipes],
+            many=True, context={'request': request}
+        ).data)
+
+    @action(detail=True, methods=['get'])
+    def similar(self, request, pk=None):
+        try:
+            recipe_id = int(pk)
+        except ValueError:
+            raise NotFound
+        ids = similar_recipe_ids(recipe_id)
+        if not ids:
+            get_object_or_404(Recipe, pk=recipe_id)
+        return self.recommendation_response(request, ids)
 
     @action(detail=False, methods=['get'],
-            permission_classes=[IsAuthenticated]
+            permission_classes=[IsAuthenticated])
+    def recommended(self, request):
+        return self.recommendation_response(
+            request, recommended_recipe_ids(request.user)
+        )
+
+    @action(detail=False, methods=['get'],
+            permission_classes=[IsAuthenticated],
+            renderer_classes=SHOPPING_LIST_RENDERERS,
+            content_negotiation_class=ShoppingListNegotiation
             )
     def download_shopping_cart(self, request):
-        data = self.generate_shopping_list(request.user)
-        resp = FileResponse(data, as_attachment=True,
-                            filename='shopping_list.txt'
-                            )
+        renderer = request.accepted_renderer
+        content = observe_stream(
+            SHOPPING_LIST_SECONDS,
+            renderer.stream(shopping_list_rows(request.user)),
+            renderer.format
+        )
+        if isinstance(request._request, ASGIRequest):
+            content = async_chunks(content)
+        content_type = renderer.media_type
+        if renderer.charset:
+            content_type += f'; charset={renderer.charset}'
+        resp = StreamingHttpResponse(content, content_type=content_type)
+        resp['Content-Disposition'] = (
+            f'attachment; filename="shopping_list.{renderer.format}"'
+        )
         return resp
 
     def include_recipe_in(self, profile, recipe, model):
+        # Счётчик избранного и итоги корзины ведут сигналы
+        # (recipe/signals.py).
         obj, created = model.objects.get_or_create(
             user=profile,
             recipe=recipe
-
         )
 
         if not created:
@@ -186,8 +320,13 @@ class RecipeViewSet(ModelViewSet):
         return Response(serialized.data, status=status.HTTP_201_CREATED)
 
     def exclude_recipe_from(self, profile, recipe, model):
-        entry = get_object_or_404(model, user=profile, recipe=recipe)
-        entry.delete()
+        with transaction.atomic():
+            # Повторный DELETE ждёт блокировку и получает 404, а не второе
+            # списание в приёмниках post_delete.
+            entry = get_object_or_404(
+                model.objects.select_for_update(), user=profile, recipe=recipe
+            )
+            entry.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     def modify_recipe_relation(self, req, pk):
@@ -213,6 +352,20 @@ class RecipeViewSet(ModelViewSet):
     def shopping_cart(self, request, pk=None):
         return self.modify_recipe_relation(request, pk)
 
+    @action(detail=False, methods=['get'], url_path='shopping_cart/summary',
+            permission_classes=[IsAuthenticated]
+            )
+    def shopping_cart_summary(self, request):
+        return Response([
+            {
+                'id': item['ingredient_id'],
+                'name': item['name'],
+                'measurement_unit': item['measurement_unit'],
+                'amount': item['total'],
+            }
+            for item in cart_ingredients(request.user)
+        ])
+
     @action(detail=True, methods=["get"], url_path="get-link")
     def get_short_link(self, request, pk=None):
         path = reverse('recipe:recipe_short_link', kwargs={'pk': pk})
@@ -226,3 +379,32 @@ class IngredientViewSet(ReadOnlyModelViewSet):
     pagination_class = None
     filter_backends = (DjangoFilterBackend,)
     filterset_class = IngredientFilter
+
+    def list(self, request, *args, **kwargs):
+        name = request.query_params.get('name')
+        if not name:
+            return super().list(request, *args, **kwargs)
+        return HttpResponse(
+            ingredient_index.render(name, settings.INGREDIENT_SEARCH_LIMIT),
+            content_type='application/json'
+        )
+
+
+class RequestStatsView(APIView):
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return Response(route_histogram.snapshot())
+
+    def delete(self, request):
+        route_histogram.reset()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class MetricsView(APIView):
+    authentication_classes = ()
+    permission_classes = (HasMetricsToken,)
+
+    def get(self, request):
+        content, content_type = render_metrics()
+        return HttpResponse(content, content_type=content_type)
@@ -0,0 +1,294 @@
+import bisect
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from .metrics import REQUEST_DB_TIME, REQUEST_LATENCY, REQUEST_QUERIES
+
+logger = logging.getLogger('foodgramm.requests')
+
+_current = ContextVar('request_stats', default=None)
+
+PLACEHOLDER_LIST = re.compile(r'\((?:%s|\?)(?:,\s*(?:%s|\?))+\)')
+LATENCY_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+
+def fingerprint(sql):
+    normalized = PLACEHOLDER_LIST.sub('(...)', sql)
+    return hashlib.md5(normalized.encode()).hexdigest()[:12], normalized
+
+
+class RequestStats:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.timings = defaultdict(float)
+        self.active = set()
+        self.statements = {}
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - started
+            self.queries += 1
+            key, normalized = fingerprint(sql)
+            self.statements.setdefault(key, normalized)
+            self.fingerprints[key] += 1
+
+    def duplicates(self, limit=3):
+        return [
+            {'fingerprint': key, 'count': count,
+             'sql': self.statements[key][:200]}
+            for key, count in self.fingerprints.most_common(limit)
+            if count > 1
+        ]
+
+    @property
+    def total(self):
+        return time.perf_counter() - self.started
+
+
+@contextmanager
+def timed(name):
+    stats = _current.get()
+    if stats is None or name in stats.active:
+        yield
+        return
+    stats.active.add(name)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats.timings[name] += time.perf_counter() - started
+        stats.active.discard(name)
+
+
+def record_query(execute, sql, params, many, context):
+    # Обёртка одна на соединение, а запрос приписывается статистике из
+    # контекста: под ASGI соединение потока для sync-кода делят запросы,
+    # которые выполняются одновременно.
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    return stats(execute, sql, params, many, context)
+
+
+def install_wrapper(connection):
+    if record_query not in connection.execute_wrappers:
+        # В начало списка, чтобы не сломать pop() у execute_wrapper(),
+        # если соединение открылось внутри него.
+        connection.execute_wrappers.insert(0, record_query)
+
+
+@receiver(connection_created)
+def wrap_new_connection(sender, connection, **kwargs):
+    install_wrapper(connection)
+
+
+@contextmanager
+def recording(stats):
+    for connection in connections.all():
+        install_wrapper(connection)
+    token = _current.set(stats)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+class RouteHistogram:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def new_route(self):
+        return {
+            'count': 0,
+            'latency_ms': [0] * (len(LATENCY_BUCKETS) + 1),
+            'queries': [0] * (len(QUERY_BUCKETS) + 1),
+            'total_ms': 0.0,
+            'db_ms': 0.0,
+            'serializer_ms': 0.0,
+            'query_count': 0,
+            'max_queries': 0,
+            'n_plus_one': 0,
+        }
+
+    def add(self, route, total, stats, duplicated):
+        total_ms = total * 1000
+        with self.lock:
+            data = self.routes.get(route)
+            if data is None:
+                data = self.routes[route] = self.new_route()
+            data['count'] += 1
+            data['latency_ms'][
+                bisect.bisect_left(LATENCY_BUCKETS, total_ms)
+            ] += 1
+            data['queries'][
+                bisect.bisect_left(QUERY_BUCKETS, stats.queries)
+            ] += 1
+            data['total_ms'] += total_ms
+            data['db_ms'] += stats.db_time * 1000
+            data['serializer_ms'] += stats.timings.get('serializer', 0) * 1000
+            data['query_count'] += stats.queries
+            data['max_queries'] = max(data['max_queries'], stats.queries)
+            data['n_plus_one'] += bool(duplicated)
+
+    def snapshot(self):
+        with self.lock:
+            routes = {
+                route: dict(data, latency_ms=list(data['latency_ms']),
+                            queries=list(data['queries']))
+                for route, data in self.routes.items()
+            }
+        return {
+            'latency_buckets_ms': list(LATENCY_BUCKETS),
+            'query_buckets': list(QUERY_BUCKETS),
+            'routes': routes,
+        }
+
+    def reset(self):
+        with self.lock:
+            self.routes.clear()
+
+
+route_histogram = RouteHistogram()
+
+
+def route_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    view = getattr(match.func, 'cls', None)
+    actions = getattr(match.func, 'actions', None) or {}
+    if view is None:
+        return match.view_name or match.func.__name__
+    action = actions.get(request.method.lower(), request.method.lower())
+    return f'{view.__name__}.{action}'
+
+
+class RequestStatsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        stats = RequestStats()
+        with recording(stats):
+            response = self.get_response(request)
+        return self.respond(request, response, stats)
+
+    async def __acall__(self, request):
+        # Соединения потоков async ORM получают обёртку при открытии
+        # (connection_created), а sync_to_async копирует контекст с _current.
+        stats = RequestStats()
+        token = _current.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.respond(request, response, stats)
+
+    def respond(self, request, response, stats):
+        # Потоковый ответ учитывается, когда тело отдано целиком.
+        if not response.streaming:
+            self.finish(request, response, stats)
+        elif response.is_async:
+            response.streaming_content = self.astream(
+                request, response, stats, response.streaming_content
+            )
+        else:
+            response.streaming_content = self.stream(
+                request, response, stats, response.streaming_content
+            )
+        if settings.SERVER_TIMING:
+            response['Server-Timing'] = self.server_timing(stats)
+        return response
+
+    def stream(self, request, response, stats, content):
+        with recording(stats):
+            yield from content
+        self.finish(request, response, stats)
+
+    async def astream(self, request, response, stats, content):
+        # Шаги асинхронного генератора могут идти в разных контекстах,
+        # поэтому _current ставится и снимается на каждый фрагмент.
+        content = aiter(content)
+        while True:
+            token = _current.set(stats)
+            try:
+                chunk = await anext(content)
+            except StopAsyncIteration:
+                break
+            finally:
+                _current.reset(token)
+            yield chunk
+        self.finish(request, response, stats)
+
+    def server_timing(self, stats):
+        metrics = [
+            f'db;dur={stats.db_time * 1000:.1f};desc="{stats.queries} queries"'
+        ]
+        metrics.extend(
+            f'{name};dur={value * 1000:.1f}'
+            for name, value in stats.timings.items()
+        )
+        metrics.append(f'total;dur={stats.total * 1000:.1f}')
+        return ', '.join(metrics)
+
+    def finish(self, request, response, stats):
+        total = stats.total
+        route = route_name(request)
+        duplicated = stats.duplicates()
+        route_histogram.add(route, total, stats, duplicated)
+        REQUEST_LATENCY.labels(
+            route, request.method, response.status_code
+        ).observe(total)
+        REQUEST_QUERIES.labels(route).observe(stats.queries)
+        REQUEST_DB_TIME.labels(route).observe(stats.db_time)
+        if (total * 1000 >= settings.SLOW_REQUEST_MS
+                or stats.queries >= settings.HEAVY_REQUEST_QUERIES):
+            level = logging.WARNING
+        else:
+            level = logging.INFO
+        if not logger.isEnabledFor(level):
+            return
+        logger.log(level, json.dumps({
+            'route': route,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 2),
+            'db_ms': round(stats.db_time * 1000, 2),
+            'queries': stats.queries,
+            **{
+                f'{name}_ms': round(value * 1000, 2)
+                for name, value in stats.timings.items()
+            },
+            'duplicates': duplicated,
+        }, ensure_ascii=False))
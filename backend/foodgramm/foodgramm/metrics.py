@@ -0,0 +1,67 @@
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess
+)
+
+REQUEST_LATENCY = Histogram(
+    'foodgramm_request_duration_seconds',
+    'Время обработки запроса',
+    ('route', 'method', 'status'),
+    buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+)
+REQUEST_QUERIES = Histogram(
+    'foodgramm_request_queries',
+    'Число SQL-запросов на один HTTP-запрос',
+    ('route',),
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100)
+)
+REQUEST_DB_TIME = Histogram(
+    'foodgramm_request_db_seconds',
+    'Время SQL-запросов на один HTTP-запрос',
+    ('route',),
+    buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1)
+)
+CACHE_REQUESTS = Counter(
+    'foodgramm_cache_requests',
+    'Обращения к кешам',
+    ('cache', 'result')
+)
+IMAGE_UPLOAD_BYTES = Histogram(
+    'foodgramm_image_upload_bytes',
+    'Размер загруженных изображений после декодирования',
+    ('field',),
+    buckets=tuple(2 ** power for power in range(14, 25))
+)
+SHOPPING_LIST_SECONDS = Histogram(
+    'foodgramm_shopping_list_seconds',
+    'Время формирования списка покупок',
+    ('format',),
+    buckets=(.01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+)
+
+
+def cache_result(cache, hit):
+    CACHE_REQUESTS.labels(cache, 'hit' if hit else 'miss').inc()
+
+
+def observe_stream(histogram, content, *labels):
+    started = time.perf_counter()
+    yield from content
+    histogram.labels(*labels).observe(time.perf_counter() - started)
+
+
+def render_metrics():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
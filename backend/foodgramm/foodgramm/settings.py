@@ -27,6 +27,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'django_filters',
     'rest_framework.authtoken',
@@ -36,6 +37,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'foodgramm.instrumentation.RequestStatsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -79,6 +81,49 @@ DATABASES = {
     }
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND',
+            'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'foodgramm'),
+    }
+}
+
+RECIPE_CACHE_ALIAS = 'default'
+RECIPE_CACHE_TIMEOUT = int(os.getenv('RECIPE_CACHE_TIMEOUT', 60))
+VIEWER_OVERLAY_TIMEOUT = int(os.getenv('VIEWER_OVERLAY_TIMEOUT', 0))
+
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'True').lower() == 'true'
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+# Журнал foodgramm.requests пишет медленные запросы и запросы с большим
+# числом обращений к БД с уровнем WARNING, остальные — с INFO (по умолчанию
+# не выводятся).
+SLOW_REQUEST_MS = int(os.getenv('SLOW_REQUEST_MS', 500))
+HEAVY_REQUEST_QUERIES = int(os.getenv('HEAVY_REQUEST_QUERIES', 20))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'plain': {'format': '%(message)s'},
+    },
+    'handlers': {
+        'requests': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'plain',
+        },
+    },
+    'loggers': {
+        'foodgramm.requests': {
+            'handlers': ['requests'],
+            'level': os.getenv('REQUEST_LOG_LEVEL', 'WARNING'),
+            'propagate': False,
+        },
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -104,7 +149,7 @@ REST_FRAMEWORK = {
     ],
 
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachingTokenAuthentication',
     ],
 
     'DEFAULT_PAGINATION_CLASS': 'api.pagination.PaginationLimiter',
@@ -144,6 +189,57 @@ STATIC_ROOT = BASE_DIR / 'collected_static/static'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+IMAGE_UPLOAD_MAX_SIZE = int(os.getenv('IMAGE_UPLOAD_MAX_SIZE', 10 * 1024 ** 2))
+IMAGE_UPLOAD_MEMORY_SIZE = 1024 ** 2
+IMAGE_MAX_PIXELS = int(os.getenv('IMAGE_MAX_PIXELS', 40_000_000))
+
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', 2))
+IMAGE_RENDITION_FORMAT = os.getenv('IMAGE_RENDITION_FORMAT', 'WEBP')
+IMAGE_RENDITIONS = {
+    'thumbnail': (160, 160),
+    'card': (600, 600),
+}
+
+INGREDIENT_INDEX_TTL = int(os.getenv('INGREDIENT_INDEX_TTL', 300))
+INGREDIENT_SEARCH_LIMIT = int(os.getenv('INGREDIENT_SEARCH_LIMIT', 50))
+SUBSCRIPTION_RECIPES_LIMIT = int(
+    os.getenv('SUBSCRIPTION_RECIPES_LIMIT', 50)
+)
+FEED_FANOUT_MAX_FOLLOWS = int(os.getenv('FEED_FANOUT_MAX_FOLLOWS', 200))
+FEED_TIMELINE_SIZE = int(os.getenv('FEED_TIMELINE_SIZE', 500))
+FEED_TIMELINE_TIMEOUT = int(os.getenv('FEED_TIMELINE_TIMEOUT', 3600))
+# Асинхронные GET для списка и карточки рецепта, поиска ингредиентов и
+# коротких ссылок; имеет смысл только под ASGI-сервером (uvicorn).
+ASYNC_READ_VIEWS = os.getenv('ASYNC_READ_VIEWS', 'False').lower() == 'true'
+RECIPE_MATCH_LIMIT = int(os.getenv('RECIPE_MATCH_LIMIT', 50))
+RECIPE_MATCH_MAX_CHANGES = int(os.getenv('RECIPE_MATCH_MAX_CHANGES', 1000))
+# Число хранимых похожих рецептов и верхняя граница limit у рекомендаций.
+RECOMMENDATION_LIMIT = int(os.getenv('RECOMMENDATION_LIMIT', 50))
+RECOMMENDATION_MAX_SEEDS = int(os.getenv('RECOMMENDATION_MAX_SEEDS', 200))
+RECOMMENDATION_CACHE_TIMEOUT = int(
+    os.getenv('RECOMMENDATION_CACHE_TIMEOUT', 3600)
+)
+RECOMMENDATION_COOCCURRENCE_WEIGHT = float(
+    os.getenv('RECOMMENDATION_COOCCURRENCE_WEIGHT', 0.7)
+)
+RECOMMENDATION_FOLLOW_BOOST = float(
+    os.getenv('RECOMMENDATION_FOLLOW_BOOST', 0.5)
+)
+# Кеш токенов авторизации: 0 в TOKEN_CACHE_TTL отключает его. Кеш
+# TOKEN_CACHE_ALIAS хранит общий уровень и журнал отзыва токенов, но другим
+# процессам он виден, только если бэкенд общий (Redis, Memcached). Без
+# алиаса или с LocMemCache записи в процессе живут TOKEN_CACHE_LOCAL_TTL:
+# столько секунд остальные воркеры gunicorn ещё принимают отозванный токен.
+TOKEN_CACHE_TTL = int(os.getenv('TOKEN_CACHE_TTL', 60))
+TOKEN_CACHE_LOCAL_TTL = int(os.getenv('TOKEN_CACHE_LOCAL_TTL', 5))
+TOKEN_CACHE_SIZE = int(os.getenv('TOKEN_CACHE_SIZE', 10000))
+TOKEN_CACHE_ALIAS = os.getenv('TOKEN_CACHE_ALIAS', 'default')
+
+SHOPPING_LIST_PDF_FONT = os.getenv(
+    'SHOPPING_LIST_PDF_FONT',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
+)
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
 
@@ -12,19 +12,18 @@ from .models import User
 
 @admin.register(User)
 class UserAdmin(admin.ModelAdmin):
-    list_display = ('username', 'email', 'first_name', 'last_name')
+    list_display = (
+        'username', 'email', 'first_name', 'last_name',
+        'recipes_count', 'followers_count'
+    )
     search_fields = ('username', 'email')
 
 
 @admin.register(Ingredient)
 class IngredientAdmin(admin.ModelAdmin):
-    list_display = ("pk", "name", "measurement_unit", "get_recipe_count")
+    list_display = ("pk", "name", "measurement_unit", "recipes_count")
     search_fields = ("name",)
 
-    @admin.display(description="Используется в рецептах")
-    def get_recipe_count(self, obj):
-        return obj.ingredients_in_recipe.count()
-
 
 class IngredientInRecipeInline(admin.TabularInline):
     model = IngredientsInRecipe
@@ -88,7 +87,7 @@ class RecipeAdmin(admin.ModelAdmin):
         "name",
         "cooking_time",
         "author",
-        "get_favorites",
+        "favorites_count",
         "get_ingredients_list",
         "get_image_preview",
         "created_at",
@@ -97,10 +96,6 @@ class RecipeAdmin(admin.ModelAdmin):
     list_filter = ("author", CookingTimeFilter)
     inlines = [IngredientInRecipeInline]
 
-    @admin.display(description="В избранном")
-    def get_favorites(self, obj):
-        return obj.favorites.count()
-
     @admin.display(description="Ингредиенты")
     def get_ingredients_list(self, obj):
         ingredients = [
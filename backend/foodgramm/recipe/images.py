@@ -0,0 +1,161 @@
+import io
+import logging
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, connection, transaction
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+RENDITIONS_DIR = 'renditions'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class InlineExecutor:
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as error:
+            future.set_exception(error)
+        return future
+
+
+class WorkerExecutor(ThreadPoolExecutor):
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(process_image_in_worker, fn, *args, **kwargs)
+
+
+def get_executor():
+    global _executor
+    if not settings.IMAGE_WORKERS:
+        return InlineExecutor()
+    with _executor_lock:
+        if _executor is None:
+            _executor = WorkerExecutor(
+                max_workers=settings.IMAGE_WORKERS,
+                thread_name_prefix='images'
+            )
+    return _executor
+
+
+def render_renditions(data):
+    image_format = settings.IMAGE_RENDITION_FORMAT
+    with Image.open(io.BytesIO(data)) as source:
+        source.load()
+        source = ImageOps.exif_transpose(source)
+        if image_format == 'JPEG':
+            source = source.convert('RGB')
+        for name, size in settings.IMAGE_RENDITIONS.items():
+            rendition = source.copy()
+            rendition.thumbnail(size)
+            buffer = io.BytesIO()
+            rendition.save(buffer, image_format, quality=80)
+            yield name, buffer.getvalue()
+
+
+def rendition_path(source, name):
+    stem = os.path.splitext(os.path.basename(source))[0]
+    extension = settings.IMAGE_RENDITION_FORMAT.lower()
+    return f'{RENDITIONS_DIR}/{stem}_{name}.{extension}'
+
+
+def rendition_files(renditions):
+    return {
+        path for name, path in renditions.items()
+        if name not in ('source', 'failed')
+    }
+
+
+def delete_files(storage, paths):
+    for path in paths:
+        try:
+            storage.delete(path)
+        except OSError:
+            logger.warning('Не удалось удалить копию изображения %s', path)
+
+
+def process_image(model, pk, field_name, source):
+    """Строит копии изображения source и удаляет копии прежнего.
+
+    Пустой source означает, что изображение убрали: остаётся только
+    удалить старые копии.
+    """
+    try:
+        instance = model.objects.filter(pk=pk).first()
+        if instance is None:
+            return
+        image = getattr(instance, field_name)
+        if (image.name or None) != source:
+            return
+        previous = getattr(instance, f'{field_name}_renditions')
+        if not source and not previous:
+            return
+        renditions = {'source': source} if source else {}
+        try:
+            if source:
+                with image.open('rb'):
+                    data = image.read()
+                for name, content in render_renditions(data):
+                    renditions[name] = image.storage.save(
+                        rendition_path(source, name), ContentFile(content)
+                    )
+        except (OSError, ValueError):
+            logger.warning('Не удалось обработать изображение %s', source)
+            renditions['failed'] = True
+        setattr(instance, f'{field_name}_renditions', renditions)
+        instance.save(update_fields=[f'{field_name}_renditions'])
+        delete_files(
+            image.storage,
+            rendition_files(previous) - rendition_files(renditions)
+        )
+    except Exception:
+        logger.exception('Ошибка обработки изображения %s', source)
+
+
+def process_image_in_worker(fn, *args, **kwargs):
+    close_old_connections()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        connection.close()
+
+
+def schedule_renditions(instance, field_name, update_fields=None):
+    if update_fields is not None and field_name not in update_fields:
+        return
+    source = getattr(instance, field_name).name or None
+    renditions = getattr(instance, f'{field_name}_renditions')
+    # Копии в памяти могут отставать от базы (объект из кеша токенов), поэтому
+    # убранное изображение всегда проверяет обработчик.
+    if source and renditions.get('source') == source:
+        return
+    model, pk = type(instance), instance.pk
+    transaction.on_commit(
+        lambda: get_executor().submit(
+            process_image, model, pk, field_name, source
+        )
+    )
+
+
+def delete_renditions(instance, field_name):
+    storage = getattr(instance, field_name).storage
+    paths = rendition_files(getattr(instance, f'{field_name}_renditions'))
+    if paths:
+        transaction.on_commit(lambda: delete_files(storage, paths))
+
+
+def rendition_url(image, renditions, name):
+    if not image:
+        return None
+    if renditions.get('source') == image.name and name in renditions:
+        return image.storage.url(renditions[name])
+    return image.url
@@ -0,0 +1,141 @@
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.core.management import BaseCommand, CommandError, call_command
+from django.db import transaction
+
+from recipe.models import (
+    Favorite,
+    Follow,
+    Ingredient,
+    IngredientsInRecipe,
+    Recipe,
+    ShoppingCart,
+    User
+)
+
+UNITS = ('г', 'мл', 'шт.', 'ч. л.', 'ст. л.')
+WORDS = (
+    'курица', 'рис', 'томат', 'сыр', 'грибы', 'тыква', 'лосось', 'шпинат',
+    'чечевица', 'баклажан', 'яблоко', 'творог', 'говядина', 'перец', 'лук',
+)
+
+
+class Command(BaseCommand):
+    help = 'Создаёт синтетических пользователей, рецепты, избранное и подписки'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--recipes-per-user', type=int, default=10)
+        parser.add_argument('--ingredients', type=int, default=2000)
+        parser.add_argument('--ingredients-per-recipe', type=int, default=8)
+        parser.add_argument('--favorites-per-user', type=int, default=30)
+        parser.add_argument('--cart-per-user', type=int, default=5)
+        parser.add_argument('--follows-per-user', type=int, default=20)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def create_ingredients(self, count, batch_size):
+        missing = count - Ingredient.objects.count()
+        if missing > 0:
+            Ingredient.objects.bulk_create(
+                (
+                    Ingredient(
+                        name=f'{self.random.choice(WORDS)} {idx}',
+                        measurement_unit=self.random.choice(UNITS)
+                    ) for idx in range(missing)
+                ),
+                batch_size=batch_size,
+                ignore_conflicts=True
+            )
+        return list(Ingredient.objects.values_list('pk', flat=True))
+
+    def create_users(self, count, batch_size):
+        prefix = f'gen{self.seed}_'
+        if User.objects.filter(username__startswith=prefix).exists():
+            raise CommandError(
+                f'Данные с --seed {self.seed} уже созданы, выберите другой'
+            )
+        password = make_password('generated-Pass-42')
+        return User.objects.bulk_create(
+            (
+                User(
+                    username=f'{prefix}{idx}',
+                    email=f'{prefix}{idx}@example.com',
+                    first_name=f'Имя {idx}',
+                    last_name=f'Фамилия {idx}',
+                    password=password
+                ) for idx in range(count)
+            ),
+            batch_size=batch_size
+        )
+
+    def create_recipes(self, users, per_user, batch_size):
+        return Recipe.objects.bulk_create(
+            (
+                Recipe(
+                    author=user,
+                    name=' '.join(self.random.sample(WORDS, 3)).capitalize(),
+                    text='Сгенерированный рецепт',
+                    cooking_time=self.random.randint(5, 180),
+                    image='recipe_pic/generated.png'
+                ) for user in users for _ in range(per_user)
+            ),
+            batch_size=batch_size
+        )
+
+    def sample(self, population, count):
+        return self.random.sample(population, min(count, len(population)))
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        self.seed = options['seed']
+        self.random = random.Random(self.seed)
+        batch_size = options['batch_size']
+
+        ingredients = self.create_ingredients(
+            options['ingredients'], batch_size
+        )
+        users = self.create_users(options['users'], batch_size)
+        recipes = self.create_recipes(
+            users, options['recipes_per_user'], batch_size
+        )
+        IngredientsInRecipe.objects.bulk_create(
+            (
+                IngredientsInRecipe(
+                    recipe=recipe,
+                    ingredient_id=ingredient_id,
+                    amount=self.random.randint(1, 500)
+                )
+                for recipe in recipes
+                for ingredient_id in self.sample(
+                    ingredients, options['ingredients_per_recipe']
+                )
+            ),
+            batch_size=batch_size
+        )
+        for model, per_user in (
+            (Favorite, options['favorites_per_user']),
+            (ShoppingCart, options['cart_per_user']),
+        ):
+            model.objects.bulk_create(
+                (
+                    model(user=user, recipe=recipe)
+                    for user in users
+                    for recipe in self.sample(recipes, per_user)
+                ),
+                batch_size=batch_size
+            )
+        Follow.objects.bulk_create(
+            (
+                Follow(follower=user, author=author)
+                for user in users
+                for author in self.sample(users, options['follows_per_user'])
+                if author != user
+            ),
+            batch_size=batch_size
+        )
+        call_command('recount', stdout=self.stdout)
+        self.stdout.write(
+            f'Создано: {len(users)} пользователей, {len(recipes)} рецептов'
+        )
@@ -1,31 +1,170 @@
-import os
+import csv
 import json
+import os
+import time
+from itertools import islice
 
 from django.conf import settings
-from django.core.management import BaseCommand
+from django.core.management import BaseCommand, CommandError
+from django.db import connection, transaction
+
 from recipe.models import Ingredient
 
+NAME_LENGTH = Ingredient._meta.get_field('name').max_length
+UNIT_LENGTH = Ingredient._meta.get_field('measurement_unit').max_length
+
+
+def read_json(file, chunk_size=64 * 1024):
+    decoder = json.JSONDecoder()
+    buffer, position, started, eof = '', 0, False, False
+    while True:
+        if not eof and len(buffer) - position < chunk_size:
+            chunk = file.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise CommandError('Неожиданный конец JSON-файла')
+            continue
+        if not started:
+            if buffer[position] != '[':
+                raise CommandError('JSON-файл должен содержать список')
+            started = True
+            position += 1
+            continue
+        if buffer[position] == ']':
+            return
+        try:
+            item, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError as error:
+            if eof:
+                raise CommandError(f'Некорректный JSON: {error}')
+            chunk = file.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+            continue
+        if isinstance(item, dict):
+            yield item.get('name'), item.get('measurement_unit')
+        else:
+            yield None, None
+
+
+def read_csv(file):
+    for row in csv.reader(file):
+        if row:
+            yield (row + [None])[:2]
+
+
+READERS = {'json': read_json, 'csv': read_csv}
+
+
+def clean_rows(rows):
+    for name, unit in rows:
+        if not isinstance(name, str) or not isinstance(unit, str):
+            yield None
+            continue
+        name, unit = name.strip(), unit.strip()
+        if (not name or not unit or len(name) > NAME_LENGTH
+                or len(unit) > UNIT_LENGTH):
+            yield None
+            continue
+        yield name, unit
+
+
+def batched(rows, size):
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+def insert_batch(keys):
+    existing = set(Ingredient.objects.filter(
+        name__in={name for name, _ in keys}
+    ).values_list('name', 'measurement_unit'))
+    new = [key for key in keys if key not in existing]
+    Ingredient.objects.bulk_create(
+        (Ingredient(name=name, measurement_unit=unit) for name, unit in new),
+        ignore_conflicts=True
+    )
+    return len(new)
+
+
+def copy_batch(keys):
+    table = Ingredient._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'CREATE TEMPORARY TABLE IF NOT EXISTS ingredient_import '
+            '(name varchar(128), measurement_unit varchar(64)) '
+            'ON COMMIT DROP'
+        )
+        cursor.execute('TRUNCATE ingredient_import')
+        with cursor.cursor.copy(
+            'COPY ingredient_import (name, measurement_unit) FROM STDIN'
+        ) as copy:
+            for key in keys:
+                copy.write_row(key)
+        cursor.execute(
+            f'INSERT INTO {table} (name, measurement_unit, recipes_count) '
+            'SELECT name, measurement_unit, 0 FROM ingredient_import '
+            'ON CONFLICT (name, measurement_unit) DO NOTHING'
+        )
+        return cursor.rowcount
+
 
 class Command(BaseCommand):
-    help = 'Добавляет ингредиенты в БД'
+    help = 'Загружает ингредиенты из JSON- или CSV-файлов'
 
-    def handle(self, *args, **options):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'paths', nargs='*', default=[
+                os.path.join(settings.BASE_DIR, 'data', 'ingredients.json')
+            ]
+        )
+        parser.add_argument('--format', choices=READERS)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument(
+            '--copy', action='store_true',
+            help='Загружать через COPY (только PostgreSQL)'
+        )
+
+    def load(self, path, file_format, batch_size, use_copy):
+        file_format = file_format or os.path.splitext(path)[1][1:].lower()
+        if file_format not in READERS:
+            raise CommandError(f'Неизвестный формат файла: {path}')
+        write_batch = copy_batch if use_copy else insert_batch
+        inserted = skipped = invalid = 0
         try:
-            file_path = os.path.join(
-                settings.BASE_DIR, 'data/', 'ingredients.json')
-
-            with open(file_path, 'r', encoding='utf-8') as file:
-                reader = json.load(file)
-                ingredients = [
-                    Ingredient(**item)
-                    for item in reader
-                ]
-                Ingredient.objects.bulk_create(
-                    ingredients,
-                    ignore_conflicts=True
-                )
-                number_of_loaded_items = Ingredient.objects.count()
-
-            print(f'Успешно загружено: ${number_of_loaded_items}')
-        except Exception as e:
-            print('Произошла ошибка при добавлении ингредиентов', e)
+            with open(path, encoding='utf-8', newline='') as file:
+                rows = clean_rows(READERS[file_format](file))
+                for batch in batched(rows, batch_size):
+                    valid = [key for key in batch if key]
+                    keys = list(dict.fromkeys(valid))
+                    with transaction.atomic():
+                        count = write_batch(keys) if keys else 0
+                    inserted += count
+                    skipped += len(valid) - count
+                    invalid += len(batch) - len(valid)
+        except OSError as error:
+            raise CommandError(f'Не удалось прочитать {path}: {error}')
+        return inserted, skipped, invalid
+
+    def handle(self, *args, **options):
+        if options['copy'] and connection.vendor != 'postgresql':
+            raise CommandError('COPY доступен только для PostgreSQL')
+        if options['batch_size'] < 1:
+            raise CommandError('Размер пакета должен быть положительным')
+        for path in options['paths']:
+            started = time.perf_counter()
+            inserted, skipped, invalid = self.load(
+                path, options['format'], options['batch_size'],
+                options['copy']
+            )
+            elapsed = time.perf_counter() - started
+            total = inserted + skipped + invalid
+            self.stdout.write(
+                f'{path}: добавлено {inserted}, пропущено {skipped}, '
+                f'ошибочных {invalid}; {total / elapsed:.0f} строк/с'
+            )
@@ -0,0 +1,72 @@
+from django.core.management import BaseCommand
+from django.db import transaction
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from recipe.models import (
+    Favorite,
+    Follow,
+    Ingredient,
+    IngredientsInRecipe,
+    Recipe,
+    ShoppingCartIngredient,
+    User
+)
+
+
+def count_of(model, field):
+    return Coalesce(Subquery(
+        model.objects.filter(**{field: OuterRef('pk')}).order_by().values(
+            field
+        ).annotate(total=Count('pk')).values('total'),
+        output_field=IntegerField()
+    ), 0)
+
+
+def rebuild_cart_totals():
+    ShoppingCartIngredient.objects.all().delete()
+    totals = IngredientsInRecipe.objects.filter(
+        recipe__shoppingcarts__isnull=False
+    ).values(
+        'recipe__shoppingcarts__user', 'ingredient'
+    ).annotate(total=Sum('amount')).order_by()
+    return len(ShoppingCartIngredient.objects.bulk_create(
+        ShoppingCartIngredient(
+            user_id=item['recipe__shoppingcarts__user'],
+            ingredient_id=item['ingredient'],
+            total=item['total']
+        ) for item in totals.iterator()
+    ))
+
+
+COUNTERS = (
+    (Recipe, 'favorites_count', Favorite, 'recipe'),
+    (User, 'recipes_count', Recipe, 'author'),
+    (User, 'followers_count', Follow, 'author'),
+    (Ingredient, 'recipes_count', IngredientsInRecipe, 'ingredient'),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересчитывает счётчики избранного, рецептов и подписчиков, '
+        'итоги корзин покупок и поисковые векторы рецептов'
+    )
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        for model, counter, related_model, field in COUNTERS:
+            actual = count_of(related_model, field)
+            fixed = model.objects.annotate(actual=actual).exclude(
+                **{counter: actual}
+            ).update(**{counter: actual})
+            self.stdout.write(
+                f'{model.__name__}.{counter}: исправлено {fixed}'
+            )
+        self.stdout.write(
+            f'ShoppingCartIngredient: пересобрано {rebuild_cart_totals()}'
+        )
+        self.stdout.write(
+            'Recipe.search_vector: обновлено '
+            f'{Recipe.objects.update_search_vectors()}'
+        )
@@ -0,0 +1,66 @@
+from django.core.management import BaseCommand
+
+from recipe.images import (
+    RENDITIONS_DIR,
+    delete_files,
+    process_image,
+    rendition_files
+)
+from recipe.models import Recipe, User
+
+IMAGE_FIELDS = ((Recipe, 'image'), (User, 'avatar'))
+
+
+class Command(BaseCommand):
+    help = (
+        'Строит уменьшенные копии изображений, которых ещё нет или которые '
+        'отстали от исходника, и удаляет копии убранных изображений'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Пересобрать копии всех изображений, например после смены '
+                 'IMAGE_RENDITIONS или IMAGE_RENDITION_FORMAT'
+        )
+        parser.add_argument(
+            '--prune', action='store_true',
+            help=f'Удалить файлы в {RENDITIONS_DIR}/, на которые не ссылается '
+                 'ни одна запись (запускать, когда загрузки не идут)'
+        )
+
+    def handle(self, *args, **options):
+        referenced = set()
+        for model, field_name in IMAGE_FIELDS:
+            processed = 0
+            rows = model.objects.values_list(
+                'pk', field_name, f'{field_name}_renditions'
+            ).order_by('pk')
+            for pk, source, renditions in rows.iterator():
+                source = source or None
+                if renditions.get('source') != source or (
+                    options['all'] and source
+                ):
+                    process_image(model, pk, field_name, source)
+                    processed += 1
+            self.stdout.write(
+                f'{model.__name__}.{field_name}: обработано {processed}'
+            )
+            for renditions in model.objects.values_list(
+                f'{field_name}_renditions', flat=True
+            ).iterator():
+                referenced |= rendition_files(renditions)
+        if options['prune']:
+            self.prune(referenced)
+
+    def prune(self, referenced):
+        storage = Recipe._meta.get_field('image').storage
+        try:
+            _, files = storage.listdir(RENDITIONS_DIR)
+        except FileNotFoundError:
+            files = []
+        orphans = {
+            f'{RENDITIONS_DIR}/{name}' for name in files
+        } - referenced
+        delete_files(storage, orphans)
+        self.stdout.write(f'{RENDITIONS_DIR}: удалено {len(orphans)}')
@@ -1,9 +1,72 @@
-from django.db import models
+import re
+
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.contrib.postgres.search import (
+    SearchQuery,
+    SearchRank,
+    SearchVector,
+    SearchVectorField,
+    TrigramSimilarity
+)
+from django.db import connections, models
+from django.db.models.functions import Cast, Greatest, Upper
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import MinValueValidator, RegexValidator
 
 
-class User(AbstractUser):
+class PortableIndexMixin:
+    """Индекс Postgres (GIN, классы операторов), который на других СУБД
+    создаётся обычным индексом по тем же выражениям, чтобы схема поднималась
+    и там (например, в SQLite)."""
+
+    def create_sql(self, model, schema_editor, using='', **kwargs):
+        if schema_editor.connection.vendor == 'postgresql':
+            return super().create_sql(
+                model, schema_editor, using=using, **kwargs
+            )
+        return models.Index(
+            *(
+                expression.get_source_expressions()[0]
+                if isinstance(expression, OpClass) else expression
+                for expression in self.expressions
+            ),
+            fields=self.fields,
+            name=self.name
+        ).create_sql(model, schema_editor, using=using, **kwargs)
+
+
+class PortableIndex(PortableIndexMixin, models.Index):
+    pass
+
+
+class PortableGinIndex(PortableIndexMixin, GinIndex):
+    pass
+
+
+def shifted(counter, delta):
+    # Счётчики неотрицательны (CHECK >= 0 в Postgres); строки, не
+    # пересчитанные командой recount, не должны уронить запрос.
+    return Greatest(models.F(counter) + delta, 0)
+
+
+class QueryManagedFieldsMixin:
+    # Поля, которые меняются только запросами (счётчики, поисковый вектор):
+    # save() без update_fields не перезаписывает их устаревшими значениями.
+    query_managed_fields = ()
+
+    def save(self, *args, **kwargs):
+        if (not self._state.adding and kwargs.get('update_fields') is None
+                and not kwargs.get('force_insert')):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.query_managed_fields
+            ]
+        super().save(*args, **kwargs)
+
+
+class User(QueryManagedFieldsMixin, AbstractUser):
     email = models.EmailField(
         'Адрес электронной почты',
         unique=True,
@@ -26,6 +89,20 @@ class User(AbstractUser):
         null=True,
         blank=True
     )
+    avatar_renditions = models.JSONField(
+        'Уменьшенные копии фото', default=dict, blank=True, editable=False
+    )
+    recipes_count = models.PositiveIntegerField(
+        'Число рецептов', default=0, editable=False
+    )
+    followers_count = models.PositiveIntegerField(
+        'Число подписчиков', default=0, editable=False
+    )
+
+    # avatar_renditions записывает обработчик изображений (recipe/images.py).
+    query_managed_fields = (
+        'recipes_count', 'followers_count', 'avatar_renditions'
+    )
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username', 'first_name', 'last_name']
@@ -39,7 +116,7 @@ class User(AbstractUser):
         return self.username
 
 
-class Ingredient(models.Model):
+class Ingredient(QueryManagedFieldsMixin, models.Model):
     name = models.CharField(
         verbose_name="Название ингридиента",
         max_length=128,
@@ -48,6 +125,13 @@ class Ingredient(models.Model):
         verbose_name="Единица измерения",
         max_length=64,
     )
+    recipes_count = models.PositiveIntegerField(
+        verbose_name="Используется в рецептах",
+        default=0,
+        editable=False
+    )
+
+    query_managed_fields = ('recipes_count',)
 
     class Meta:
         verbose_name = 'Ингредиент'
@@ -58,17 +142,148 @@ class Ingredient(models.Model):
                 name='unique_ingredient'
             )
         ]
+        indexes = [
+            PortableIndex(
+                OpClass(Upper('name'), name='text_pattern_ops'),
+                name='ingredient_upper_name_idx'
+            ),
+        ]
 
     def __str__(self):
         return self.name
 
 
-class Recipe(models.Model):
+SEARCH_CONFIG = 'russian'
+SEARCH_ORDERING = ('-search_rank', '-id')
+SEARCH_WEIGHTS = {'A': 1.0, 'B': 0.4, 'C': 0.2}
+RUSSIAN_ENDING = re.compile(
+    r'(ами|ями|ого|его|ому|ему|ыми|ими|ой|ей|ий|ый|ая|яя|ое|ее|ую|юю|'
+    r'ам|ям|ах|ях|ом|ем|ов|ев|ы|и|а|я|о|е|у|ю|ь|й)$'
+)
+
+
+def stem(word):
+    stemmed = RUSSIAN_ENDING.sub('', word.casefold())
+    return stemmed if len(stemmed) >= 3 else word.casefold()
+
+
+class RecipeQuerySet(models.QuerySet):
+
+    def is_postgresql(self):
+        return connections[self.db].vendor == 'postgresql'
+
+    def search(self, text):
+        if not self.is_postgresql():
+            return self.search_fallback(text)
+        query = SearchQuery(
+            text, config=SEARCH_CONFIG, search_type='websearch'
+        )
+        # ts_rank и similarity возвращают real: без приведения курсор
+        # хранит округлённое значение, которое больше сохранённого, и
+        # search_rank__lt снова выбирает последнюю строку страницы.
+        return self.annotate(search_rank=Cast(
+            SearchRank(models.F('search_vector'), query)
+            + TrigramSimilarity('name', text),
+            models.FloatField()
+        )).filter(
+            models.Q(search_vector=query) | self.fuzzy_condition(text)
+        ).order_by(*SEARCH_ORDERING)
+
+    @staticmethod
+    def fuzzy_condition(text):
+        # Опечатки прощаются по каждому слову отдельно: слово должно
+        # совпасть по основе или быть похожим на слово из названия, иначе
+        # близкое по триграммам название проходило без части слов запроса.
+        condition = models.Q()
+        for word in text.split():
+            condition &= models.Q(search_vector=SearchQuery(
+                word, config=SEARCH_CONFIG, search_type='plain'
+            )) | models.Q(name__trigram_word_similar=word)
+        return condition
+
+    def search_fallback(self, text):
+        # Без Postgres: совпадение основ слов без учёта регистра (REGEXP
+        # в SQLite выполняется через re), веса полей как у search_vector.
+        queryset, rank = self, models.Value(0.0)
+        for word in text.split():
+            pattern = re.escape(stem(word))
+            in_ingredients = models.Exists(IngredientsInRecipe.objects.filter(
+                recipe=models.OuterRef('pk'),
+                ingredient__name__iregex=pattern
+            ))
+            matches = (
+                (models.Q(name__iregex=pattern), SEARCH_WEIGHTS['A']),
+                (models.Q(in_ingredients), SEARCH_WEIGHTS['B']),
+                (models.Q(text__iregex=pattern), SEARCH_WEIGHTS['C']),
+            )
+            condition = models.Q()
+            for match, weight in matches:
+                condition |= match
+                rank += models.Case(
+                    models.When(match, then=models.Value(weight)),
+                    default=models.Value(0.0)
+                )
+            queryset = queryset.filter(condition)
+        return queryset.annotate(
+            search_rank=models.ExpressionWrapper(
+                rank, output_field=models.FloatField()
+            )
+        ).order_by(*SEARCH_ORDERING)
+
+    def update_search_vectors(self):
+        if not self.is_postgresql():
+            return 0
+        ingredient_names = models.Subquery(
+            IngredientsInRecipe.objects.filter(
+                recipe=models.OuterRef('pk')
+            ).order_by().values('recipe').annotate(
+                names=StringAgg('ingredient__name', ' ')
+            ).values('names')
+        )
+        return self.update(search_vector=(
+            SearchVector('name', weight='A', config=SEARCH_CONFIG)
+            + SearchVector(ingredient_names, weight='B', config=SEARCH_CONFIG)
+            + SearchVector('text', weight='C', config=SEARCH_CONFIG)
+        ))
+
+    def with_user_state(self, user):
+        queryset = self.defer('search_vector').select_related(
+            'author'
+        ).prefetch_related(
+            models.Prefetch(
+                'ingredients_in_recipe',
+                queryset=IngredientsInRecipe.objects.select_related(
+                    'ingredient'
+                )
+            )
+        )
+        if not user.is_authenticated:
+            return queryset.annotate(
+                is_favorited=models.Value(False),
+                is_in_shopping_cart=models.Value(False),
+                author_is_subscribed=models.Value(False),
+            )
+        return queryset.annotate(
+            is_favorited=models.Exists(Favorite.objects.filter(
+                user=user, recipe=models.OuterRef('pk')
+            )),
+            is_in_shopping_cart=models.Exists(ShoppingCart.objects.filter(
+                user=user, recipe=models.OuterRef('pk')
+            )),
+            author_is_subscribed=models.Exists(Follow.objects.filter(
+                follower=user, author=models.OuterRef('author')
+            )),
+        )
+
+
+class Recipe(QueryManagedFieldsMixin, models.Model):
+    # Отдельный индекс не нужен: его покрывает recipe_author_created_at_idx.
     author = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
         related_name="recipes",
         verbose_name="Автор",
+        db_index=False,
     )
     name = models.CharField(verbose_name="Название рецепта", max_length=256,)
     image = models.ImageField(
@@ -76,6 +291,12 @@ class Recipe(models.Model):
         verbose_name="Фотография",
         max_length=256
     )
+    image_renditions = models.JSONField(
+        verbose_name="Уменьшенные копии фотографии",
+        default=dict,
+        blank=True,
+        editable=False
+    )
     text = models.TextField(
         verbose_name="Описание"
     )
@@ -87,6 +308,11 @@ class Recipe(models.Model):
         auto_now_add=True,
         verbose_name="Дата создания",
     )
+    favorites_count = models.PositiveIntegerField(
+        verbose_name="В избранном",
+        default=0,
+        editable=False
+    )
     ingredients = models.ManyToManyField(
         Ingredient,
         through='IngredientsInRecipe',
@@ -94,10 +320,42 @@ class Recipe(models.Model):
         verbose_name='Ингредиенты'
     )
 
+    search_vector = SearchVectorField(
+        verbose_name="Поисковый вектор",
+        null=True,
+        editable=False
+    )
+
+    objects = RecipeQuerySet.as_manager()
+
+    # search_vector пересчитывается запросом после сохранения рецепта,
+    # image_renditions записывает обработчик изображений.
+    query_managed_fields = (
+        'favorites_count', 'search_vector', 'image_renditions'
+    )
+
     class Meta:
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
         ordering = ('-created_at',)
+        indexes = [
+            models.Index(
+                fields=['-created_at', '-id'],
+                name='recipe_created_at_idx'
+            ),
+            models.Index(
+                fields=['author', '-created_at'],
+                name='recipe_author_created_at_idx'
+            ),
+            PortableGinIndex(
+                fields=['search_vector'],
+                name='recipe_search_vector_idx'
+            ),
+            PortableGinIndex(
+                OpClass('name', name='gin_trgm_ops'),
+                name='recipe_name_trgm_idx'
+            ),
+        ]
 
     def __str__(self):
         return self.name
@@ -136,11 +394,13 @@ class IngredientsInRecipe(models.Model):
 
 
 class UserRecipeBaseModel(models.Model):
+    # Выборки по пользователю обслуживает уникальный индекс (user, recipe).
     user = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
         related_name='%(class)ss',
-        verbose_name='Пользователь'
+        verbose_name='Пользователь',
+        db_index=False
     )
     recipe = models.ForeignKey(
         Recipe,
@@ -176,6 +436,99 @@ class ShoppingCart(UserRecipeBaseModel):
         return f'Рецепт "{self.recipe.name}" в корзине у {self.user.username}'
 
 
+class RecipeSimilarity(models.Model):
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='similarities',
+        verbose_name='Рецепт'
+    )
+    similar = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Похожий рецепт'
+    )
+    score = models.FloatField(verbose_name='Сходство')
+
+    class Meta:
+        verbose_name = 'Похожий рецепт'
+        verbose_name_plural = 'Похожие рецепты'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['recipe', 'similar'],
+                name='unique_recipe_similarity'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.similar.name} похож на {self.recipe.name}'
+
+
+class ShoppingCartIngredientQuerySet(models.QuerySet):
+
+    def apply_deltas(self, user_ids, deltas):
+        deltas = {pk: delta for pk, delta in deltas.items() if delta}
+        if not user_ids or not deltas:
+            return
+        self.bulk_create(
+            (
+                self.model(user_id=user_id, ingredient_id=pk, total=0)
+                for user_id in user_ids
+                for pk, delta in deltas.items() if delta > 0
+            ),
+            ignore_conflicts=True
+        )
+        rows = self.filter(user_id__in=user_ids, ingredient_id__in=deltas)
+        rows.update(total=models.F('total') + models.Case(
+            *(
+                models.When(ingredient_id=pk, then=models.Value(delta))
+                for pk, delta in deltas.items()
+            ),
+            output_field=models.IntegerField()
+        ))
+        rows.filter(total__lte=0).delete()
+
+    def add_recipe(self, user_ids, recipe_id, sign=1):
+        self.apply_deltas(user_ids, {
+            pk: sign * amount
+            for pk, amount in IngredientsInRecipe.objects.filter(
+                recipe_id=recipe_id
+            ).values_list('ingredient_id', 'amount')
+        })
+
+
+class ShoppingCartIngredient(models.Model):
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='cart_ingredients',
+        verbose_name='Пользователь'
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='cart_totals',
+        verbose_name='Ингредиент'
+    )
+    total = models.IntegerField(verbose_name='Всего', default=0)
+
+    objects = ShoppingCartIngredientQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Ингредиент в корзине'
+        verbose_name_plural = 'Ингредиенты в корзине'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'ingredient'],
+                name='unique_cart_ingredient'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.ingredient.name} в корзине у {self.user.username}'
+
+
 class Follow(models.Model):
     author = models.ForeignKey(
         User,
@@ -183,11 +536,13 @@ class Follow(models.Model):
         related_name='authors_subs',
         verbose_name='автор'
     )
+    # Подписки пользователя обслуживает уникальный индекс (follower, author).
     follower = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
         related_name='followers_subs',
-        verbose_name='подписчик'
+        verbose_name='подписчик',
+        db_index=False
     )
 
     class Meta:
@@ -196,7 +551,7 @@ class Follow(models.Model):
         constraints = [
             models.UniqueConstraint
             (
-                fields=['author', 'follower'],
+                fields=['follower', 'author'],
                 name='unique_subscription'
             )
         ]
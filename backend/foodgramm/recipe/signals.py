@@ -0,0 +1,205 @@
+from collections import Counter
+
+from django.db import connections, transaction
+from django.db.models.signals import (
+    post_delete,
+    post_save,
+    pre_delete,
+    pre_save
+)
+from django.dispatch import receiver
+
+from .images import delete_renditions, schedule_renditions
+from .models import (
+    Favorite,
+    Follow,
+    Ingredient,
+    IngredientsInRecipe,
+    Recipe,
+    ShoppingCart,
+    ShoppingCartIngredient,
+    User,
+    shifted
+)
+
+SEARCH_FIELDS = {'name', 'text'}
+
+
+def create_extensions(using, **kwargs):
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+
+@receiver(post_save, sender=Recipe)
+def process_recipe_image(instance, update_fields=None, **kwargs):
+    schedule_renditions(instance, 'image', update_fields)
+
+
+@receiver(post_save, sender=User)
+def process_avatar(instance, update_fields=None, **kwargs):
+    schedule_renditions(instance, 'avatar', update_fields)
+
+
+@receiver(post_delete, sender=Recipe)
+def delete_recipe_renditions(instance, **kwargs):
+    delete_renditions(instance, 'image')
+
+
+@receiver(post_delete, sender=User)
+def delete_avatar_renditions(instance, **kwargs):
+    delete_renditions(instance, 'avatar')
+
+
+@receiver(post_save, sender=Recipe)
+def refresh_search_vector(instance, update_fields=None, **kwargs):
+    if update_fields is not None and not SEARCH_FIELDS & set(update_fields):
+        return
+    transaction.on_commit(
+        lambda: Recipe.objects.filter(pk=instance.pk).update_search_vectors()
+    )
+
+
+@receiver(post_save, sender=Ingredient)
+def refresh_ingredient_recipes(instance, created, **kwargs):
+    if not created:
+        transaction.on_commit(lambda: Recipe.objects.filter(
+            ingredients_in_recipe__ingredient=instance
+        ).update_search_vectors())
+
+
+# Итоги корзин (ShoppingCartIngredient) - сумма по парам «строка корзины x
+# строка состава рецепта». Приёмники каждой стороны смотрят на текущее
+# состояние другой, поэтому при каскадном удалении пара списывается ровно
+# один раз, в каком бы порядке Django ни удалял строки. bulk_create и
+# bulk_update сигналов не шлют - их итоги считает вызывающий код.
+
+def deleted_with(origin, model, pk):
+    return isinstance(origin, model) and origin.pk == pk
+
+
+def change_counter(model, pk, counter, delta):
+    model.objects.filter(pk=pk).update(**{counter: shifted(counter, delta)})
+
+
+def cart_users(recipe_id):
+    return list(ShoppingCart.objects.filter(
+        recipe_id=recipe_id
+    ).values_list('user_id', flat=True))
+
+
+@receiver(pre_delete, sender=Recipe)
+def remove_recipe_from_carts(instance, origin=None, **kwargs):
+    # Удаление самого рецепта списывается из всех корзин одним проходом,
+    # построчные приёмники его связей тогда пропускают работу.
+    if deleted_with(origin, Recipe, instance.pk):
+        ShoppingCartIngredient.objects.add_recipe(
+            cart_users(instance.pk), instance.pk, sign=-1
+        )
+
+
+@receiver(post_save, sender=ShoppingCart)
+def add_cart_totals(instance, created, raw=False, **kwargs):
+    if created and not raw:
+        ShoppingCartIngredient.objects.add_recipe(
+            [instance.user_id], instance.recipe_id
+        )
+
+
+@receiver(post_delete, sender=ShoppingCart)
+def remove_cart_totals(instance, origin=None, **kwargs):
+    if not (deleted_with(origin, Recipe, instance.recipe_id)
+            or deleted_with(origin, User, instance.user_id)):
+        ShoppingCartIngredient.objects.add_recipe(
+            [instance.user_id], instance.recipe_id, sign=-1
+        )
+
+
+@receiver(pre_save, sender=IngredientsInRecipe)
+def remember_composition(instance, raw=False, **kwargs):
+    instance._saved_row = None if raw or instance._state.adding else (
+        IngredientsInRecipe.objects.filter(pk=instance.pk).values_list(
+            'recipe_id', 'ingredient_id', 'amount'
+        ).first()
+    )
+
+
+def change_cart_totals(deltas):
+    for (recipe_id, ingredient_id), delta in deltas.items():
+        if delta:
+            ShoppingCartIngredient.objects.apply_deltas(
+                cart_users(recipe_id), {ingredient_id: delta}
+            )
+
+
+@receiver(post_save, sender=IngredientsInRecipe)
+def update_composition_totals(instance, raw=False, **kwargs):
+    if raw:
+        return
+    deltas = Counter()
+    saved = instance.__dict__.pop('_saved_row', None)
+    if saved is None:
+        change_counter(Ingredient, instance.ingredient_id, 'recipes_count', 1)
+    else:
+        recipe_id, ingredient_id, amount = saved
+        deltas[recipe_id, ingredient_id] -= amount
+        if ingredient_id != instance.ingredient_id:
+            change_counter(Ingredient, ingredient_id, 'recipes_count', -1)
+            change_counter(
+                Ingredient, instance.ingredient_id, 'recipes_count', 1
+            )
+    deltas[instance.recipe_id, instance.ingredient_id] += instance.amount
+    change_cart_totals(deltas)
+
+
+@receiver(post_delete, sender=IngredientsInRecipe)
+def remove_composition_totals(instance, origin=None, **kwargs):
+    if deleted_with(origin, Ingredient, instance.ingredient_id):
+        return
+    change_counter(Ingredient, instance.ingredient_id, 'recipes_count', -1)
+    if not deleted_with(origin, Recipe, instance.recipe_id):
+        change_cart_totals({
+            (instance.recipe_id, instance.ingredient_id): -instance.amount
+        })
+
+
+# Счётчики (recipes_count, followers_count, favorites_count) тоже ведут
+# сигналы, чтобы их не сбивали админка и каскадные удаления; recount
+# остаётся инструментом починки. Строка, которая удаляется вместе с
+# объектом-владельцем счётчика, его не трогает.
+
+@receiver(post_save, sender=Recipe)
+def count_created_recipe(instance, created, raw=False, **kwargs):
+    if created and not raw:
+        change_counter(User, instance.author_id, 'recipes_count', 1)
+
+
+@receiver(post_delete, sender=Recipe)
+def count_deleted_recipe(instance, origin=None, **kwargs):
+    if not deleted_with(origin, User, instance.author_id):
+        change_counter(User, instance.author_id, 'recipes_count', -1)
+
+
+@receiver(post_save, sender=Favorite)
+def count_created_favorite(instance, created, raw=False, **kwargs):
+    if created and not raw:
+        change_counter(Recipe, instance.recipe_id, 'favorites_count', 1)
+
+
+@receiver(post_delete, sender=Favorite)
+def count_deleted_favorite(instance, origin=None, **kwargs):
+    if not deleted_with(origin, Recipe, instance.recipe_id):
+        change_counter(Recipe, instance.recipe_id, 'favorites_count', -1)
+
+
+@receiver(post_save, sender=Follow)
+def count_created_follow(instance, created, raw=False, **kwargs):
+    if created and not raw:
+        change_counter(User, instance.author_id, 'followers_count', 1)
+
+
+@receiver(post_delete, sender=Follow)
+def count_deleted_follow(instance, origin=None, **kwargs):
+    if not deleted_with(origin, User, instance.author_id):
+        change_counter(User, instance.author_id, 'followers_count', -1)
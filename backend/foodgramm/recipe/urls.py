@@ -1,8 +1,14 @@
+from django.conf import settings
 from django.urls import path
-from recipe.views import redirect_short_link
+from recipe.views import aredirect_short_link, redirect_short_link
 
 app_name = "recipe"
 
 urlpatterns = [
-    path('s/<int:pk>/', redirect_short_link, name='recipe_short_link')
+    path(
+        's/<int:pk>/',
+        aredirect_short_link if settings.ASYNC_READ_VIEWS
+        else redirect_short_link,
+        name='recipe_short_link'
+    )
 ]
@@ -1,3 +1,4 @@
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.shortcuts import redirect
 from recipe.models import Recipe
@@ -6,3 +7,9 @@ from recipe.models import Recipe
 def redirect_short_link(request, pk):
     get_object_or_404(Recipe, id=pk)
     return redirect(f'/recipes/{pk}/')
+
+
+async def aredirect_short_link(request, pk):
+    if not await Recipe.objects.filter(id=pk).aexists():
+        raise Http404('Рецепт не найден')
+    return redirect(f'/recipes/{pk}/')